@@ -0,0 +1,2 @@
+# Benchmarks for the notification system. Run them from the repository root,
+# e.g. `python -m benchmarks.parse_file_info`
@@ -0,0 +1,39 @@
+# Times a full notification cycle (state update, formatting and dispatch)
+# delivered over SMTP to a local stand-in server.
+#   python -m benchmarks.email_dispatch [recipients] [files]
+import sys
+import time
+from datetime import timedelta
+from dateutil import parser
+import toad_functions
+from benchmarks.fakes import FakeSmtpServer
+from benchmarks.parse_file_info import syntheticNames
+
+def main(recipients=500, files=200):
+    now = parser.isoparse("2021-01-01T00:00:00+10:00")
+    names = syntheticNames(files)
+    dropbox_files = [toad_functions.FileEntry(name, "/audio/" + name) for name in names]
+    whitelist_times = toad_functions.parse_whitelist_times(None)
+    send_to_emails = [f"subscriber{i}@example.com" for i in range(recipients)]
+
+    with FakeSmtpServer() as server:
+        transport = toad_functions.SmtpTransport("127.0.0.1", server.port)
+        started = time.perf_counter()
+        (notifications_to_send, sensors_status) = toad_functions.getNotificationsAndActivatingSensors(
+            dropbox_files, {}, {}, 3600, timedelta(hours=10), now, whitelist_times)
+        toad_functions.updateState(notifications_to_send, sensors_status, {}, {}, now)
+        body = toad_functions.formatNotifications(notifications_to_send, sensors_status, lambda path: "https://example.com" + path)
+        dispatch_started = time.perf_counter()
+        outcomes = toad_functions.sendEmail(body, "benchmark", send_to_emails, "bot@example.com", transport)
+        finished = time.perf_counter()
+        transport.close()
+
+    assert all(outcomes.values()) and server.messages == recipients
+    dispatch = finished - dispatch_started
+    print(f"{files} files, {recipients} recipients over {server.connections} SMTP connection(s)")
+    print(f"  cycle    {finished - started:8.3f}s")
+    print(f"  dispatch {dispatch:8.3f}s  {recipients / dispatch:10.0f} messages/s")
+    return {"cycle_seconds": finished - started, "dispatch_seconds": dispatch, "messages_per_second": recipients / dispatch}
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,136 @@
+# Times whole notifier runs (toad_notification_system.runCycle) against a
+# synthetic archive held in a local fake Dropbox, with emails going to a fake
+# SendGrid. Two runs are measured:
+#   backfill     a new instance's first run over the whole archive
+#   incremental  a following run after new files arrive, using the cursor
+# Results (per stage seconds and API call counts) are written as JSON so they
+# can be compared between commits.
+#   python -m benchmarks.end_to_end --files 100000 --sensors 50 --output results.json
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import timedelta
+from dateutil import parser
+import toad_functions
+import toad_notification_system
+from toad_state import openStateStore
+from benchmarks.fakes import FakeDropbox, FakeSendGrid
+
+ROOT_FOLDER = "/instance/audio"
+LOG_FOLDER = "/instance"
+EMAIL_LIST = "/instance/email_alert_list.txt"
+
+def _recordingName(recorded_at, sensor):
+    return recorded_at.strftime("toad-%Y-%m-%d-%H%M%S%z-") + f"sensor{sensor}.flac"
+
+# Fill `dbx` with `files` recordings from `sensors` sensors spread over the
+# `days` before `now`, an up and a down log a day for each sensor, and a list
+# of `recipients` email addresses
+def syntheticArchive(dbx, now, files, sensors, days, recipients, seed=42):
+    rng = random.Random(seed)
+    span = int(timedelta(days=days).total_seconds())
+    for _ in range(files):
+        recorded_at = now - timedelta(seconds=rng.randrange(span))
+        dbx.addFile(ROOT_FOLDER + "/" + _recordingName(recorded_at, rng.randrange(sensors)))
+
+    for sensor in range(sensors):
+        dbx.addFolder(f"{LOG_FOLDER}/sensor{sensor}/logs")
+        for day in range(days):
+            logged_at = now - timedelta(days=day)
+            for (hour, status) in [(6, "up"), (18, "down")]:
+                name = logged_at.replace(hour=hour, minute=0, second=0).strftime("log-%Y-%m-%d-%H%M%S-") + status + ".txt"
+                dbx.addFile(f"{LOG_FOLDER}/sensor{sensor}/logs/{name}")
+
+    dbx.addFile(EMAIL_LIST, "\n".join(f"subscriber{i}@example.com" for i in range(recipients)).encode("utf-8"))
+
+# The notifier's configuration for the synthetic archive. A status report is
+# due at both runs, and each run's metrics are appended to `metrics_path`.
+def _configuration(metrics_path):
+    return {"name": "benchmark", "root_folder": ROOT_FOLDER, "log_folder": LOG_FOLDER,
+        "save_status_reports_folder": None, "filename_send_to": EMAIL_LIST, "send_from": "bot@example.com",
+        "pause_duration": 3600, "fallback_utc_offset": 36000, "log_retention_days": 7,
+        "whitelist_times_of_day": [["18:00", "24:00"], ["00:00", "06:00"]],
+        "update_status_report_at": ["00:00", "02:00"], "metrics": {"json_lines": metrics_path}}
+
+# One run of the driver's cycle.
+# returns its stage seconds, as the cycle's metrics recorded them
+def _timeRun(system_configuration, dbx, sendgrid_client, state, now):
+    toad_notification_system.runCycle(system_configuration, dbx, toad_functions.SendGridTransport(sendgrid_client), state, now)
+    with open(system_configuration["metrics"]["json_lines"], "r") as f:
+        return json.loads(f.readlines()[-1])["stages"]
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(files=100000, sensors=50, days=30, recipients=100, new_files=100, page_size=2000, latency=0.0, output=None):
+    now = parser.isoparse("2021-01-01T00:00:00+10:00")
+    dbx = FakeDropbox(page_size=page_size, latency=latency)
+    sendgrid_client = FakeSendGrid(latency=latency)
+    syntheticArchive(dbx, now, files, sensors, days, recipients)
+
+    results = {
+        "benchmark": "end_to_end",
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "parameters": {"files": files, "sensors": sensors, "days": days, "recipients": recipients,
+            "new_files": new_files, "page_size": page_size, "latency": latency},
+        "runs": {},
+    }
+    # the status report can be copied to the working directory
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            system_configuration = _configuration(os.path.join(scratch, "metrics.jsonl"))
+            state = openStateStore("json", scratch)
+            # the backfill is a new instance's first run, which takes in the
+            # whole archive without notifying. The incremental run's new files
+            # are then notified.
+            for (run, run_at, arriving) in [("backfill", now, 0), ("incremental", now + timedelta(hours=2), new_files)]:
+                rng = random.Random(run)
+                for i in range(arriving):
+                    dbx.addFile(ROOT_FOLDER + "/" + _recordingName(run_at - timedelta(seconds=i + 1), rng.randrange(sensors)))
+                dbx.calls.clear()
+                started = time.perf_counter()
+                stages = _timeRun(system_configuration, dbx, sendgrid_client, state, run_at)
+                results["runs"][run] = {
+                    "total_seconds": time.perf_counter() - started,
+                    "stages": stages,
+                    "api_calls": dict(dbx.calls),
+                }
+        finally:
+            os.chdir(working_directory)
+    results["emails"] = {"requests": sendgrid_client.requests, "personalizations": sendgrid_client.personalizations}
+
+    for (run, result) in results["runs"].items():
+        print(f"{run}: {result['total_seconds']:.3f}s, {sum(result['api_calls'].values())} API calls")
+        for (stage, seconds) in result["stages"].items():
+            print(f"  {stage:14} {seconds:8.3f}s")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to " + output)
+    return results
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Time full notifier runs against a fake Dropbox")
+    argument_parser.add_argument("--files", type=int, default=100000, help="recordings in the archive")
+    argument_parser.add_argument("--sensors", type=int, default=50)
+    argument_parser.add_argument("--days", type=int, default=30, help="days of recordings and logs")
+    argument_parser.add_argument("--recipients", type=int, default=100)
+    argument_parser.add_argument("--new-files", type=int, default=100, help="recordings arriving before the incremental run")
+    argument_parser.add_argument("--page-size", type=int, default=2000, help="entries per listing page")
+    argument_parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake API call")
+    argument_parser.add_argument("--output", help="write the results to this JSON file")
+    arguments = argument_parser.parse_args(sys.argv[1:])
+    main(arguments.files, arguments.sensors, arguments.days, arguments.recipients,
+        arguments.new_files, arguments.page_size, arguments.latency, arguments.output)
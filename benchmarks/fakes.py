@@ -0,0 +1,214 @@
+# In-process stand-ins for the services the notifier talks to
+import posixpath
+import socketserver
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+import dropbox
+import toad_functions
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply("220 localhost fake SMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self._reply("250 localhost")
+            elif command == b"DATA":
+                self._reply("354 end data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self._reply("250 OK")
+            elif command == b"QUIT":
+                self._reply("221 bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self._reply("250 OK")
+
+# Accepts and counts every message it's sent, without keeping them.
+#   with FakeSmtpServer() as server: SmtpTransport("localhost", server.port)
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _SmtpHandler)
+        self.port = self.server_address[1]
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.connections = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+class _SharedLinkError():
+    def is_shared_link_already_exists(self):
+        return True
+
+class _NotFoundError():
+    def is_path(self):
+        return True
+
+    def get_path(self):
+        return self
+
+    def is_not_found(self):
+        return True
+
+# An in-memory Dropbox answering the calls the notifier makes. Each folder keeps
+# its entries in the order they were added, so a cursor is just a position and
+# continuing a finished listing returns whatever has been added since, like the
+# real delta API. A longpoll returns as soon as something is added. Every call
+# is counted in `calls` and sleeps `latency` seconds to stand in for the
+# network round trip.
+class FakeDropbox():
+    def __init__(self, page_size=2000, latency=0.0):
+        self.page_size = page_size
+        self.latency = latency
+        self.folders = {"": []}
+        self.contents = {}
+        self.links = {}
+        self.sessions = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        # notified whenever an entry is added
+        self.changed = threading.Condition()
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _addEntry(self, entry):
+        parent = posixpath.dirname(entry.path_lower)
+        if parent == "/":
+            parent = ""
+        if parent not in self.folders:
+            self.addFolder(parent)
+        with self.changed:
+            self.folders[parent].append(entry)
+            self.changed.notify_all()
+
+    def addFolder(self, path):
+        path = path.lower().rstrip("/")
+        if path not in self.folders:
+            self.folders[path] = []
+            self._addEntry(dropbox.files.FolderMetadata(name=posixpath.basename(path), path_lower=path, path_display=path))
+
+    def addFile(self, path, content=b""):
+        path = path.lower()
+        if path not in self.contents:
+            self._addEntry(dropbox.files.FileMetadata(name=posixpath.basename(path), path_lower=path, path_display=path))
+        self.contents[path] = content
+
+    def _page(self, folder, position):
+        # unknown folders list as empty, where Dropbox would raise a not_found error
+        entries = self.folders.get(folder, [])
+        end = min(position + self.page_size, len(entries))
+        return dropbox.files.ListFolderResult(entries[position:end], f"{folder}|{end}", end < len(entries))
+
+    def users_get_current_account(self):
+        self._call("users_get_current_account")
+        return SimpleNamespace(email="benchmark@example.com")
+
+    def files_list_folder(self, path):
+        self._call("files_list_folder")
+        return self._page(path.lower().rstrip("/"), 0)
+
+    def files_list_folder_continue(self, cursor):
+        self._call("files_list_folder_continue")
+        (folder, position) = cursor.rsplit("|", 1)
+        return self._page(folder, int(position))
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        self._call("files_list_folder_longpoll")
+        (folder, position) = cursor.rsplit("|", 1)
+        with self.changed:
+            changes = self.changed.wait_for(lambda: len(self.folders.get(folder, [])) > int(position), timeout)
+        return SimpleNamespace(changes=changes, backoff=None)
+
+    def files_download(self, path):
+        self._call("files_download")
+        return (self._metadata(path), SimpleNamespace(content=self.contents[path.lower()], close=lambda: None))
+
+    def files_download_to_file(self, download_path, path):
+        self._call("files_download_to_file")
+        with open(download_path, "wb") as f:
+            f.write(self.contents[path.lower()])
+
+    def _metadata(self, path):
+        return dropbox.files.FileMetadata(name=posixpath.basename(path), path_lower=path.lower(),
+            content_hash=toad_functions.dropboxContentHash(self.contents[path.lower()]))
+
+    def files_get_metadata(self, path):
+        self._call("files_get_metadata")
+        if path.lower() not in self.contents:
+            raise dropbox.exceptions.ApiError(None, _NotFoundError(), None, None)
+        return self._metadata(path)
+
+    def files_upload(self, f, path, mode=None, mute=False, **kwargs):
+        self._call("files_upload")
+        self.addFile(path, f)
+        return self._metadata(path)
+
+    def files_upload_session_start(self, f, close=False):
+        self._call("files_upload_session_start")
+        session_id = f"session{len(self.sessions)}"
+        self.sessions[session_id] = bytearray(f)
+        return SimpleNamespace(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+        self._call("files_upload_session_append_v2")
+        assert len(self.sessions[cursor.session_id]) == cursor.offset, "upload session offset mismatch"
+        self.sessions[cursor.session_id] += f
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        self._call("files_upload_session_finish")
+        assert len(self.sessions[cursor.session_id]) == cursor.offset, "upload session offset mismatch"
+        self.addFile(commit.path, bytes(self.sessions.pop(cursor.session_id) + f))
+        return self._metadata(commit.path)
+
+    def sharing_create_shared_link_with_settings(self, path, settings=None):
+        self._call("sharing_create_shared_link_with_settings")
+        with self.lock:
+            if path in self.links:
+                raise dropbox.exceptions.ApiError(None, _SharedLinkError(), None, None)
+            self.links[path] = SimpleNamespace(url="https://dropbox.example.com/s" + path)
+        return self.links[path]
+
+    def sharing_get_shared_links(self, path=None):
+        self._call("sharing_get_shared_links")
+        return SimpleNamespace(links=[self.links[path]] if path in self.links else [])
+
+# Stands in for a SendGridAPIClient: sg.client.mail.send.post(request_body=...)
+# is accepted and counted, and nothing is sent.
+class FakeSendGrid():
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.client = SimpleNamespace(mail=SimpleNamespace(send=self))
+        self.requests = 0
+        self.personalizations = 0
+
+    def post(self, request_body):
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        self.personalizations += len(request_body["personalizations"])
+        return SimpleNamespace(status_code=202)
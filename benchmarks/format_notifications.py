@@ -0,0 +1,38 @@
+# Times building the email body for a large flush: 5,000 notified files from
+# 50 sensors, listed in full and as a digest of 20 files per sensor.
+#   python -m benchmarks.format_notifications [files] [sensors]
+import sys
+import time
+from datetime import timedelta
+import toad_functions
+from benchmarks.parse_file_info import syntheticNames
+
+def _time(call, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(files=5000, sensors=50):
+    fallback = timedelta(hours=10)
+    notifications_to_send = []
+    for name in syntheticNames(files, sensors):
+        (timestamp, utc_offset, sensor_name) = toad_functions.parseFileTimestamp(name, fallback)
+        notifications_to_send.append(toad_functions.Notification(name, "/audio/" + name, timestamp, utc_offset, sensor_name, False))
+    sensors_status = {f"sensor{sensor}": toad_functions.SensorState.ACTIVATED for sensor in range(sensors)}
+    href_function = lambda path: "https://example.com" + path
+
+    results = {
+        "format": _time(lambda: toad_functions.formatNotifications(notifications_to_send, sensors_status, href_function)),
+        "format_digest": _time(lambda: toad_functions.formatNotifications(notifications_to_send, sensors_status, href_function, 20)),
+    }
+    print(f"email body for {files} files from {sensors} sensors")
+    print(f"  every file           {results['format']:8.4f}s")
+    print(f"  20 files per sensor  {results['format_digest']:8.4f}s")
+    return results
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
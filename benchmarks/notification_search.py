@@ -0,0 +1,43 @@
+# Times getNotificationsAndActivatingSensors over a large backfill, where
+# every file in the listing is new.
+#   python -m benchmarks.notification_search [files] [sensors]
+import sys
+import time
+from datetime import timedelta
+from dateutil import parser
+import toad_functions
+from benchmarks.parse_file_info import syntheticNames
+
+def main(files=1000000, sensors=50):
+    names = syntheticNames(files, sensors)
+    dropbox_files = [toad_functions.FileEntry(name, "/audio/" + name) for name in names]
+    whitelist_times = toad_functions.compile_whitelist([["18:00", "24:00"], ["00:00", "06:00"]])
+    now = parser.isoparse("2021-01-01T00:00:00+10:00")
+    fallback_utc_offset = timedelta(hours=10)
+
+    started = time.perf_counter()
+    table = toad_functions.ListingTable.fromEntries(dropbox_files, {}, fallback_utc_offset)
+    ingested = time.perf_counter()
+    in_whitelist = whitelist_times.containsAll(table.localSeconds(), table.sensor_ids, table.sensor_names)
+    whitelisted = time.perf_counter()
+    del table, in_whitelist
+
+    searched = time.perf_counter()
+    (notifications_to_send, sensors_status) = toad_functions.getNotificationsAndActivatingSensors(
+        dropbox_files, {}, {}, 3600, fallback_utc_offset, now, whitelist_times)
+    finished = time.perf_counter()
+
+    results = {
+        "ingest_seconds": ingested - started,
+        "whitelist_seconds": whitelisted - ingested,
+        "notifications_seconds": finished - searched,
+    }
+    inside = sum(not notification.suppress for notification in notifications_to_send)
+    print(f"{files} new files from {len(sensors_status)} sensors, {inside} inside the whitelist")
+    print(f"  ingest             {results['ingest_seconds']:8.3f}s")
+    print(f"  whitelist (batch)  {results['whitelist_seconds']:8.3f}s")
+    print(f"  full search        {results['notifications_seconds']:8.3f}s")
+    return results
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
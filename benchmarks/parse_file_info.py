@@ -0,0 +1,48 @@
+# Micro-benchmark for filename parsing over a synthetic listing.
+#   python -m benchmarks.parse_file_info [count]
+import sys
+import random
+import timeit
+from datetime import timedelta
+import toad_functions
+
+def syntheticNames(count, sensors=50, seed=42):
+    rng = random.Random(seed)
+    offsets = ["", "", "Z", "+1000", "-0930"]
+    names = []
+    for i in range(count):
+        names.append("toad-%04d-%02d-%02d-%02d%02d%02d%s-sensor%d.flac" % (
+            rng.randint(2015, 2020), rng.randint(1, 12), rng.randint(1, 28),
+            rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+            rng.choice(offsets), rng.randrange(sensors)))
+    return names
+
+def _timeParse(parse, names, fallback):
+    def run():
+        for name in names:
+            parse(name, fallback)
+    return min(timeit.repeat(run, number=1, repeat=3))
+
+def main(count=500000):
+    names = syntheticNames(count)
+    fallback = timedelta(hours=10)
+    results = {}
+
+    results["generic"] = _timeParse(toad_functions._parseFileInfoGeneric, names, fallback)
+    results["fast_path"] = _timeParse(toad_functions._parseFileInfoCached.__wrapped__, names, fallback)
+
+    # the memo only helps names it can hold, so time a listing that fits
+    cached_names = names[:toad_functions._PARSE_CACHE_SIZE]
+    toad_functions._parseFileInfoCached.cache_clear()
+    for name in cached_names:
+        toad_functions.parseFileInfo(name, fallback)
+    results["memoized"] = _timeParse(toad_functions.parseFileInfo, cached_names, fallback) * len(names) / len(cached_names)
+
+    print(f"parsing {count} filenames")
+    for (label, seconds) in results.items():
+        speedup = results["generic"] / seconds
+        print(f"  {label:10} {seconds:8.3f}s  {count / seconds:12.0f} names/s  {speedup:6.1f}x")
+    return results
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,49 @@
+# Times rendering the status page for a large deployment: 100 sensors with a
+# year of daily up/down log counts each.
+#   python -m benchmarks.status_report [sensors] [days]
+import sys
+import time
+import random
+from datetime import date, timedelta
+import toad_functions
+
+def syntheticReport(sensors, days, target_date, seed=42):
+    rng = random.Random(seed)
+    all_sensors = {}
+    for sensor in range(sensors):
+        logs = {}
+        for day in range(days):
+            if rng.random() < 0.95:
+                logs[(target_date - timedelta(days=day)).isoformat()] = {"up": rng.choice([1, 1, 1, 2]), "down": 1}
+        all_sensors[f"sensor{sensor}"] = {"logs": logs, "last_activation": None}
+    return {"sensors": all_sensors, "report_date": target_date.isoformat(), "name": "benchmark"}
+
+def _time(call, repeat=5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(sensors=100, days=365):
+    target_date = date(2021, 1, 1)
+    full_report = syntheticReport(sensors, days, target_date)
+
+    started = time.perf_counter()
+    toad_functions.renderReport(full_report, target_date)
+    results = {"first_render": time.perf_counter() - started}
+    results["view_model"] = _time(lambda: toad_functions.reportViewModel(full_report, target_date))
+    results["render"] = _time(lambda: toad_functions.renderReport(full_report, target_date))
+    results["render_every_day"] = _time(lambda: toad_functions.renderReport(full_report, target_date, days))
+
+    print(f"status page for {sensors} sensors with {days} days of logs")
+    print(f"  first render (compile)   {results['first_render']:8.4f}s")
+    print(f"  view model               {results['view_model']:8.4f}s")
+    print(f"  render (5 days shown)    {results['render']:8.4f}s")
+    print(f"  render ({days} days shown)  {results['render_every_day']:8.4f}s")
+    return results
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
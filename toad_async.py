@@ -0,0 +1,12 @@
+# Runs the notifier's blocking steps from an asyncio driver, so independent
+# API calls can overlap. The Dropbox SDK and the SendGrid and SMTP clients
+# block, so each step runs on the event loop's executor and is awaited there.
+# Clients are shared between those threads just as they are by the concurrent
+# listings.
+import asyncio
+import functools
+
+# await a blocking call on the running loop's executor
+async def run(function, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
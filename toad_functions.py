@@ -1,23 +1,79 @@
 # Import libraries
 import os
+import sys
 import json
 import requests
 import datetime
 import dropbox
 import sendgrid
 import platform
+import smtplib
+import threading
+import mailbox
+import math
+import gc
+import hashlib
 import pytimeparse
+import toad_http
 from dateutil import parser
 from enum import Enum
-from sendgrid.helpers.mail import Email, Mail, Content
+from sendgrid.helpers.mail import Email, Mail, Content, Personalization
+import email.policy
+from email.mime.text import MIMEText
+from email.utils import parseaddr, formatdate, make_msgid
 from datetime import datetime
+from datetime import date
 from datetime import timezone
 from datetime import timedelta
 from pathlib import PurePosixPath
+from collections import namedtuple
+from functools import lru_cache
+from contextlib import contextmanager
+from itertools import compress, repeat
+from operator import add, sub, mod, not_
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import posixpath
 import re
 
 _LOG_FOLDER_REGEX = r'[/\S]+(sensor\d{1,2})'
 _DATE_REGEX = r'.*((\d{4}-\d{2}-\d{2}-\d{6})(Z|[+-]\d+)?)-(.*)\.([a-zA-Z0-9]+)'
+# Fast path for the layout our sensors use: prefix-YYYY-MM-DD-HHMMSS[offset]-name.ext
+# Anchored with no leading .* so it can't backtrack; anything else falls back to _DATE_REGEX
+_FILENAME_REGEX = re.compile(r'[^\d.]*?(\d{4})-(\d\d)-(\d\d)-(\d\d)(\d\d)(\d\d)(Z|[+-]\d\d(?:\d\d)?)?-([^.]*)\.[a-zA-Z0-9]+$')
+# _FILENAME_REGEX over a whole listing's names joined into lines, giving the
+# date, time, offset and sensor name of each line. A line in any other layout
+# matches the last branch, with every group empty.
+_LISTING_REGEX = re.compile(r'^[^\d.\n]*(\d{4}-\d\d-\d\d)-(\d{6})(Z|[+-]\d\d(?:\d\d)?)?-([^.\n]*)\.[a-zA-Z0-9]+$|^.*$', re.M)
+# Loose on purpose, it only catches lines that are clearly not an address
+_EMAIL_ADDRESS_REGEX = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+# How many parsed filenames to remember
+_PARSE_CACHE_SIZE = 1 << 18
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+_SECONDS_PER_DAY = 86400
+_SECONDS_PER_WEEK = 7 * _SECONDS_PER_DAY
+# 1970-01-01 was a Thursday, shifting epoch seconds by this starts weeks on Monday
+_EPOCH_WEEK_SHIFT = 3 * _SECONDS_PER_DAY
+_DAYS_OF_WEEK = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+REPORT_TEMPLATE = "sensors_status.template.html"
+# Dropbox hashes content in blocks of this size
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# Uploads bigger than this are sent in chunks of this size through an upload session
+UPLOAD_CHUNK_SIZE = 2 * DROPBOX_HASH_BLOCK_SIZE
+
+# A minimal stand in for a dropbox FileMetadata - we only ever use these fields
+FileEntry = namedtuple("FileEntry", ["name", "path_lower"])
+
+# A file's notification decision. Only the name and path_lower are kept from
+# its listing entry, so the Dropbox metadata isn't held for the whole run, and
+# it can stand in for the entry wherever one is expected. `timestamp` is unix
+# seconds, `utc_offset` the offset it was recorded at in seconds, and
+# `sensor_name` is interned so every notification from a sensor shares it.
+class Notification(namedtuple("Notification", ["name", "path_lower", "timestamp", "utc_offset", "sensor_name", "suppress"])):
+    __slots__ = ()
+
+    def recordedAt(self):
+        return datetime.fromtimestamp(self.timestamp, _timezoneFromSeconds(self.utc_offset))
 
 class SensorState(Enum):
     IDLE = 0
@@ -39,6 +95,22 @@ class SensorState(Enum):
 def parseFileInfo(filename, fallback):
     if fallback is None:
         raise TypeError("A fallback must be provided")
+    return _parseFileInfoCached(filename, fallback)
+
+# Filenames never change meaning, so each is only ever parsed once
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _parseFileInfoCached(filename, fallback):
+    match = _FILENAME_REGEX.match(filename)
+    if match == None:
+        return _parseFileInfoGeneric(filename, fallback)
+
+    (year, month, day, hour, minute, second, utc_offset, name) = match.groups()
+    tzinfo = _timezoneFromOffset(utc_offset) if utc_offset else _timezoneFromOffset(fallback)
+    date = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=tzinfo)
+    return (date, name)
+
+# The original parser, handles any layout dateutil understands
+def _parseFileInfoGeneric(filename, fallback):
     match = re.search(_DATE_REGEX, filename)
     if match == None:
         raise ValueError("Filename invalid, cannot parse date")
@@ -48,39 +120,342 @@ def parseFileInfo(filename, fallback):
         date = date.replace(tzinfo=offset)
     return (date, match[4])
 
+# The "YYYY-MM" a file was recorded in, as written in its name (so its local
+# month, whatever the fallback offset), or None for a name without a date
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def recordingMonth(filename):
+    match = _FILENAME_REGEX.match(filename)
+    if match is not None:
+        return f"{match[1]}-{match[2]}"
+    match = re.search(_DATE_REGEX, filename)
+    return None if match is None else match[2][:7]
+
+# accepts a timedelta, "Z", or an ISO 8601 "+HH"/"+HHMM" offset
+@lru_cache(maxsize=None)
+def _timezoneFromOffset(offset):
+    if isinstance(offset, timedelta):
+        return timezone(offset)
+    if offset == "Z":
+        return timezone.utc
+    sign = -1 if offset[0] == "-" else 1
+    hours = int(offset[1:3])
+    minutes = int(offset[3:5] or 0)
+    return timezone(sign * timedelta(hours=hours, minutes=minutes))
+
+# Like parseFileInfo, but returns plain numbers rather than a datetime:
+# (epoch seconds, utc offset seconds, sensor name). Memoized the same way, so
+# a file left pending isn't parsed again on each run.
+@lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def parseFileTimestamp(filename, fallback):
+    match = _FILENAME_REGEX.match(filename)
+    if match == None:
+        (date, name) = parseFileInfo(filename, fallback)
+        return (int(date.timestamp()), int(date.utcoffset().total_seconds()), name)
+
+    (year, month, day, hour, minute, second, utc_offset, name) = match.groups()
+    (hour, minute, second) = (int(hour), int(minute), int(second))
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError("Filename invalid, time out of range")
+    offset_seconds = _utcOffsetSeconds(utc_offset) if utc_offset else int(fallback.total_seconds())
+    local_seconds = _epochDay(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+    return (local_seconds - offset_seconds, offset_seconds, name)
+
+# days since 1970-01-01, raises ValueError for dates that don't exist
+@lru_cache(maxsize=1 << 16)
+def _epochDay(year, month, day):
+    return date(int(year), int(month), int(day)).toordinal() - _EPOCH_ORDINAL
+
+@lru_cache(maxsize=None)
+def _utcOffsetSeconds(offset):
+    return int(_timezoneFromOffset(offset).utcoffset(None).total_seconds())
+
+# "HHMMSS" -> seconds since midnight, for every valid time of day
+@lru_cache(maxsize=None)
+def _secondsOfDayTable():
+    return {f"{hour:02}{minute:02}{second:02}": hour * 3600 + minute * 60 + second
+        for hour in range(24) for minute in range(60) for second in range(60)}
+
+# "YYYY-MM-DD" -> epoch seconds of its midnight, None if it isn't a date
+def _epochDaySeconds(day):
+    try:
+        return _epochDay(day[0:4], day[5:7], day[8:10]) * _SECONDS_PER_DAY
+    except ValueError:
+        return None
+
+# Columns are built from millions of small tuples, none of them in a cycle,
+# which would otherwise set off collections over the whole heap as they're made
+@contextmanager
+def _collectorPaused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# Notified column codes for a ListingTable
+LISTING_NEW = -1
+LISTING_PENDING = 0
+
+# A listing of files that still need processing (never seen, or pending a
+# notification) held as columns rather than one object per file. New names are
+# parsed all at once: one regex pass over the joined names, then timestamps
+# built from per-day and per-time lookups. Names pending from an earlier run,
+# or in another layout, go through the memoized parseFileTimestamp.
+# The column work is mostly map() and compress(), which loop in C rather than
+# running Python code for each file.
+class ListingTable():
+    def __init__(self):
+        self.names = []
+        self.paths = []
+        self.sensor_names = []
+        # index into sensor_names
+        self.sensor_ids = array("I")
+        self.timestamps = array("q")
+        self.utc_offsets = array("i")
+        # LISTING_NEW or LISTING_PENDING
+        self.notified = array("b")
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def fromEntries(cls, dropbox_files, file_history, fallback_utc_offset):
+        with _collectorPaused():
+            return cls()._ingest(dropbox_files, file_history, fallback_utc_offset)
+
+    def _ingest(self, dropbox_files, file_history, fallback_utc_offset):
+        entries = list(dropbox_files)
+        names = [entry.name for entry in entries]
+
+        # Check for new records by comparing against what we already have
+        unseen = object()
+        history = list(map(file_history.get, names, repeat(unseen)))
+        keep = [notified is unseen or notified is False for notified in history]
+        names = list(compress(names, keep))
+        paths = [entry.path_lower for entry in compress(entries, keep)]
+        notified = [LISTING_NEW if notified is unseen else LISTING_PENDING for notified in compress(history, keep)]
+        if not names:
+            return self
+
+        # Extract semantic info from the names for easy processing. Pending
+        # names are blanked so they fall through to the memo below.
+        if LISTING_PENDING in notified:
+            lines = [name if code == LISTING_NEW else "" for (name, code) in zip(names, notified)]
+        else:
+            lines = names
+        fields = _LISTING_REGEX.findall("\n".join(lines))
+        if len(fields) != len(names):
+            # a name with a line break in it, leave them all to the memo
+            fields = [("", "", "", "")] * len(names)
+        (days, times, offsets, sensor_names) = zip(*fields)
+
+        epoch_days = {day: _epochDaySeconds(day) for day in set(days)}
+        day_seconds = list(map(epoch_days.__getitem__, days))
+        time_seconds = list(map(_secondsOfDayTable().get, times))
+        fallback_seconds = int(fallback_utc_offset.total_seconds())
+        offset_seconds = {offset: _utcOffsetSeconds(offset) if offset else fallback_seconds for offset in set(offsets)}
+        offsets = list(map(offset_seconds.__getitem__, offsets))
+
+        if None in day_seconds or None in time_seconds:
+            sensor_names = list(sensor_names)
+            malformed = set()
+            for row in [row for (row, (day, seconds)) in enumerate(zip(day_seconds, time_seconds)) if day is None or seconds is None]:
+                try:
+                    (timestamp, utc_offset, sensor_name) = parseFileTimestamp(names[row], fallback_utc_offset)
+                except Exception as e:
+                    print(f"Could not process file name {names[row]}: " + str(e))
+                    malformed.add(row) # Malformed filename, don't worry about it
+                    continue
+                (day_seconds[row], time_seconds[row], offsets[row], sensor_names[row]) = (timestamp + utc_offset, 0, utc_offset, sensor_name)
+            if malformed:
+                keep = [row not in malformed for row in range(len(names))]
+                (names, paths, notified, day_seconds, time_seconds, offsets, sensor_names) = (list(compress(column, keep))
+                    for column in (names, paths, notified, day_seconds, time_seconds, offsets, sensor_names))
+
+        sensor_ids = {sensor_name: sensor_id for (sensor_id, sensor_name) in enumerate(dict.fromkeys(sensor_names))}
+        self.names = names
+        self.paths = paths
+        self.sensor_names = [sys.intern(sensor_name) for sensor_name in sensor_ids]
+        self.sensor_ids = array("I", map(sensor_ids.__getitem__, sensor_names))
+        self.timestamps = array("q", map(sub, map(add, day_seconds, time_seconds), offsets))
+        self.utc_offsets = array("i", offsets)
+        self.notified = array("b", notified)
+        return self
+
+    # local time of every file, as seconds since the epoch
+    def localSeconds(self):
+        return list(map(add, self.timestamps, self.utc_offsets))
+
+    # local time of day of every file, in seconds
+    def secondsOfDay(self):
+        return list(map(mod, self.localSeconds(), repeat(_SECONDS_PER_DAY)))
+
+    def recordedAt(self, row):
+        return datetime.fromtimestamp(self.timestamps[row], _timezoneFromSeconds(self.utc_offsets[row]))
+
+    # A Notification for every file, `in_whitelist` holding a truth value for each
+    def notifications(self, in_whitelist):
+        columns = zip(self.names, self.paths, self.timestamps, self.utc_offsets,
+            map(self.sensor_names.__getitem__, self.sensor_ids), map(not_, in_whitelist))
+        with _collectorPaused():
+            return list(map(tuple.__new__, repeat(Notification), columns))
+
+@lru_cache(maxsize=None)
+def _timezoneFromSeconds(offset_seconds):
+    return _timezoneFromOffset(timedelta(seconds=offset_seconds))
+
+# Call an API function, retrying transient failures (rate limits, 5xx
+# responses, dropped connections) under toad_http's retry policy. Calls made
+# through a toad_http.ResilientDropbox already retry under their run's policy.
+def retryApiCall(call, *args, **kwargs):
+    if getattr(call, "retried", False):
+        return call(*args, **kwargs)
+    return toad_http.callWithRetry(call, *args, **kwargs)
+
+# A folder listing streamed page by page from files_list_folder/_continue,
+# starting from `first_page`. While one page is being consumed the next is
+# fetched in the background (unless prefetch is off), so processing overlaps
+# with the network and only about two pages are held at once.
+# Can be iterated once. Afterwards `cursor` is the cursor for later changes
+# and `count` the number of entries listed.
+class DropboxListing():
+    def __init__(self, dbx, first_page, prefetch=True):
+        self.dbx = dbx
+        self.first_page = first_page
+        self.prefetch = prefetch
+        self.cursor = None
+        self.count = 0
+
+    def __iter__(self):
+        page = self.first_page
+        self.first_page = None
+        executor = None
+        try:
+            while True:
+                upcoming = None
+                if page.has_more and self.prefetch:
+                    if executor is None:
+                        executor = ThreadPoolExecutor(max_workers=1)
+                    upcoming = executor.submit(retryApiCall, self.dbx.files_list_folder_continue, page.cursor)
+                self.count += len(page.entries)
+                yield from page.entries
+                if not page.has_more:
+                    break
+                page = upcoming.result() if upcoming else retryApiCall(self.dbx.files_list_folder_continue, page.cursor)
+            self.cursor = page.cursor
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+# Stream the files in a Dropbox folder, see DropboxListing
+def iterFilesFromDropbox(dbx, root_folder='', prefetch=True):
+    return DropboxListing(dbx, retryApiCall(dbx.files_list_folder, root_folder), prefetch)
+
 # iteratively pull list of files in Dropbox
 def getFilesFromDropbox(dbx, root_folder=''):
-    dropbox_files = []
-    finished_looping = False
-    fetched_files = dbx.files_list_folder(root_folder)
-    while (not finished_looping):
-        for entry in fetched_files.entries:
-            dropbox_files.append(entry)
-        if fetched_files.has_more:
-            fetched_files = dbx.files_list_folder_continue(fetched_files.cursor)
+    return list(iterFilesFromDropbox(dbx, root_folder, prefetch=False))
+
+# Stream only what changed in a folder since `cursor` was issued.
+# With no cursor, or a cursor Dropbox has reset, the whole folder is listed.
+# returns (DropboxListing, full_listing)
+def streamFileChangesFromDropbox(dbx, root_folder='', cursor=None):
+    if cursor is not None:
+        try:
+            return (DropboxListing(dbx, retryApiCall(dbx.files_list_folder_continue, cursor)), False)
+        except dropbox.exceptions.ApiError as apiError:
+            # cursors expire or are reset server side, the only recovery is a full list
+            if apiError.error.is_reset():
+                print("Listing cursor was reset by Dropbox, listing " + root_folder + " in full")
+            else:
+                raise
+    return (iterFilesFromDropbox(dbx, root_folder), True)
+
+# Pull only what changed in a folder since `cursor` was issued.
+# With no cursor, or a cursor Dropbox has reset, the whole folder is listed.
+# returns (entries, cursor, full_listing)
+def getFileChangesFromDropbox(dbx, root_folder='', cursor=None):
+    (listing, full_listing) = streamFileChangesFromDropbox(dbx, root_folder, cursor)
+    changed_files = list(listing)
+    return (changed_files, listing.cursor, full_listing)
+
+# Block until Dropbox reports changes in the folder `cursor` lists, or `timeout`
+# seconds (30 to 480) pass. Doesn't return the changes, use the cursor for that.
+# returns (changes, backoff) where backoff is seconds to wait before polling again
+def waitForDropboxChanges(dbx, cursor, timeout=480):
+    result = dbx.files_list_folder_longpoll(cursor, timeout)
+    return (result.changes, result.backoff)
+
+# Turn a delta listing into the entries that need processing this run.
+# Deleted files still waiting for a notification are forgotten, and files that
+# are still waiting (they won't be in the delta) are added back.
+def mergeFileChanges(changed_files, file_history, root_folder=''):
+    current = {}
+    for entry in changed_files:
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            current.pop(entry.name, None)
+            if entry.name in file_history and file_history[entry.name] is False:
+                del file_history[entry.name]
         else:
-            finished_looping = True
-    return dropbox_files
+            current[entry.name] = entry
 
-def getEmailsFromDropbox(email_config_file_path, dbx, debug=False, debug_content="", debug_files=""):
-    send_to_emails = []
-    if not debug:
-        # This is the file that contains the emails to send to
-        temp_file = "./emails_to_send_to.txt"
+    folder = root_folder.lower() or "/"
+    for filename in pendingFiles(file_history):
+        if filename not in current:
+            current[filename] = FileEntry(filename, posixpath.join(folder, filename.lower()))
 
-        # Download file from dropbox
-        dbx.files_download_to_file(temp_file, email_config_file_path)
-        
-        email_file_data = open(temp_file, "r").read()
-        # Pull the email data out
-        send_to_emails = [x.strip() for x in email_file_data.split('\n')]
-    else:
-        # Same as above but with debugging workflow
+    return list(current.values())
+
+# Names of files still waiting on a notification. State stores that index
+# this provide `pending()`, a plain dict has to be scanned.
+def pendingFiles(file_history):
+    if hasattr(file_history, "pending"):
+        return file_history.pending()
+    return [filename for (filename, notified) in file_history.items() if notified is False]
+
+# The addresses in a recipient list, one per line, optionally with a display
+# name ("Name <toad@example.com>"). Blank lines and anything that isn't an
+# address are left out, as are repeats of an address in any case.
+def parseRecipients(text):
+    recipients = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        (_name, address) = parseaddr(line)
+        if not _EMAIL_ADDRESS_REGEX.match(address):
+            print(f"Ignoring invalid recipient '{line}'")
+            continue
+        recipients.setdefault(address.lower(), line)
+    return list(recipients.values())
+
+# The recipient list in `email_config_file_path`. With a `recipient_cache`
+# (path -> {"content_hash": ..., "recipients": [...]}, kept between runs) the
+# list is only downloaded again when its content_hash changes, otherwise it
+# costs one metadata call.
+def getEmailsFromDropbox(email_config_file_path, dbx, debug=False, debug_content="", debug_files="", recipient_cache=None):
+    if debug:
+        # Same as below but with debugging workflow
         for entry in debug_files:
             if email_config_file_path in entry:
-                email_file_data = debug_content
-                send_to_emails = [x.strip() for x in email_file_data.split('\n')]
-                break
+                return parseRecipients(debug_content)
+        return []
+
+    cached = None if recipient_cache is None else recipient_cache.get(email_config_file_path)
+    if cached is not None:
+        metadata = retryApiCall(dbx.files_get_metadata, email_config_file_path)
+        if metadata.content_hash == cached["content_hash"]:
+            return cached["recipients"]
+
+    # Download the file that contains the emails to send to
+    (metadata, response) = retryApiCall(dbx.files_download, email_config_file_path)
+    try:
+        send_to_emails = parseRecipients(response.content.decode("utf-8-sig"))
+    finally:
+        response.close()
+    if recipient_cache is not None:
+        recipient_cache[email_config_file_path] = {"content_hash": metadata.content_hash, "recipients": send_to_emails}
     return send_to_emails
 
 def parse_whitelist_times(whitelist):
@@ -97,63 +472,129 @@ def parse_whitelist_times(whitelist):
         raise ValueError(f"whitelist value was not an list, was a {type(whitelist)} ({whitelist})")       
         
 
+# Whitelists can also be given per day of the week:
+#   {"sat": [["00:00", "24:00"]], "sun": [["00:00", "24:00"]], "default": [["20:00", "24:00"]]}
+# Days not listed use "default", which like a missing whitelist is the whole day.
+# returns a list of seven parse_whitelist_times results, Monday first
+def parse_whitelist_week(whitelist):
+    if isinstance(whitelist, dict):
+        unknown = set(whitelist) - set(_DAYS_OF_WEEK) - {"default"}
+        if unknown:
+            raise ValueError(f"whitelist days {sorted(unknown)} are not one of {_DAYS_OF_WEEK} or default")
+        default = parse_whitelist_times(whitelist.get("default"))
+        return [parse_whitelist_times(whitelist[day]) if day in whitelist else default for day in _DAYS_OF_WEEK]
+    return [parse_whitelist_times(whitelist)] * 7
+
+# One byte per second of the day, 1 where the time is inside a range
+@lru_cache(maxsize=None)
+def _dayBitmap(bounds):
+    day = bytearray(_SECONDS_PER_DAY)
+    for (time_min, time_max) in bounds:
+        start = max(0, math.ceil(time_min.total_seconds()))
+        end = min(_SECONDS_PER_DAY, math.ceil(time_max.total_seconds()))
+        if start < end:
+            day[start:end] = b"\x01" * (end - start)
+    return bytes(day)
+
+@lru_cache(maxsize=None)
+def _weekBitmap(week):
+    return b"".join(_dayBitmap(tuple(bounds)) for bounds in week)
+
+# A whitelist compiled once into a bitmap with a byte for every second of the
+# week, so checking a time is a single index whatever the ranges are.
+# `week` is what parse_whitelist_week returns and `by_sensor` maps sensor names
+# to their own week, for sensors that don't follow the default.
+class CompiledWhitelist():
+    def __init__(self, week, by_sensor=None):
+        self.week = _weekBitmap(tuple(tuple(bounds) for bounds in week))
+        self.by_sensor = {sensor_name: _weekBitmap(tuple(tuple(bounds) for bounds in sensor_week))
+            for (sensor_name, sensor_week) in (by_sensor or {}).items()}
+
+    # `local_seconds` is a local time as seconds since the epoch, i.e. a unix
+    # timestamp plus the UTC offset
+    def contains(self, local_seconds, sensor_name=None):
+        week = self.by_sensor.get(sensor_name, self.week)
+        return week[(local_seconds + _EPOCH_WEEK_SHIFT) % _SECONDS_PER_WEEK] == 1
+
+    # Batch form of contains, 1 for each time inside the whitelist and 0 for
+    # each outside. `sensor_ids` index `sensor_names` for each time, they are
+    # only needed when sensors have their own whitelists.
+    def containsAll(self, local_seconds, sensor_ids=None, sensor_names=None):
+        seconds_of_week = map(mod, map(add, local_seconds, repeat(_EPOCH_WEEK_SHIFT)), repeat(_SECONDS_PER_WEEK))
+        if not self.by_sensor or sensor_ids is None:
+            return list(map(self.week.__getitem__, seconds_of_week))
+        weeks = [self.by_sensor.get(sensor_name, self.week) for sensor_name in sensor_names]
+        return list(map(bytes.__getitem__, map(weeks.__getitem__, sensor_ids), seconds_of_week))
+
+# Compile the whitelist_times_of_day and whitelist_times_by_sensor configs
+def compile_whitelist(whitelist, whitelist_by_sensor=None):
+    by_sensor = {sensor_name: parse_whitelist_week(sensor_whitelist)
+        for (sensor_name, sensor_whitelist) in (whitelist_by_sensor or {}).items()}
+    return CompiledWhitelist(parse_whitelist_week(whitelist), by_sensor)
+
 def time_ranges_contain_time_from_date(bounds_list, date_time):
-    time_delta = date_time - date_time.replace(hour=0, minute=0, second=0, microsecond=0)
-    for (time_min, time_max) in bounds_list:
-        if time_min <= time_delta and time_delta < time_max:
-            return True
-    return False
+    seconds_of_day = date_time.hour * 3600 + date_time.minute * 60 + date_time.second
+    return _dayBitmap(tuple(bounds_list))[seconds_of_day] == 1
+
+# Batch form of time_ranges_contain_time_from_date for whole local seconds since midnight
+def time_ranges_contain_seconds_of_day(bounds_list, seconds_of_day):
+    day = _dayBitmap(tuple(bounds_list))
+    return [day[seconds] == 1 for seconds in seconds_of_day]
+
+# sensor_history holds each sensor's last activation as unix seconds, state
+# stores keep it as an ISO date
+def activationFromIso(activated_at):
+    previous_fire = parser.isoparse(activated_at)
+    assert previous_fire.tzinfo != None, "Corrupt sensors.json, a date is missing it's UTC offset"
+    return previous_fire.timestamp()
+
+def activationToIso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
 
 def getNotificationsAndActivatingSensors(dropbox_files, file_history,
     sensor_history, pause_duration, fallback_utc_offset, datetime_now, whitelist_times):
-    # Array of tuples to store results of the upcoming search
-    notifications_to_send = []
     sensors_status = {}
 
     # first let us build up the current state of the sensors
+    now = datetime_now.timestamp()
     for sensor_name in sensor_history:
-        previous_fire = parser.isoparse(sensor_history[sensor_name])
-        assert previous_fire.tzinfo != None, "Corrupt sensors.json, a date is missing it's UTC offset"
         # how long between the last sensor fire and now
-        elapsed_time = datetime_now - previous_fire
-        (quotient, _remainder) = divmod(elapsed_time.total_seconds(), pause_duration)
+        elapsed_time = now - sensor_history[sensor_name]
+        (quotient, _remainder) = divmod(elapsed_time, pause_duration)
         # keep sensors still within timeout window paused, otherwise set state to idle
         sensors_status[sensor_name] = SensorState.IDLE if quotient >= 1 else SensorState.PAUSED
 
-    # Check for new records by comparing against what we already have
-    for entry in dropbox_files:
-        filename = entry.name
-        if filename not in file_history or file_history[filename] == False:
-            try:
-                # Extract semantic info from name for easy processing
-                (recorded_at, sensor_name) = parseFileInfo(filename, fallback_utc_offset)
-            except Exception as e:
-                print(f"Could not process file name {filename}: " + str(e))
-                continue # Malformed filename, don't worry about it
-
-            # white listing feature - only show a notification if time in whitelist
-            suppress = not time_ranges_contain_time_from_date(whitelist_times, recorded_at)
-
-            # Append notification regardless of whether or not any sensor will trigger an email
-            notifications_to_send.append((entry, recorded_at, sensor_name, suppress))
-
-            # if this activity occurred outside of the whitelist times, never show
-            # a notification - and never activate the sensor
-            if not suppress:
-                # Have we seen this sensor before?
-                if sensor_name in sensor_history:
-                    # This used to be: how long between recorded date and previous 
-                    # sensor fire:
-                    #elapsed_time = recorded_at - previous_fire
-                    # But what we really want to know is how long since the last
-                    # sensor fire and now? Which is taken care of above.
-                    # Once we know that it is simply a case of reporting any
-                    # files that have not been repported yet.
-                    sensors_status[sensor_name] = sensors_status[sensor_name].activate()              
-                else:
-                    # Brand new sensor, add it to the list
-                    sensors_status[sensor_name] = SensorState.ACTIVATED
- 
+    # Gather the new records (see ListingTable) as columns, then process them all at once
+    table = ListingTable.fromEntries(dropbox_files, file_history, fallback_utc_offset)
+
+    # white listing feature - only show a notification if time in whitelist.
+    # whitelist_times is a CompiledWhitelist, or parse_whitelist_times ranges
+    # that apply to every sensor on every day
+    if not isinstance(whitelist_times, CompiledWhitelist):
+        whitelist_times = CompiledWhitelist([whitelist_times] * 7)
+    in_whitelist = whitelist_times.containsAll(table.localSeconds(), table.sensor_ids, table.sensor_names)
+
+    # Append notification regardless of whether or not any sensor will trigger an email
+    notifications_to_send = table.notifications(in_whitelist)
+
+    # if this activity occurred outside of the whitelist times, never show
+    # a notification - and never activate the sensor
+    for sensor_id in dict.fromkeys(compress(table.sensor_ids, in_whitelist)):
+        sensor_name = table.sensor_names[sensor_id]
+        # Have we seen this sensor before?
+        if sensor_name in sensor_history:
+            # This used to be: how long between recorded date and previous 
+            # sensor fire:
+            #elapsed_time = recorded_at - previous_fire
+            # But what we really want to know is how long since the last
+            # sensor fire and now? Which is taken care of above.
+            # Once we know that it is simply a case of reporting any
+            # files that have not been repported yet.
+            sensors_status[sensor_name] = sensors_status[sensor_name].activate()
+        else:
+            # Brand new sensor, add it to the list
+            sensors_status[sensor_name] = SensorState.ACTIVATED
+
     return (notifications_to_send, sensors_status)
 
 def updateState(notifications_to_send, sensors_status, file_history, sensor_history, datetime_now):
@@ -163,7 +604,7 @@ def updateState(notifications_to_send, sensors_status, file_history, sensor_hist
         # For ACTIVATED store date to start a pause.
         # For ACTIVATED_PAUSED we don't reset the pause timer so do nothing also.
         if state == SensorState.ACTIVATED:
-            sensor_history[sensor_name] = datetime_now.isoformat()
+            sensor_history[sensor_name] = datetime_now.timestamp()
 
     # Record whether each notification should be dispatched 
     # If *any* sensor has ACTIVATED (not on a timeout ACTIVATED_PAUSED):
@@ -176,15 +617,15 @@ def updateState(notifications_to_send, sensors_status, file_history, sensor_hist
     any_activation = any(v == SensorState.ACTIVATED for (k,v) in sensors_status.items())
     
     all_idle = all((v == SensorState.IDLE for (k,v) in sensors_status.items()))
-    assert (not all_idle or sum(not suppressed for (_,_,_, suppressed) in notifications_to_send) == 0), "All sensors are IDLE but there are pending notifications!"
+    assert (not all_idle or sum(not notification.suppress for notification in notifications_to_send) == 0), "All sensors are IDLE but there are pending notifications!"
     
     send_notifications = any_activation #or all_idle
-    for (entry, _, _, suppress) in notifications_to_send:
+    for notification in notifications_to_send:
         # here we record if we will send a notification
         # If suppress then we store None to indicate no notification is sent
         # Otherwise record if all notifications were sent or not - ones stored as false will be picked up on next
         # sensor activation
-        file_history[entry.name] = None if suppress else send_notifications 
+        file_history[notification.name] = None if notification.suppress else send_notifications 
 
     # Return the updated state
     return (file_history, sensor_history, send_notifications)
@@ -193,7 +634,7 @@ def getSharedLink(dbx, db_path):
     sharedLink = None
     try:
         # attempt to get a shared link - we can only do this once per path
-        sharedLink = dbx.sharing_create_shared_link_with_settings(db_path)
+        sharedLink = retryApiCall(dbx.sharing_create_shared_link_with_settings, db_path)
     except dropbox.exceptions.ApiError as apiError:
         # if the error was a duplicate shared link
         if apiError.error.is_shared_link_already_exists():
@@ -201,96 +642,263 @@ def getSharedLink(dbx, db_path):
             # we can only get all shared links for a path!
             # we assume the first one is valid, and that this app created it,
             #   and thus it has public accessibility!
-            allLinks = dbx.sharing_get_shared_links(db_path).links
+            allLinks = retryApiCall(dbx.sharing_get_shared_links, db_path).links
             sharedLink = allLinks[0]
             print("successfully retrieved existing shared link for " + db_path)
         else:
             raise
     return sharedLink.url
 
-def formatNotifications(notifications_to_send, sensors_status, href_function):
-    # Group notifications by sensor and send a bundled email now.
-    email_body = "<h1>Toad Update in Dropbox</h1>"
-    for (sensor_name, state) in sensors_status.items():
-        # send notification for either ACTIVATED or PAUSED_ACTIVATED
-        if not state.is_activated():
-            continue
+# Make sure `link_cache` (path_lower -> url) has a shared link for every path.
+# Only paths we've never linked before cost an API call, and those calls are
+# made concurrently.
+def resolveSharedLinks(dbx, paths, link_cache, max_workers=4):
+    missing = [path for path in dict.fromkeys(paths) if path not in link_cache]
+    if missing:
+        print(f"Creating shared links for {len(missing)} files")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (path, url) in zip(missing, executor.map(lambda path: getSharedLink(dbx, path), missing)):
+                link_cache[path] = url
+    return link_cache
+
+# The notifications being sent, grouped by sensor in sensors_status order,
+# for each sensor notifying now (ACTIVATED or IDLE).
+# returns {sensor name: [notification, ...]}
+def groupNotifications(notifications_to_send, sensors_status):
+    groups = {sensor_name: [] for (sensor_name, state) in sensors_status.items() if state.is_activated()}
+    for notification in notifications_to_send:
+        # suppressed notifications should not happen here
+        group = None if notification.suppress else groups.get(notification.sensor_name)
+        if group is not None:
+            group.append(notification)
+    return groups
+
+# The dropbox paths formatNotifications will link to
+def notificationPaths(notifications_to_send, sensors_status, max_files_per_sensor=None):
+    return [entry.path_lower for entries in groupNotifications(notifications_to_send, sensors_status).values()
+        for entry in entries[:max_files_per_sensor]]
 
-        # Process for this sensor
-        sensor_header = f"<h2>Suspicious recordings from { sensor_name }</h2>"
-        header_added = False
-        for notification in notifications_to_send:
-            (entry, _recorded_at, notification_sensor, suppress) = notification
-            
-            if suppress:
-                # this case should not happen
-                continue
-
-            if sensor_name != notification_sensor:
-                continue
-
-            if not header_added:
-                email_body += sensor_header
-                header_added = True
-            
+# Group notifications by sensor into the body of a bundled email. With
+# max_files_per_sensor, a sensor's email section lists that many files and
+# counts the rest.
+def formatNotifications(notifications_to_send, sensors_status, href_function, max_files_per_sensor=None):
+    fragments = ["<h1>Toad Update in Dropbox</h1>"]
+    for (sensor_name, entries) in groupNotifications(notifications_to_send, sensors_status).items():
+        if not entries:
+            continue
+        fragments.append(f"<h2>Suspicious recordings from { sensor_name }</h2>")
+        listed = entries[:max_files_per_sensor]
+        for entry in listed:
             # get the drop box file name, get the path_lower to use for href
-            filename = entry.name
-            db_path = entry.path_lower
-            db_href = href_function(db_path) 
-            
-            # Add the file to the email
-            email_body = email_body + f"<p><a href=\"{db_href}\">{filename}</a></p>"
-    return email_body
+            db_href = href_function(entry.path_lower)
+            # Add the file to the email, unlinked if it has no shared link
+            if db_href is None:
+                fragments.append(f"<p>{entry.name}</p>")
+            else:
+                fragments.append(f"<p><a href=\"{db_href}\">{entry.name}</a></p>")
+        if len(entries) > len(listed):
+            fragments.append(f"<p>and {len(entries) - len(listed)} more recordings from { sensor_name }</p>")
+    return "".join(fragments)
+
+# Ways of delivering a notification email. Each transport's send returns a
+# dict of recipient -> True if their email was accepted.
+class EmailTransport():
+    def send(self, send_from, subject, html, recipients):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+# Sends through the SendGrid API. Every recipient gets their own
+# personalization (so no one sees the others) in as few requests as possible.
+# Requests SendGrid throttles or fails with a 5xx are retried under `retry_policy`.
+class SendGridTransport(EmailTransport):
+    # SendGrid accepts at most this many personalizations (recipients) per request
+    MAX_RECIPIENTS = 1000
+
+    def __init__(self, sg, retry_policy=toad_http.DEFAULT_RETRY_POLICY):
+        self.sg = sg
+        self.retry_policy = retry_policy
+
+    def send(self, send_from, subject, html, recipients):
+        content = Content("text/html", html)
+        outcomes = {}
+        for start in range(0, len(recipients), self.MAX_RECIPIENTS):
+            batch = recipients[start:start + self.MAX_RECIPIENTS]
+            # Prepare the email
+            mail = Mail(Email(send_from), subject, None, content)
+            for recipient in batch:
+                personalization = Personalization()
+                personalization.add_to(Email(recipient))
+                mail.add_personalization(personalization)
+
+            # Send the email
+            try:
+                response = toad_http.callWithRetry(self.sg.client.mail.send.post, request_body=mail.get(), policy=self.retry_policy)
+                # Check the response and return true if success (any HTTP code starting with 2)
+                completed_well = str(response.status_code).startswith('2')
+            except Exception as e:
+                # the SendGrid client raises for 4xx and 5xx responses
+                print(f"email request failed: {e}")
+                completed_well = False
+            print(f"email sent to {len(batch)} recipients was { '' if completed_well else ' NOT '} successful")
+            for recipient in batch:
+                outcomes[recipient] = completed_well
+        return outcomes
+
+# The message is the same for everyone, so it's only encoded once and each
+# recipient's To header is prepended
+# The notification as a MIME message, its body encoded once for every recipient
+def _encodeEmail(send_from, subject, html):
+    message = MIMEText(html, "html", "utf-8")
+    message["From"] = send_from
+    message["Subject"] = subject
+    message["Date"] = formatdate(localtime=True)
+    return message
+
+# The message as sent to one recipient, with its own Message-ID and the CRLF
+# line endings SMTP requires (servers may refuse bare LFs)
+def _addressEmail(message, recipient):
+    del message["To"]
+    del message["Message-ID"]
+    message["To"] = recipient
+    message["Message-ID"] = make_msgid(domain=parseaddr(message["From"])[1].rpartition("@")[2] or "localhost")
+    return message.as_bytes(policy=email.policy.SMTP)
+
+# Sends through an SMTP server, reusing one connection for every recipient and
+# every send until closed. Safe to share between threads, sends take turns.
+class SmtpTransport(EmailTransport):
+    def __init__(self, host="localhost", port=25, username=None, password=None, starttls=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _sendOne(self, send_from, recipient, message_bytes):
+        if self.connection is None:
+            self.connection = self._connect()
+        try:
+            self.connection.sendmail(send_from, [recipient], message_bytes)
+        except smtplib.SMTPServerDisconnected:
+            # the pooled connection went stale, one fresh attempt
+            self.connection = self._connect()
+            self.connection.sendmail(send_from, [recipient], message_bytes)
+
+    def send(self, send_from, subject, html, recipients):
+        message = _encodeEmail(send_from, subject, html)
+        outcomes = {}
+        with self.lock:
+            for recipient in recipients:
+                try:
+                    self._sendOne(send_from, recipient, _addressEmail(message, recipient))
+                    outcomes[recipient] = True
+                except (smtplib.SMTPException, OSError) as e:
+                    print(f"email sent to '{recipient}' was NOT successful: {e}")
+                    outcomes[recipient] = False
+        print(f"email sent to {sum(outcomes.values())} of {len(recipients)} recipients")
+        return outcomes
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection.quit()
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self.connection = None
+
+# Delivers into a local maildir instead of sending anything, for testing
+class MaildirTransport(EmailTransport):
+    def __init__(self, folder):
+        # mailbox only creates the maildir layout for a folder that doesn't exist yet
+        for subfolder in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+        self.folder = folder
+        self.maildir = mailbox.Maildir(folder, create=False)
+
+    def send(self, send_from, subject, html, recipients):
+        message = _encodeEmail(send_from, subject, html)
+        for recipient in recipients:
+            self.maildir.add(_addressEmail(message, recipient))
+        print(f"email for {len(recipients)} recipients written to {self.folder}")
+        return {recipient: True for recipient in recipients}
+
+# Build the transport described by the optional `email_transport` config, e.g.
+#   {"type": "smtp", "host": "localhost", "port": 25}
+# Without one, emails are sent through SendGrid.
+def makeEmailTransport(system_configuration):
+    transport_configuration = dict(system_configuration.get("email_transport") or {"type": "sendgrid"})
+    transport_type = transport_configuration.pop("type", "sendgrid")
+    if transport_type == "sendgrid":
+        return SendGridTransport(sendgrid.SendGridAPIClient(apikey=system_configuration['sendgrid_api_key']),
+            toad_http.RetryPolicy(system_configuration.get("api_retries", 5)))
+    elif transport_type == "smtp":
+        return SmtpTransport(**transport_configuration)
+    elif transport_type == "maildir":
+        return MaildirTransport(**transport_configuration)
+    else:
+        raise ValueError(f"Unknown email_transport type '{transport_type}', expected sendgrid, smtp or maildir")
 
 # Function to send notifications
-# body is the content of the email, send_to_emails is the array of emails to send to, send_from is the address to send from, sg is a SendGrid object
-# returns true if everything worked.
-def sendEmail(body, instance_name, send_to_emails, send_from, sg):
+# body is the content of the email, send_to_emails is the array of emails to send to, send_from is the address to send from,
+# transport is an EmailTransport (a SendGrid object is also accepted)
+# returns a dict of recipient -> True if their email was accepted, so failures can be retried
+def sendEmail(body, instance_name, send_to_emails, send_from, transport):
     # We assume this function is only called if notifications should be sent.
-    completed_well = False
+    if not isinstance(transport, EmailTransport):
+        transport = SendGridTransport(transport)
     host = platform.node() or "(unknown)"
-    
+    subject = 'Suspicious Recordings from Sensors'
+    # Email Copy
+    email_html_copy = f"""
+    <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+    <html xmlns="http://www.w3.org/1999/xhtml">
+     <head>
+      <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+      <title> { subject } </title>
+      <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
+     </head>
+     <body>
+        { body }
+        <br/>
+        <br/>
+        <br/>
+        <p>
+            <small style="font-size: 7pt;color:#ccc;">
+                Sent from { instance_name } ({ host })
+            </small>
+        </p>
+    </body>
+    </html>
+    """
+
     # Send emails
-    for recipient in send_to_emails:
-        # Prepare the email
-        from_email = Email(send_from)
-        to_email = Email(recipient)
-        subject = 'Suspicious Recordings from Sensors'
-        # Email Copy
-        email_html_copy = f"""
-        <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
-        <html xmlns="http://www.w3.org/1999/xhtml">
-         <head>
-          <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
-          <title> { subject } </title>
-          <meta name="viewport" content="width=device-width, initial-scale=1.0"/>
-         </head>
-         <body>
-            { body }
-            <br/>
-            <br/>
-            <br/>
-            <p>
-                <small style="font-size: 7pt;color:#ccc;">
-                    Sent from { instance_name } ({ host })
-                </small>
-            </p>
-        </body>
-        </html>
-        """
-        content = Content("text/html", email_html_copy)
-        mail = Mail(from_email, subject, to_email, content)
-        # Send the email
-        response = sg.client.mail.send.post(request_body=mail.get())
-        # Check the response and return true if success (any HTTP code starting with 2)
-        completed_well = str(response.status_code).startswith('2')
-        print(f"email sent to '{recipient}' was { '' if completed_well else ' NOT '} successful")
+    recipients = list(dict.fromkeys(send_to_emails))
+    outcomes = transport.send(send_from, subject, email_html_copy, recipients)
 
     # Indicate whether everything worked as expected
-    print("Notification sent to subscribers was " + ("successful" if completed_well else "not successful") )
-    return completed_well
+    all_completed_well = all(outcomes.values())
+    print("Notification sent to subscribers was " + ("successful" if all_completed_well else "not successful") )
+    return outcomes
 
 def closeToTimeOfDay(target, times, threshold_seconds = 300):
+    return scheduledTimeOfDay(target, times, threshold_seconds) is not None
+
+# The time today, from `times`, that `target` is within `threshold_seconds` of
+# (to the minute), or None if there isn't one
+def scheduledTimeOfDay(target, times, threshold_seconds = 300):
     threshold = timedelta(seconds=threshold_seconds)
 
     for time in times:
@@ -298,9 +906,9 @@ def closeToTimeOfDay(target, times, threshold_seconds = 300):
         check_time = parser.parse(time, default=target)
         within_threshold = abs(target - check_time) < threshold
         if within_threshold:
-            return True
-    
-    return False
+            return check_time.replace(second=0, microsecond=0)
+
+    return None
 
 def filterSensorDirs(dropbox_files, exclude_paths):
     for entry in dropbox_files:
@@ -338,19 +946,157 @@ def filterGroupLogFiles(dropbox_files, report_date, limit, fallback_utc_offset):
 
     return results
 
+# Apply changes from a sensor's log folder listing to its index, `log_days`
+# (day -> {filename: status}). Logs are keyed by name, so a log listed again
+# is only counted once and a deleted one is removed.
+def applyLogChanges(log_days, log_files, fallback_utc_offset):
+    for entry in log_files:
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            for logs in log_days.values():
+                logs.pop(entry.name, None)
+            continue
+        try:
+            # Extract semantic info from name for easy processing
+            (log_date, status) = parseFileInfo(entry.name, fallback_utc_offset)
+        except Exception as e:
+            print(f"Could not process file name {entry.name}: " + str(e))
+            continue # Malformed filename, don't worry about it
+        log_days.setdefault(log_date.date().isoformat(), {})[entry.name] = status
+    return log_days
+
+# Bring `log_index` (log folder -> day -> {filename: status}) up to date.
+# Each folder is listed from its cursor in `cursors`, so only logs added since
+# the last update are fetched, and folders new to the index are listed in full.
+# Folders are listed concurrently, folders that have gone are dropped and days
+# more than `retention` before `report_date` are evicted.
+def updateLogIndex(dbx, log_folders, log_index, cursors, report_date, retention, fallback_utc_offset, max_workers=4):
+    def update(folder):
+        cursor = cursors.get(folder) if folder in log_index else None
+        (listing, full_listing) = streamFileChangesFromDropbox(dbx, folder, cursor)
+        log_days = {} if full_listing else log_index[folder]
+        applyLogChanges(log_days, listing, fallback_utc_offset)
+        return (log_days, listing.cursor)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        updates = list(executor.map(update, log_folders))
+
+    for folder in set(log_index) - set(log_folders):
+        del log_index[folder]
+        cursors.pop(folder, None)
+    oldest_day = (report_date - retention).date().isoformat()
+    for (folder, (log_days, cursor)) in zip(log_folders, updates):
+        log_index[folder] = {day: logs for (day, logs) in log_days.items() if day >= oldest_day}
+        cursors[folder] = cursor
+    return log_index
+
+# Daily counts of each status in a sensor's log index, e.g. {"2018-08-28": {"up": 1, "down": 1}}
+def countLogs(log_days):
+    counts = {}
+    for (day, logs) in sorted(log_days.items()):
+        day_counts = counts[day] = {}
+        for status in logs.values():
+            day_counts[status] = day_counts.get(status, 0) + 1
+    return counts
+
+# One jinja2 Environment for the process. Templates loaded by name are parsed
+# once, and their compiled bytecode is cached on disk so a fresh process (e.g.
+# from cron) doesn't parse them either.
+@lru_cache(maxsize=None)
+def _templateEnvironment():
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    return Environment(
+        loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False)
+
+@lru_cache(maxsize=8)
+def _compileTemplate(template):
+    return _templateEnvironment().from_string(template)
+
+def _healthCheck(day_counts):
+    if not day_counts:
+        return {"verdict": "missing"}
+    up = day_counts.get("up", 0)
+    down = day_counts.get("down", 0)
+    # one up and one down log a day (when there isn't a fault with the sensor!)
+    return {"verdict": "healthy" if up == down else "unbalanced", "up": up, "down": down}
+
+# Everything the status page shows, worked out ahead of rendering: a row per
+# sensor with a health check for each of the last `report_days` days. The
+# template only lays it out, so rendering doesn't depend on how many logs there are.
+def reportViewModel(full_report, target_date, report_days=5):
+    # generate a date range
+    dates = [(target_date - timedelta(days=i)).isoformat() for i in range(report_days)]
+    sensors = [
+        {
+            "name": sensor_name,
+            "last_activation": sensor["last_activation"],
+            "checks": [_healthCheck(sensor["logs"].get(day)) for day in dates],
+        }
+        for (sensor_name, sensor) in full_report["sensors"].items()]
+    return {"name": full_report["name"], "report_date": full_report["report_date"], "dates": dates, "sensors": sensors}
+
 def templateReport(template, full_report, target_date, report_days = 5):
-    # generate a date range 
-    dates = list(map(lambda i: (target_date - timedelta(days=i)).isoformat(), range(0, 5)))
-    additional_context = {"dates": dates}
-    from jinja2 import Template
-    compiled_template = Template(template)
-    return compiled_template.render({**full_report, **additional_context})
-
-def uploadFileToDropbox(dbx, content, path):
+    return _compileTemplate(template).render(reportViewModel(full_report, target_date, report_days))
+
+# Render the status page from sensors_status.template.html
+def renderReport(full_report, target_date, report_days=5):
+    template = _templateEnvironment().get_template(REPORT_TEMPLATE)
+    return template.render(reportViewModel(full_report, target_date, report_days))
+
+# Dropbox's content_hash: the SHA-256 of the SHA-256s of each 4MB block
+def dropboxContentHash(content_bytes):
+    block_hashes = b"".join(
+        hashlib.sha256(content_bytes[start:start + DROPBOX_HASH_BLOCK_SIZE]).digest()
+        for start in range(0, len(content_bytes), DROPBOX_HASH_BLOCK_SIZE))
+    return hashlib.sha256(block_hashes).hexdigest()
+
+# content_hash of the file at `path`, or None if there's no file there
+def _remoteContentHash(dbx, path):
+    try:
+        metadata = retryApiCall(dbx.files_get_metadata, path)
+    except dropbox.exceptions.ApiError as apiError:
+        if apiError.error.is_path() and apiError.error.get_path().is_not_found():
+            return None
+        raise
+    return getattr(metadata, "content_hash", None)
+
+# Upload in UPLOAD_CHUNK_SIZE pieces, for files too big for one request
+def _uploadInSession(dbx, content_bytes, path):
+    chunks = [content_bytes[start:start + UPLOAD_CHUNK_SIZE] for start in range(0, len(content_bytes), UPLOAD_CHUNK_SIZE)]
+    session = retryApiCall(dbx.files_upload_session_start, chunks[0])
+    cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=len(chunks[0]))
+    for chunk in chunks[1:-1]:
+        retryApiCall(dbx.files_upload_session_append_v2, chunk, cursor)
+        cursor.offset += len(chunk)
+    last_chunk = chunks[-1] if len(chunks) > 1 else b""
+    commit = dropbox.files.CommitInfo(path=path, mode=dropbox.files.WriteMode.overwrite, mute=True)
+    retryApiCall(dbx.files_upload_session_finish, last_chunk, cursor, commit)
+
+# Upload `content` to `path`, overwriting what's there.
+# With `upload_hashes` (path -> content_hash of our last upload) an upload is
+# skipped when the content hasn't changed. A path we haven't uploaded before
+# is checked against the content_hash Dropbox has for it.
+# `local_copy` also writes the content to the working directory, for debugging.
+# returns True if the content was uploaded
+def uploadFileToDropbox(dbx, content, path, upload_hashes=None, local_copy=False):
     content_bytes = content.encode('utf-8')
-    dbx.files_upload(content_bytes, path, dropbox.files.WriteMode.overwrite, mute=True)
-    # for debugging:
-    import posixpath
-    name = posixpath.basename(path)
-    with open(name, 'w', encoding = 'utf-8') as f:
-        f.write(content)
\ No newline at end of file
+    if local_copy:
+        with open(posixpath.basename(path), 'w', encoding = 'utf-8') as f:
+            f.write(content)
+
+    if upload_hashes is not None:
+        content_hash = dropboxContentHash(content_bytes)
+        previous_hash = upload_hashes[path] if path in upload_hashes else _remoteContentHash(dbx, path)
+        if previous_hash == content_hash:
+            print(f"{path} is unchanged, skipping upload")
+            upload_hashes[path] = content_hash
+            return False
+
+    if len(content_bytes) > UPLOAD_CHUNK_SIZE:
+        _uploadInSession(dbx, content_bytes, path)
+    else:
+        retryApiCall(dbx.files_upload, content_bytes, path, dropbox.files.WriteMode.overwrite, mute=True)
+    if upload_hashes is not None:
+        upload_hashes[path] = content_hash
+    return True
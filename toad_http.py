@@ -0,0 +1,146 @@
+# Resilience for the HTTP APIs we call (Dropbox and SendGrid): transient
+# failures are retried with jittered exponential backoff that honours how long
+# the server asks us to wait, and a run can be given a budget of API calls so a
+# throttled or misbehaving account slows a run down instead of stalling it.
+import time
+import random
+import threading
+import requests
+import dropbox
+from contextlib import contextmanager
+
+# Raised instead of making a call once a run's ApiBudget is spent
+class ApiBudgetExhausted(Exception):
+    pass
+
+# How a transient failure is retried: up to `retries` more attempts, waiting
+# base_delay, 2 * base_delay, 4 * base_delay... (at most max_delay) between
+# them, or as long as the server asked. Every wait gets up to 25% jitter so
+# concurrent callers don't retry in lock step.
+class RetryPolicy():
+    def __init__(self, retries=5, base_delay=1, max_delay=60):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * random.uniform(1, 1.25)
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# The most API calls one run may make, shared by every thread of the run
+class ApiBudget():
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.limit is not None and self.used >= self.limit:
+                raise ApiBudgetExhausted(f"API call budget of {self.limit} calls spent")
+            self.used += 1
+
+    def remaining(self):
+        return None if self.limit is None else max(0, self.limit - self.used)
+
+def _retryAfterHeader(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+# Whether `error` is worth retrying.
+# returns (transient, throttled, seconds the server asked us to wait or None)
+def classifyError(error):
+    if isinstance(error, dropbox.exceptions.RateLimitError):
+        # the SDK reads Retry-After into backoff
+        return (True, True, error.backoff)
+    if isinstance(error, dropbox.exceptions.InternalServerError):
+        return (True, False, None)
+    if isinstance(error, dropbox.exceptions.HttpError):
+        return (error.status_code >= 500, False, None)
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return (True, False, None)
+    # the SendGrid client raises python_http_client errors carrying the response
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int) and (status_code == 429 or status_code >= 500):
+        return (True, status_code == 429, _retryAfterHeader(getattr(error, "headers", None)))
+    return (False, False, None)
+
+# Retries made on this thread with no on_retry of their own are reported to
+# the listener set by reportingRetries
+_listener = threading.local()
+
+@contextmanager
+def reportingRetries(on_retry):
+    previous = getattr(_listener, "on_retry", None)
+    _listener.on_retry = on_retry
+    try:
+        yield
+    finally:
+        _listener.on_retry = previous
+
+# Make `call`, retrying transient failures under `policy`.
+# on_retry(error, throttled, delay) is called before each retry.
+def callWithRetry(call, *args, policy=DEFAULT_RETRY_POLICY, on_retry=None, **kwargs):
+    on_retry = on_retry or getattr(_listener, "on_retry", None)
+    for attempt in range(policy.retries + 1):
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            (transient, throttled, retry_after) = classifyError(e)
+            if not transient or attempt == policy.retries:
+                raise
+            delay = policy.delay(attempt, retry_after)
+            if on_retry is not None:
+                on_retry(e, throttled, delay)
+            print(f"{'Rate limited' if throttled else 'Request failed'} ({type(e).__name__}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+# Dropbox client methods that make an API call
+DROPBOX_CALL_PREFIXES = ("files_", "sharing_", "users_")
+
+# Wraps a Dropbox client so every API call made through it is retried under
+# `policy` and paid for from `budget` (one unit per attempt). Retries and
+# throttled attempts are counted into `metrics` (anything with count) if given.
+# The calls are marked `retried` so retryApiCall doesn't retry them again.
+class ResilientDropbox():
+    def __init__(self, dbx, policy=DEFAULT_RETRY_POLICY, budget=None, metrics=None):
+        self.dbx = dbx
+        self.policy = policy
+        self.budget = budget or ApiBudget()
+        self.metrics = metrics
+
+    def _onRetry(self, error, throttled, delay):
+        if self.metrics is not None:
+            self.metrics.count("api_retries")
+            if throttled:
+                self.metrics.count("api_throttled")
+
+    def _attempt(self, attribute, *args, **kwargs):
+        try:
+            self.budget.spend()
+        except ApiBudgetExhausted:
+            if self.metrics is not None:
+                self.metrics.count("api_budget_exhausted")
+            raise
+        return attribute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.dbx, name)
+        if not (callable(attribute) and name.startswith(DROPBOX_CALL_PREFIXES)):
+            return attribute
+        def call(*args, **kwargs):
+            return callWithRetry(self._attempt, attribute, *args, policy=self.policy, on_retry=self._onRetry, **kwargs)
+        call.retried = True
+        return call
+
+# A pooled keep-alive session for a Dropbox client with room for
+# `max_connections` concurrent requests
+def pooledSession(max_connections=8):
+    return dropbox.create_session(max_connections=max_connections)
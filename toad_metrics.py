@@ -0,0 +1,225 @@
+# Instrumentation for a notifier run: wall time per stage, API calls (with
+# their errors, time and bytes transferred) and counts of what was processed.
+# A run's metrics can be appended to a JSON lines file, written as a Prometheus
+# textfile (for node_exporter's textfile collector) and uploaded to Dropbox.
+import os
+import json
+import time
+import threading
+import dropbox
+import toad_functions
+import toad_http
+from collections import Counter
+from contextlib import contextmanager
+
+METRICS_UPLOAD_NAME = "run_metrics.json"
+
+# Bytes moved by the HTTP requests made on this thread. The Dropbox SDK makes
+# its requests on the calling thread, so a call's transfer is what this counts
+# between the call starting and returning.
+_transfer = threading.local()
+
+def _countTransfer(response, *args, **kwargs):
+    body = response.request.body
+    _transfer.sent = getattr(_transfer, "sent", 0) + (len(body) if body else 0)
+    if "Content-Length" in response.headers:
+        received = int(response.headers["Content-Length"])
+    elif not kwargs.get("stream"):
+        received = len(response.content)
+    else:
+        # a streamed download of unknown length, reading it here would buffer it all
+        received = 0
+    _transfer.received = getattr(_transfer, "received", 0) + received
+    return response
+
+# A pooled requests session for the Dropbox client that counts bytes transferred
+def countingSession(max_connections=8):
+    session = toad_http.pooledSession(max_connections)
+    session.hooks["response"].append(_countTransfer)
+    return session
+
+class RunMetrics():
+    def __init__(self, instance_name, started_at):
+        self.instance_name = instance_name
+        self.started_at = started_at
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.items = Counter()
+        self.api_calls = Counter()
+        self.api_errors = Counter()
+        self.api_seconds = Counter()
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.duration = None
+        self.failed = False
+        self._started = time.perf_counter()
+
+    # time the enclosed block, time spent in a stage more than once is summed
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def count(self, item, value=1):
+        with self.lock:
+            self.items[item] += value
+
+    def recordCall(self, api, call, seconds, sent=0, received=0, error=None):
+        with self.lock:
+            self.api_calls[(api, call)] += 1
+            self.api_seconds[(api, call)] += seconds
+            self.bytes_sent[api] += sent
+            self.bytes_received[api] += received
+            if error is not None:
+                self.api_errors[(api, call, error)] += 1
+
+    def finish(self, failed=False):
+        self.duration = time.perf_counter() - self._started
+        self.failed = failed
+
+    def toDict(self):
+        return {
+            "instance": self.instance_name,
+            "started_at": self.started_at.isoformat(),
+            "duration_seconds": self.duration,
+            "failed": self.failed,
+            "stages": self.stages,
+            "items": dict(self.items),
+            "api_calls": [
+                {"api": api, "call": call, "count": count, "seconds": self.api_seconds[(api, call)]}
+                for ((api, call), count) in self.api_calls.items()],
+            "api_errors": [
+                {"api": api, "call": call, "error": error, "count": count}
+                for ((api, call, error), count) in self.api_errors.items()],
+            "bytes": {api: {"sent": self.bytes_sent[api], "received": self.bytes_received[api]} for api in self.bytes_sent},
+        }
+
+    def toPrometheus(self):
+        instance = _label(self.instance_name)
+        lines = []
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (labels, value) in samples:
+                label_text = ",".join([f'instance="{instance}"'] + [f'{key}="{_label(label_value)}"' for (key, label_value) in labels])
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        family("toad_run_timestamp_seconds", "gauge", "When the last run started",
+            [((), self.started_at.timestamp())])
+        family("toad_run_duration_seconds", "gauge", "Wall time of the last run",
+            [((), self.duration or 0)])
+        family("toad_run_failed", "gauge", "1 if the last run raised an error",
+            [((), int(self.failed))])
+        family("toad_stage_seconds", "gauge", "Wall time of each stage of the last run",
+            [((("stage", stage),), seconds) for (stage, seconds) in self.stages.items()])
+        family("toad_run_items", "gauge", "Files, notifications and emails handled by the last run",
+            [((("item", item),), count) for (item, count) in self.items.items()])
+        family("toad_api_calls", "gauge", "API calls made by the last run",
+            [((("api", api), ("call", call)), count) for ((api, call), count) in self.api_calls.items()])
+        family("toad_api_call_seconds", "gauge", "Time spent in API calls by the last run",
+            [((("api", api), ("call", call)), seconds) for ((api, call), seconds) in self.api_seconds.items()])
+        family("toad_api_errors", "gauge", "API calls that failed in the last run",
+            [((("api", api), ("call", call), ("error", error)), count) for ((api, call, error), count) in self.api_errors.items()])
+        family("toad_api_bytes", "gauge", "Bytes transferred by API calls in the last run",
+            [((("api", api), ("direction", "sent")), self.bytes_sent[api]) for api in self.bytes_sent] +
+            [((("api", api), ("direction", "received")), self.bytes_received[api]) for api in self.bytes_received])
+        return "\n".join(lines) + "\n"
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _errorName(error):
+    if isinstance(error, dropbox.exceptions.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, dropbox.exceptions.ApiError):
+        return "api"
+    if isinstance(error, dropbox.exceptions.HttpError):
+        return f"http_{error.status_code}"
+    return type(error).__name__
+
+# Wraps a Dropbox client so every API call made through it is recorded
+class InstrumentedDropbox():
+    def __init__(self, dbx, metrics):
+        self.dbx = dbx
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.dbx, name)
+        if not (callable(attribute) and name.startswith(toad_http.DROPBOX_CALL_PREFIXES)):
+            return attribute
+        def call(*args, **kwargs):
+            _transfer.sent = _transfer.received = 0
+            started = time.perf_counter()
+            error = None
+            try:
+                return attribute(*args, **kwargs)
+            except Exception as e:
+                error = _errorName(e)
+                raise
+            finally:
+                self.metrics.recordCall("dropbox", name, time.perf_counter() - started, _transfer.sent, _transfer.received, error)
+        return call
+
+# Wraps an EmailTransport (or a SendGrid object) so every send, how many
+# recipients it failed and the requests it retried are recorded
+class InstrumentedTransport(toad_functions.EmailTransport):
+    def __init__(self, transport, metrics):
+        if not isinstance(transport, toad_functions.EmailTransport):
+            transport = toad_functions.SendGridTransport(transport)
+        self.transport = transport
+        self.metrics = metrics
+
+    def send(self, send_from, subject, html, recipients):
+        started = time.perf_counter()
+        error = None
+        try:
+            with toad_http.reportingRetries(self._onRetry):
+                outcomes = self.transport.send(send_from, subject, html, recipients)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.metrics.recordCall("email", type(self.transport).__name__, time.perf_counter() - started, error=error)
+        self.metrics.count("emails_sent", sum(outcomes.values()))
+        self.metrics.count("emails_failed", len(outcomes) - sum(outcomes.values()))
+        return outcomes
+
+    def _onRetry(self, error, throttled, delay):
+        self.metrics.count("email_retries")
+        if throttled:
+            self.metrics.count("email_throttled")
+
+    def close(self):
+        self.transport.close()
+
+def writeJsonLines(metrics, path):
+    with open(path, "a") as f:
+        f.write(json.dumps(metrics.toDict()) + "\n")
+
+# written to a temporary file then swapped in, the textfile collector must never read half a file
+def writePrometheusTextfile(metrics, path):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(metrics.toPrometheus())
+    os.replace(temp_path, path)
+
+# Emit a run's metrics as the optional `metrics` config asks, e.g.
+#   {"json_lines": "metrics.jsonl", "prometheus_textfile": "/var/lib/node_exporter/toad.prom", "upload": true}
+# An upload goes next to sensors_status.json in `upload_folder`.
+# A metrics failure is reported and never fails the run.
+def emitMetrics(metrics, metrics_configuration, dbx=None, upload_folder=None):
+    metrics_configuration = metrics_configuration or {}
+    try:
+        if metrics_configuration.get("json_lines"):
+            writeJsonLines(metrics, metrics_configuration["json_lines"])
+        if metrics_configuration.get("prometheus_textfile"):
+            writePrometheusTextfile(metrics, metrics_configuration["prometheus_textfile"])
+        if metrics_configuration.get("upload") and upload_folder:
+            toad_functions.uploadFileToDropbox(dbx, json.dumps(metrics.toDict()), upload_folder + "/" + METRICS_UPLOAD_NAME)
+    except Exception as e:
+        print(f"Could not emit run metrics: {e}")
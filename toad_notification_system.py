@@ -2,6 +2,13 @@
 import os
 import sys
 import json
+import time
+import signal
+import asyncio
+import argparse
+import glob
+import threading
+import traceback
 import requests
 import datetime
 from datetime import datetime
@@ -9,137 +16,575 @@ from datetime import timezone
 from dateutil import parser
 from datetime import timedelta
 import dropbox
-import sendgrid
+from concurrent.futures import ThreadPoolExecutor
 import toad_functions
+import toad_state
+import toad_metrics
+import toad_http
+import toad_async
 
 # Load configuration
-config_path = "./config.json"
-if len(sys.argv) >= 2:
-    config_path = sys.argv[1]
-system_configuration = json.loads(open(config_path, "r").read())
-bot_address = system_configuration['send_from']
-
-# Open files
-# If the file does not exist, just feed the JSON parser and empty JSON object
-new_instance = False
-try:
-    file_history_io = open("files.json", "r")
-    file_history_text = file_history_io.read()
-    file_history_io.close()
-except:
-    file_history_text = "{}"
-    # we need to cater for empty file/sensor histories - indicative of a new
-    # monitor being set up for an established folder
-    new_instance = True
-
-try:
-    sensor_history_io = open("sensors.json", "r")
-    sensor_history_text = sensor_history_io.read()
-    sensor_history_io.close()
-except:
-    sensor_history_text =  "{}"
-
-# Load state databases from text file
-file_history = json.loads(file_history_text)
-sensor_history = json.loads(sensor_history_text)
+def loadConfiguration(config_path):
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+# One deployment: its config.json and the clients it uses
+class Instance():
+    def __init__(self, config_path, system_configuration, state_folder="."):
+        self.config_path = config_path
+        self.system_configuration = system_configuration
+        self.name = system_configuration.get("name") or config_path
+        self.state_folder = state_folder
+        self.dbx = None
+        self.email_transport = None
+
+# Expand the config arguments, a directory stands for every .json file in it.
+# Each instance keeps its state in `state_folder` if the config sets one. A
+# lone instance otherwise uses the working directory, as it always has, and
+# several instances get a folder each under ./state named after their config.
+def loadInstances(config_paths):
+    expanded_paths = []
+    for path in config_paths:
+        if os.path.isdir(path):
+            expanded_paths.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        else:
+            expanded_paths.append(path)
+
+    instances = []
+    for config_path in expanded_paths:
+        system_configuration = loadConfiguration(config_path)
+        state_folder = system_configuration.get("state_folder")
+        if not state_folder:
+            state_folder = "." if len(expanded_paths) == 1 else os.path.join("state", os.path.splitext(os.path.basename(config_path))[0])
+        instances.append(Instance(config_path, system_configuration, state_folder))
+    return instances
+
+# Open state
+# A new instance (no file history) is indicative of a new monitor being set up
+# for an established folder
+def openState(system_configuration, state_folder="."):
+    os.makedirs(state_folder, exist_ok=True)
+    backend = system_configuration.get("state_backend", "json")
+    options = {}
+    if backend == "sharded":
+        options["hot_days"] = system_configuration.get("file_history_hot_days", 90)
+    return toad_state.openStateStore(backend, state_folder, **options)
 
 # Authenticate
-sg = sendgrid.SendGridAPIClient(apikey=system_configuration['sendgrid_api_key'])
-dbx = dropbox.Dropbox(system_configuration['dropbox_api_key'])
-dbx.users_get_current_account()
-
-# Pull list of files in Dropbox
-root_folder = system_configuration['root_folder']
-dropbox_files = toad_functions.getFilesFromDropbox(dbx, root_folder=root_folder)
-
-# Get list of emails to send to by scanning Dropbox
-send_to_emails = toad_functions.getEmailsFromDropbox(system_configuration["filename_send_to"], dbx, debug=False)
-
-# Search for new notifications, in the context of file and sensor history
-now = datetime.now(timezone.utc)
-pause_duration = system_configuration["pause_duration"]
-fallback_utc_offset = timedelta(seconds=(system_configuration["fallback_utc_offset"]))
-whitelist_times = toad_functions.parse_whitelist_times(system_configuration["whitelist_times_of_day"])
-(notifications_to_send, sensors_status) = toad_functions.getNotificationsAndActivatingSensors(
-    dropbox_files,file_history, sensor_history, pause_duration, fallback_utc_offset, now, whitelist_times)
-
-# in a new instance, when there are no history files available (files.json and sensors.json)
-# we modify the sensor activation date to now - pause_duration. This way we alert
-# for any files in the next block, but for none of the previous files
-if new_instance:
-    print("New instance detected. Sensor activation date is shifted back " + str(pause_duration))
-    activation_adjustment = -1 * pause_duration
-    # Activation adjustment allows us to tweak when a sensor was activated.
-    # Useful for new deploys without past history files available.
-    now = now + timedelta(seconds=activation_adjustment)
-
-# Update state
-(file_history, sensor_history, send_notifications) = toad_functions.updateState(notifications_to_send, sensors_status, file_history, sensor_history, now)
-file_history_io = open("files.json", "w")
-sensor_history_io = open("sensors.json", "w")
-json.dump(file_history, file_history_io)
-json.dump(sensor_history, sensor_history_io)
-file_history_io.close()
-sensor_history_io.close()
-
-# Do not send notifications for new instance initial setup so we don't send a
-#  notification for every previous file - this should only happen when there are
-#  no history files available (files.json and sensors.json are empty).
-if new_instance:
-    print("New instance detected. Squashing all notifications. New notifications will work from next script run")
-    send_notifications = False
+# Instances using the same API keys share clients (and their connection pools)
+# through `clients`. The pool has room for our most concurrent stage plus the
+# listing prefetch. Retries are left to toad_http so each run's retries are
+# counted and paid for from its budget, rather than the SDK retrying (rate
+# limits without end) out of sight.
+def connect(system_configuration, clients=None):
+    if clients is None:
+        clients = {}
+    dropbox_key = ("dropbox", system_configuration['dropbox_api_key'])
+    if dropbox_key not in clients:
+        pool_size = max(8, system_configuration.get("shared_link_concurrency", 4),
+            system_configuration.get("log_fetch_concurrency", 4)) + 1
+        dbx = dropbox.Dropbox(system_configuration['dropbox_api_key'], max_retries_on_error=0,
+            max_retries_on_rate_limit=0, session=toad_metrics.countingSession(pool_size))
+        dbx.users_get_current_account()
+        clients[dropbox_key] = dbx
+    transport_key = ("email", system_configuration.get('sendgrid_api_key'),
+        json.dumps(system_configuration.get("email_transport"), sort_keys=True))
+    if transport_key not in clients:
+        clients[transport_key] = toad_functions.makeEmailTransport(system_configuration)
+    return (clients[dropbox_key], clients[transport_key])
+
+def closeClients(clients):
+    for client in clients.values():
+        if isinstance(client, toad_functions.EmailTransport):
+            client.close()
+
+# Connect every instance, leaving out (and reporting) any that can't
+def connectInstances(instances, clients):
+    connected = []
+    for instance in instances:
+        try:
+            (instance.dbx, instance.email_transport) = connect(instance.system_configuration, clients)
+            connected.append(instance)
+        except Exception:
+            print(f"Could not connect instance {instance.name}")
+            traceback.print_exc()
+    return connected
+
+def runNotifications(system_configuration, dbx, email_transport, state, now, metrics):
+    send_to_emails = fetchRecipients(system_configuration, dbx, state, metrics)
+    (notifications_to_send, sensors_status, send_notifications) = findNotifications(system_configuration, dbx, state, now, metrics)
+    with metrics.stage("commit"):
+        state.commit()
+    if send_notifications:
+        sendNotifications(system_configuration, email_transport, state, notifications_to_send, sensors_status, send_to_emails, metrics)
+
+# Get list of emails to send to from Dropbox, or from the state if it hasn't changed
+def fetchRecipients(system_configuration, dbx, state, metrics):
+    with metrics.stage("emails"):
+        return toad_functions.getEmailsFromDropbox(system_configuration["filename_send_to"], dbx,
+            recipient_cache=state.recipient_lists)
+
+# List the root folder, search it for notifications and record them in the
+# state, along with any shared links the email needs. Nothing is committed.
+# returns (notifications_to_send, sensors_status, send_notifications)
+def findNotifications(system_configuration, dbx, state, now, metrics):
+    new_instance = state.new_instance
+    file_history = state.file_history
+    sensor_history = state.sensor_history
+    cursors = state.cursors
+
+    # Pull list of files in Dropbox, or just the changes since our last run.
+    # A cursor is only trusted if we still have the history it was saved with.
+    root_folder = system_configuration['root_folder']
+    cursor = None if new_instance else cursors.get(root_folder)
+    # A full listing is streamed into the notification search, so only the
+    # files we haven't processed are ever held in memory. A delta is small
+    # and merged with what's still pending first.
+    with metrics.stage("list"):
+        (listing, full_listing) = toad_functions.streamFileChangesFromDropbox(dbx, root_folder, cursor)
+        if full_listing:
+            dropbox_files = listing
+        else:
+            dropbox_files = toad_functions.mergeFileChanges(listing, file_history, root_folder)
+            print(f"Processing {listing.count} changed entries since the last run")
+
+    # Search for new notifications, in the context of file and sensor history
+    pause_duration = system_configuration["pause_duration"]
+    fallback_utc_offset = timedelta(seconds=(system_configuration["fallback_utc_offset"]))
+    whitelist_times = toad_functions.compile_whitelist(system_configuration["whitelist_times_of_day"],
+        system_configuration.get("whitelist_times_by_sensor"))
+    with metrics.stage("notifications"):
+        (notifications_to_send, sensors_status) = toad_functions.getNotificationsAndActivatingSensors(
+            dropbox_files,file_history, sensor_history, pause_duration, fallback_utc_offset, now, whitelist_times)
+    cursors[root_folder] = listing.cursor
+    metrics.count("files_listed", listing.count)
+    metrics.count("notifications", len(notifications_to_send))
+    metrics.count("sensors_activated", sum(status == toad_functions.SensorState.ACTIVATED for status in sensors_status.values()))
+
+    # in a new instance, when there are no history files available (files.json and sensors.json)
+    # we modify the sensor activation date to now - pause_duration. This way we alert
+    # for any files in the next block, but for none of the previous files
+    activated_at = now
+    if new_instance:
+        print("New instance detected. Sensor activation date is shifted back " + str(pause_duration))
+        activation_adjustment = -1 * pause_duration
+        # Activation adjustment allows us to tweak when a sensor was activated.
+        # Useful for new deploys without past history files available.
+        activated_at = now + timedelta(seconds=activation_adjustment)
+
+    # Update state
+    with metrics.stage("update_state"):
+        (file_history, sensor_history, send_notifications) = toad_functions.updateState(notifications_to_send, sensors_status, file_history, sensor_history, activated_at)
+
+    # Do not send notifications for new instance initial setup so we don't send a
+    #  notification for every previous file - this should only happen when there are
+    #  no history files available (files.json and sensors.json are empty).
+    if new_instance:
+        print("New instance detected. Squashing all notifications. New notifications will work from next script run")
+        send_notifications = False
+
+    # Shared links are cached with the rest of our state, so each file is only
+    # ever linked once. If the run's API budget runs out first, the files
+    # still without a link are named in the email unlinked.
+    max_files_per_sensor = system_configuration.get("email_max_files_per_sensor")
+    if send_notifications:
+        paths = toad_functions.notificationPaths(notifications_to_send, sensors_status, max_files_per_sensor)
+        concurrency = system_configuration.get("shared_link_concurrency", 4)
+        with metrics.stage("shared_links"):
+            try:
+                toad_functions.resolveSharedLinks(dbx, paths, state.shared_links, concurrency)
+            except toad_http.ApiBudgetExhausted as e:
+                unlinked = len(set(paths) - set(state.shared_links))
+                print(f"{e}, sending {unlinked} files without a shared link")
+                metrics.count("files_unlinked", unlinked)
+    return (notifications_to_send, sensors_status, send_notifications)
 
 # Send Notifications
-instance_name = system_configuration["name"]
-if send_notifications:
-    href_function = lambda path: toad_functions.getSharedLink(dbx, path)
-    body = toad_functions.formatNotifications(notifications_to_send, sensors_status, href_function)
-    toad_functions.sendEmail(body, instance_name, send_to_emails, bot_address, sg)
-
-print("Updating sensor health")
-
-# get a list of sensor folders
-status_path = system_configuration["log_folder"]
-update_at = system_configuration["update_status_report_at"]
-status_save_path = system_configuration["save_status_reports_folder"] or system_configuration["log_folder"]
-
-if status_path:
-    if update_at and toad_functions.closeToTimeOfDay(now, update_at):
-        all_files = toad_functions.getFilesFromDropbox(dbx, root_folder=status_path)
-        log_dirs = toad_functions.filterSensorDirs(all_files, [root_folder])
-        # for each log dir, get logs
-        # Note: this would be an optimal async operation
-        # Note: we could run into API limitations here
-        limit = None # no limit, or you could set one timedelta(days=3)
-        all_sensors  = {}
-        for (log_dir, sensor) in log_dirs:
-            print("Downloading logs for " + log_dir)
-            log_files = toad_functions.getFilesFromDropbox(dbx, root_folder=log_dir)
-            report = toad_functions.filterGroupLogFiles(log_files, now, limit, fallback_utc_offset)
-            last_activation = None if new_instance else sensor_history.get(sensor)
-            all_sensors[sensor] = {"logs": report, "last_activation":  last_activation}
-
-        full_report = {"sensors": all_sensors, "report_date": now.isoformat(), "name": instance_name}
-        # upload the report to dropbox
-        content = json.dumps(full_report)
-        
-        report_path = status_save_path + "/sensors_status.json"
-        print("Uploading report to " + report_path)
-        toad_functions.uploadFileToDropbox(dbx, content, report_path)
-
-        # upload the html report viewer
-        target_date = now.date()
-        report_path = status_save_path + f"/sensors_status_{target_date.isoformat()}.html"
-        print("Uploading template to " + report_path)
-        with open("sensors_status.template.html", 'r', encoding = 'utf-8') as f:
-            viewer_template = f.read()
-            
-            report = toad_functions.templateReport(viewer_template, full_report, target_date)
-            toad_functions.uploadFileToDropbox(dbx, report, report_path)
-    else:
+def sendNotifications(system_configuration, email_transport, state, notifications_to_send, sensors_status, send_to_emails, metrics):
+    instance_name = system_configuration["name"]
+    bot_address = system_configuration['send_from']
+    max_files_per_sensor = system_configuration.get("email_max_files_per_sensor")
+    href_function = lambda path: state.shared_links.get(path)
+    with metrics.stage("format"):
+        body = toad_functions.formatNotifications(notifications_to_send, sensors_status, href_function, max_files_per_sensor)
+    with metrics.stage("send"):
+        outcomes = toad_functions.sendEmail(body, instance_name, send_to_emails, bot_address, email_transport)
+        failed = [recipient for (recipient, completed_well) in outcomes.items() if not completed_well]
+        if failed:
+            print(f"Retrying notification for {len(failed)} recipients")
+            toad_functions.sendEmail(body, instance_name, failed, bot_address, email_transport)
+
+# List the sensor log folders and bring the log index (in the state, not
+# committed) up to date for a report at `report_at`.
+# returns the [(log folder, sensor)] being reported on
+def updateStatusLogs(system_configuration, dbx, state, report_at, metrics):
+    root_folder = system_configuration['root_folder']
+    status_path = system_configuration["log_folder"]
+    fallback_utc_offset = timedelta(seconds=(system_configuration["fallback_utc_offset"]))
+
+    # get a list of sensor folders
+    with metrics.stage("report_list"):
+        all_files = toad_functions.iterFilesFromDropbox(dbx, root_folder=status_path)
+        log_dirs = list(toad_functions.filterSensorDirs(all_files, [root_folder]))
+    metrics.count("log_folders", len(log_dirs))
+
+    # for each log dir, get the logs added since the last report. These are
+    # listed concurrently and rate limited requests are retried. The index
+    # only keeps log_retention_days of logs.
+    concurrency = system_configuration.get("log_fetch_concurrency", 4)
+    retention = timedelta(days=system_configuration.get("log_retention_days", 7))
+    print(f"Updating logs for {len(log_dirs)} sensors, {concurrency} at a time")
+    with metrics.stage("report_logs"):
+        log_index = toad_functions.updateLogIndex(dbx, [log_dir for (log_dir, _) in log_dirs],
+            state.log_index, state.cursors, report_at, retention, fallback_utc_offset, concurrency)
+    metrics.count("log_files", sum(len(logs) for log_days in log_index.values() for logs in log_days.values()))
+    return log_dirs
+
+# `report_at` is the update_status_report_at time the report is for. A report
+# made again for the same time, with the same logs, is identical and so isn't
+# uploaded again.
+# `log_dirs` are the [(log folder, sensor)] updateStatusLogs returned, if it's
+# already been run.
+def runStatusReport(system_configuration, dbx, state, report_at, new_instance, metrics, log_dirs=None):
+    print("Updating sensor health")
+    if log_dirs is None:
+        log_dirs = updateStatusLogs(system_configuration, dbx, state, report_at, metrics)
+    status_save_path = system_configuration["save_status_reports_folder"] or system_configuration["log_folder"]
+    instance_name = system_configuration["name"]
+    log_index = state.log_index
+
+    all_sensors  = {}
+    for (log_dir, sensor) in log_dirs:
+        last_activation = None if new_instance else state.sensor_history.get(sensor)
+        if last_activation is not None:
+            last_activation = toad_functions.activationToIso(last_activation)
+        all_sensors[sensor] = {"logs": toad_functions.countLogs(log_index[log_dir]), "last_activation":  last_activation}
+
+    full_report = {"sensors": all_sensors, "report_date": report_at.isoformat(), "name": instance_name}
+    # upload the report to dropbox
+    content = json.dumps(full_report)
+
+    local_copy = system_configuration.get("local_report_copies", False)
+    report_path = status_save_path + "/sensors_status.json"
+    print("Uploading report to " + report_path)
+    with metrics.stage("report_upload"):
+        uploaded = toad_functions.uploadFileToDropbox(dbx, content, report_path, state.upload_hashes, local_copy)
+    metrics.count("uploads_skipped", int(not uploaded))
+
+    # upload the html report viewer
+    target_date = report_at.date()
+    report_path = status_save_path + f"/sensors_status_{target_date.isoformat()}.html"
+    print("Uploading template to " + report_path)
+    with metrics.stage("report_render"):
+        report = toad_functions.renderReport(full_report, target_date)
+    with metrics.stage("report_upload"):
+        uploaded = toad_functions.uploadFileToDropbox(dbx, report, report_path, state.upload_hashes, local_copy)
+    metrics.count("uploads_skipped", int(not uploaded))
+
+    # a dated report is never uploaded again once its day has passed, so only
+    # the hashes of this report's paths are worth keeping
+    report_paths = {status_save_path + "/sensors_status.json", report_path}
+    for path in [path for path in state.upload_hashes if path not in report_paths]:
+        del state.upload_hashes[path]
+
+    # the log index, its cursors and what was uploaded
+    with metrics.stage("commit"):
+        state.commit()
+
+# One notification cycle, followed by the status report if one is due.
+# `report_threshold` is how close to an update_status_report_at time we must be.
+# The cycle's metrics are emitted as the optional `metrics` config asks, even
+# if it fails.
+# returns True if a status report was made
+def runCycle(system_configuration, dbx, email_transport, state, now, report_threshold=300):
+    metrics = toad_metrics.RunMetrics(system_configuration["name"], now)
+    (cycle_dbx, cycle_transport) = cycleClients(system_configuration, dbx, email_transport, metrics)
+    failed = True
+    try:
+        report_made = runCycleSteps(system_configuration, cycle_dbx, cycle_transport, state, now, report_threshold, metrics)
+        failed = False
+        return report_made
+    finally:
+        finishCycle(system_configuration, dbx, metrics, failed)
+
+# The same cycle as runCycle with its independent steps overlapped, see runCycleStepsAsync
+async def runCycleAsync(system_configuration, dbx, email_transport, state, now, report_threshold=300):
+    metrics = toad_metrics.RunMetrics(system_configuration["name"], now)
+    (cycle_dbx, cycle_transport) = cycleClients(system_configuration, dbx, email_transport, metrics)
+    failed = True
+    try:
+        report_made = await runCycleStepsAsync(system_configuration, cycle_dbx, cycle_transport, state, now, report_threshold, metrics)
+        failed = False
+        return report_made
+    finally:
+        await toad_async.run(finishCycle, system_configuration, dbx, metrics, failed)
+
+# The clients a cycle uses: every API attempt is recorded, and paid for from
+# the run's budget
+def cycleClients(system_configuration, dbx, email_transport, metrics):
+    retry_policy = toad_http.RetryPolicy(system_configuration.get("api_retries", 5))
+    budget = toad_http.ApiBudget(system_configuration.get("api_call_budget"))
+    instrumented_dbx = toad_http.ResilientDropbox(toad_metrics.InstrumentedDropbox(dbx, metrics), retry_policy, budget, metrics)
+    instrumented_transport = toad_metrics.InstrumentedTransport(email_transport, metrics)
+    return (instrumented_dbx, instrumented_transport)
+
+def finishCycle(system_configuration, dbx, metrics, failed):
+    metrics.finish(failed)
+    status_save_path = system_configuration["save_status_reports_folder"] or system_configuration["log_folder"]
+    toad_metrics.emitMetrics(metrics, system_configuration.get("metrics"), dbx, status_save_path)
+
+def runCycleSteps(system_configuration, dbx, email_transport, state, now, report_threshold, metrics):
+    new_instance = state.new_instance
+    runNotifications(system_configuration, dbx, email_transport, state, now, metrics)
+
+    report_at = statusReportTime(system_configuration, now, report_threshold)
+    if report_at is None:
+        return False
+    return makeStatusReport(system_configuration, dbx, state, report_at, new_instance, metrics)
+
+# Listing the root folder, downloading the recipient list and updating the log
+# index don't depend on each other, so they run at once. They all update the
+# state, which is committed once they're done. Then the email is sent while
+# the status report is made.
+async def runCycleStepsAsync(system_configuration, dbx, email_transport, state, now, report_threshold, metrics):
+    new_instance = state.new_instance
+    report_at = statusReportTime(system_configuration, now, report_threshold)
+
+    steps = [
+        toad_async.run(findNotifications, system_configuration, dbx, state, now, metrics),
+        toad_async.run(fetchRecipients, system_configuration, dbx, state, metrics)]
+    if report_at is not None:
+        steps.append(toad_async.run(updateStatusLogs, system_configuration, dbx, state, report_at, metrics))
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    for result in results[:2]:
+        if isinstance(result, Exception):
+            raise result
+    ((notifications_to_send, sensors_status, send_notifications), send_to_emails) = results[:2]
+    with metrics.stage("commit"):
+        state.commit()
+
+    # a failed log index update doesn't stop the email going out
+    failure = None
+    log_dirs = results[2] if report_at is not None else None
+    if isinstance(log_dirs, toad_http.ApiBudgetExhausted):
+        print(f"{log_dirs}, postponing the status report")
+        report_at = None
+    elif isinstance(log_dirs, Exception):
+        failure = log_dirs
+        report_at = None
+
+    steps = []
+    if send_notifications:
+        steps.append(toad_async.run(sendNotifications, system_configuration, email_transport, state,
+            notifications_to_send, sensors_status, send_to_emails, metrics))
+    if report_at is not None:
+        steps.append(toad_async.run(makeStatusReport, system_configuration, dbx, state, report_at, new_instance, metrics, log_dirs))
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    failure = failure or next((result for result in results if isinstance(result, Exception)), None)
+    if failure is not None:
+        raise failure
+    return report_at is not None and results[-1]
+
+# The update_status_report_at time a cycle at `now` should report for, or
+# None if no report is due
+def statusReportTime(system_configuration, now, report_threshold):
+    status_path = system_configuration["log_folder"]
+    update_at = system_configuration["update_status_report_at"]
+    if not status_path:
+        print("Skipping status update, no log_folder set in config file")
+        return None
+    report_at = toad_functions.scheduledTimeOfDay(now, update_at or [], report_threshold)
+    if report_at is None:
         print("skipping status update, not close enough to update_status_report_at times")
-else:
-    print("Skipping status update, no log_folder set in config file")
+    return report_at
+
+# the report is what gives way when the run's API budget is spent, the next
+# cycle near the report time tries again
+# returns True if the report was made
+def makeStatusReport(system_configuration, dbx, state, report_at, new_instance, metrics, log_dirs=None):
+    try:
+        runStatusReport(system_configuration, dbx, state, report_at, new_instance, metrics, log_dirs)
+    except toad_http.ApiBudgetExhausted as e:
+        print(f"{e}, postponing the status report")
+        return False
+    return True
+
+# Longpoll Dropbox for changes under the root folder and set `wake` when there
+# are some. After each wake up it waits for `cycled`, so the daemon has moved the
+# cursor on before we ask again. Returns once `stop` is set, after the longpoll
+# in progress (if any) finishes.
+def watchForChanges(dbx, current_cursor, wake, cycled, stop, timeout):
+    def waitForCycle():
+        # the daemon sets cycled after every cycle and as it stops
+        cycled.wait()
+        cycled.clear()
+
+    while not stop.is_set():
+        cursor = current_cursor()
+        if cursor is None:
+            # nothing to poll until the first cycle has listed the folder
+            waitForCycle()
+            continue
+
+        try:
+            (changes, backoff) = toad_functions.waitForDropboxChanges(dbx, cursor, timeout)
+        except Exception:
+            traceback.print_exc()
+            stop.wait(timeout)
+            continue
+
+        if changes and not stop.is_set():
+            cycled.clear()
+            wake.set()
+            waitForCycle()
+        if backoff:
+            stop.wait(backoff)
+
+# Run one cycle for every instance, concurrently. A failing instance is
+# reported and doesn't stop the others.
+# returns the number of instances that failed
+def runInstances(instances):
+    def runInstance(instance):
+        state = openState(instance.system_configuration, instance.state_folder)
+        try:
+            runCycle(instance.system_configuration, instance.dbx, instance.email_transport, state, datetime.now(timezone.utc))
+        finally:
+            state.close()
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, len(instances))) as executor:
+        futures = [(instance, executor.submit(runInstance, instance)) for instance in instances]
+        for (instance, future) in futures:
+            try:
+                future.result()
+            except Exception:
+                failures += 1
+                print(f"Instance {instance.name} failed")
+                traceback.print_exc()
+    return failures
+
+# runInstances on an event loop, with the independent steps of each cycle
+# overlapped (see runCycleStepsAsync)
+# returns the number of instances that failed
+def runInstancesAsync(instances):
+    async def runInstance(instance):
+        state = await toad_async.run(openState, instance.system_configuration, instance.state_folder)
+        try:
+            await runCycleAsync(instance.system_configuration, instance.dbx, instance.email_transport, state, datetime.now(timezone.utc))
+        finally:
+            state.close()
+
+    async def runAll():
+        return await asyncio.gather(*[runInstance(instance) for instance in instances], return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(runAll())
+    finally:
+        loop.close()
+
+    failures = 0
+    for (instance, result) in zip(instances, results):
+        if isinstance(result, Exception):
+            failures += 1
+            print(f"Instance {instance.name} failed")
+            traceback.print_exception(type(result), result, result.__traceback__)
+    return failures
+
+# Keep an instance's state warm and run a cycle every `interval` seconds until
+# `stop` is set. Setting `wake` starts the next cycle early.
+# With `longpoll` a cycle also runs as soon as new files arrive, but never
+# within `min_gap` seconds of the previous one.
+def runInstanceDaemon(instance, interval, longpoll, min_gap, stop, wake):
+    system_configuration = instance.system_configuration
+    cycled = threading.Event()
+    state = openState(system_configuration, instance.state_folder)
+    # each tick is within `interval` of a report time at least once, and a
+    # report is not repeated for ticks either side of the same time
+    report_threshold = max(300, interval)
+    last_report = None
+
+    if longpoll:
+        root_folder = system_configuration['root_folder']
+        current_cursor = lambda: None if state.new_instance else state.cursors.get(root_folder)
+        watcher = threading.Thread(target=watchForChanges, name=f"longpoll {instance.name}",
+            args=(instance.dbx, current_cursor, wake, cycled, stop, min(480, max(30, interval))), daemon=True)
+        watcher.start()
+
+    while not stop.is_set():
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        try:
+            report_due = last_report is None or (now - last_report).total_seconds() >= 2 * report_threshold
+            if runCycle(system_configuration, instance.dbx, instance.email_transport, state, now, report_threshold if report_due else 0):
+                last_report = now
+        except Exception:
+            print(f"Instance {instance.name} failed")
+            traceback.print_exc()
+            # throw away anything the failed cycle left uncommitted
+            state.close()
+            state = openState(system_configuration, instance.state_folder)
+        cycled.set()
+
+        wake.wait(max(0, interval - (time.monotonic() - started)))
+        wake.clear()
+        stop.wait(max(0, min_gap - (time.monotonic() - started)))
+
+    state.close()
+    # let the watcher see stop
+    cycled.set()
+
+# Run every instance in its own thread until SIGTERM or SIGINT. A signal lets
+# the current cycles finish before exiting.
+def runDaemon(instances, interval, longpoll=False, min_gap=10):
+    stop = threading.Event()
+    wakes = [threading.Event() for _ in instances]
+    def requestStop(signal_number, frame):
+        stop.set()
+        for wake in wakes:
+            wake.set()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, requestStop)
+
+    threads = [threading.Thread(target=runInstanceDaemon, name=instance.name,
+        args=(instance, interval, longpoll, min_gap, stop, wake)) for (instance, wake) in zip(instances, wakes)]
+    for thread in threads:
+        thread.start()
+    # join with a timeout so this thread keeps handling signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+    print("Daemon stopped")
+
+def main(argv):
+    argument_parser = argparse.ArgumentParser(description="Send alerts when files are added to a Dropbox folder")
+    argument_parser.add_argument("config", nargs="*", default=["./config.json"],
+        help="paths to config.json files, or directories of them")
+    argument_parser.add_argument("--daemon", action="store_true",
+        help="keep running, checking for new files every --interval seconds")
+    argument_parser.add_argument("--interval", type=int, default=300,
+        help="seconds between checks in daemon mode (default: 300)")
+    argument_parser.add_argument("--longpoll", action="store_true",
+        help="daemon mode that also checks as soon as Dropbox reports new files")
+    argument_parser.add_argument("--async", dest="use_async", action="store_true",
+        help="overlap the independent steps of each run (listing, the recipient list, sensor logs) on an event loop")
+    arguments = argument_parser.parse_args(argv)
+
+    instances = loadInstances(arguments.config)
+    clients = {}
+    connected = connectInstances(instances, clients)
+    failures = len(instances) - len(connected)
+    if arguments.daemon or arguments.longpoll:
+        runDaemon(connected, arguments.interval, arguments.longpoll)
+    elif arguments.use_async:
+        failures += runInstancesAsync(connected)
+    else:
+        failures += runInstances(connected)
+    closeClients(clients)
+
+    # Done
+    print("Script finished")
+    return 1 if failures else 0
 
-# Done
-print("Script finished")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
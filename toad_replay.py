@@ -0,0 +1,187 @@
+# Replays a timeline of file arrivals through the notifier's state machine
+# (getNotificationsAndActivatingSensors and updateState) as if it had run every
+# `interval`, entirely in memory. Shows what a pause_duration or whitelist
+# would have sent before it's changed in production.
+#   python toad_replay.py --config config.json --days 365 --sensors 50
+#   python toad_replay.py --config config.json --timeline arrivals.txt --pause-duration 7200
+# A recorded timeline has a filename per line, optionally followed by a tab and
+# the ISO time it arrived in Dropbox (otherwise it's taken to arrive when it
+# was recorded).
+import sys
+import json
+import time
+import random
+import argparse
+from collections import Counter, namedtuple
+from datetime import timedelta, timezone
+from dateutil import parser
+import toad_functions
+
+Arrival = namedtuple("Arrival", ["arrived_at", "entry"])
+
+# when a synthetic timeline starts, unless --start says otherwise
+DEFAULT_START = "2021-01-01T00:00:00+10:00"
+
+# What one run did, for runs with files to process:
+#   listed      files processed (new arrivals and those still pending)
+#   emailed     {sensor name: files in the email}, empty if no email was sent
+#   silenced    files marked notified without being in an email, as their
+#               sensor was paused when another sensor triggered the email
+#   suppressed  files outside the whitelist
+#   pending     files left waiting for a sensor to activate
+RunResult = namedtuple("RunResult", ["run_at", "listed", "emailed", "silenced", "suppressed", "pending"])
+
+def _fileEntry(name):
+    return toad_functions.FileEntry(name, "/replay/" + name.lower())
+
+# A deployment where each sensor makes, on average, `events_per_day` bursts of
+# 1 to `burst` recordings a minute apart, each uploaded within `upload_delay`
+# seconds of being recorded
+def syntheticTimeline(start, days, sensors=50, events_per_day=2, burst=10, upload_delay=1800, utc_offset=timedelta(hours=10), seed=42):
+    rng = random.Random(seed)
+    local_start = start.astimezone(timezone(utc_offset)).replace(hour=0, minute=0, second=0, microsecond=0)
+    arrivals = []
+    for day in range(days):
+        day_start = local_start + timedelta(days=day)
+        for sensor in range(sensors):
+            for _ in range(rng.randint(0, 2 * events_per_day)):
+                event_at = day_start + timedelta(seconds=rng.randrange(86400))
+                for minute in range(rng.randint(1, burst)):
+                    recorded_at = event_at + timedelta(minutes=minute)
+                    name = recorded_at.strftime("toad-%Y-%m-%d-%H%M%S%z-") + f"sensor{sensor}.flac"
+                    arrivals.append(Arrival(recorded_at + timedelta(seconds=rng.randrange(upload_delay)), _fileEntry(name)))
+    arrivals.sort(key=lambda arrival: arrival.arrived_at)
+    return arrivals
+
+def loadTimeline(path, fallback_utc_offset):
+    arrivals = []
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            name = fields[0].strip()
+            if not name:
+                continue
+            try:
+                if len(fields) > 1 and fields[1].strip():
+                    arrived_at = parser.isoparse(fields[1].strip())
+                else:
+                    (arrived_at, _sensor_name) = toad_functions.parseFileInfo(name, fallback_utc_offset)
+            except ValueError as e:
+                print(f"Skipping {name}: {e}")
+                continue
+            arrivals.append(Arrival(arrived_at, _fileEntry(name)))
+    arrivals.sort(key=lambda arrival: arrival.arrived_at)
+    return arrivals
+
+# Run the notifier's decisions every `interval` from `start` until `end` over
+# `arrivals`, starting from an empty history. A run with nothing new or
+# pending can't change any state, so it's counted but not simulated.
+# returns (number of runs, [RunResult] for the runs with files to process, {filename: seconds from arrival to email})
+def replay(arrivals, start, end, interval, pause_duration, whitelist, fallback_utc_offset):
+    file_history = {}
+    sensor_history = {}
+    # filename -> Arrival, files waiting on a notification
+    pending = {}
+    results = []
+    delays = {}
+    position = 0
+    runs = 0
+    run_at = start
+    while run_at <= end:
+        runs += 1
+        arrived = []
+        while position < len(arrivals) and arrivals[position].arrived_at <= run_at:
+            arrived.append(arrivals[position])
+            position += 1
+        if arrived or pending:
+            listed = {arrival.entry.name: arrival for arrival in arrived}
+            listed.update(pending)
+            (notifications_to_send, sensors_status) = toad_functions.getNotificationsAndActivatingSensors(
+                [arrival.entry for arrival in listed.values()], file_history, sensor_history,
+                pause_duration, fallback_utc_offset, run_at, whitelist)
+            (file_history, sensor_history, send_notifications) = toad_functions.updateState(
+                notifications_to_send, sensors_status, file_history, sensor_history, run_at)
+
+            emailed = Counter()
+            if send_notifications:
+                for (sensor_name, entries) in toad_functions.groupNotifications(notifications_to_send, sensors_status).items():
+                    for notification in entries:
+                        emailed[sensor_name] += 1
+                        delays[notification.name] = (run_at - listed[notification.name].arrived_at).total_seconds()
+            suppressed = 0
+            for notification in notifications_to_send:
+                if file_history[notification.name] is False:
+                    pending[notification.name] = listed[notification.name]
+                else:
+                    pending.pop(notification.name, None)
+                suppressed += notification.suppress
+            silenced = len(notifications_to_send) - suppressed - sum(emailed.values()) if send_notifications else 0
+            results.append(RunResult(run_at, len(listed), dict(emailed), silenced, suppressed, len(pending)))
+        run_at += interval
+    return (runs, results, delays)
+
+def summarise(runs, results, delays):
+    emailed = Counter()
+    for result in results:
+        emailed.update(result.emailed)
+    return {
+        "runs": runs,
+        "runs_with_files": len(results),
+        "emails": sum(bool(result.emailed) for result in results),
+        "files_emailed": sum(emailed.values()),
+        "files_emailed_by_sensor": dict(sorted(emailed.items())),
+        "files_silenced": sum(result.silenced for result in results),
+        "files_suppressed": sum(result.suppressed for result in results),
+        "files_pending_at_end": results[-1].pending if results else 0,
+        "mean_seconds_to_email": sum(delays.values()) / len(delays) if delays else None,
+        "max_seconds_to_email": max(delays.values()) if delays else None,
+    }
+
+def main(argv):
+    argument_parser = argparse.ArgumentParser(description="Replay file arrivals through the notifier's state machine, in memory")
+    argument_parser.add_argument("--config", help="config.json to take pause_duration, the whitelists and fallback_utc_offset from")
+    argument_parser.add_argument("--timeline", help="recorded arrivals, a filename (and optionally a tab and arrival time) per line")
+    argument_parser.add_argument("--days", type=int, default=365, help="days to simulate (default: 365)")
+    argument_parser.add_argument("--sensors", type=int, default=50, help="sensors in a synthetic timeline (default: 50)")
+    argument_parser.add_argument("--events-per-day", type=int, default=2, help="average bursts of recordings per sensor per day in a synthetic timeline")
+    argument_parser.add_argument("--start", default=None, help="when the first run is (default: 2021-01-01T00:00:00+10:00, or the first arrival of a recorded timeline)")
+    argument_parser.add_argument("--interval", type=int, default=300, help="seconds between runs (default: 300)")
+    argument_parser.add_argument("--pause-duration", type=int, help="overrides the config's pause_duration")
+    argument_parser.add_argument("--output", help="write every run's result and the summary to this JSON file")
+    arguments = argument_parser.parse_args(argv)
+
+    system_configuration = {}
+    if arguments.config:
+        with open(arguments.config, "r") as f:
+            system_configuration = json.load(f)
+    pause_duration = arguments.pause_duration or system_configuration.get("pause_duration", 3600)
+    fallback_utc_offset = timedelta(seconds=system_configuration.get("fallback_utc_offset", 0))
+    whitelist = toad_functions.compile_whitelist(system_configuration.get("whitelist_times_of_day"),
+        system_configuration.get("whitelist_times_by_sensor"))
+
+    start = parser.isoparse(arguments.start or DEFAULT_START)
+    if arguments.timeline:
+        arrivals = loadTimeline(arguments.timeline, fallback_utc_offset)
+        if arrivals and arguments.start is None:
+            start = arrivals[0].arrived_at
+    else:
+        arrivals = syntheticTimeline(start, arguments.days, arguments.sensors, arguments.events_per_day)
+    end = start + timedelta(days=arguments.days)
+
+    started = time.perf_counter()
+    (runs, results, delays) = replay(arrivals, start, end, timedelta(seconds=arguments.interval),
+        pause_duration, whitelist, fallback_utc_offset)
+    summary = summarise(runs, results, delays)
+    print(f"Replayed {len(arrivals)} files over {runs} runs in {time.perf_counter() - started:.1f}s")
+    for (key, value) in summary.items():
+        if key != "files_emailed_by_sensor":
+            print(f"  {key:22} {value}")
+
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump({"summary": summary, "runs": [dict(result._asdict(), run_at=result.run_at.isoformat()) for result in results]}, f, indent=2)
+        print("Results written to " + arguments.output)
+    return summary
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,474 @@
+# Persistence for the notifier's state between runs:
+#   file_history:   filename -> True (notified) / False (pending) / None (suppressed),
+#                   optionally sharded by recording month (ShardedFileHistory)
+#   sensor_history: sensor name -> unix seconds of the last activation (an ISO date when stored)
+#   cursors:        Dropbox folder -> listing cursor
+#   shared_links:   Dropbox path_lower -> public shared link url
+#   log_index:      sensor log folder -> day -> {log filename: status}
+#   upload_hashes:  Dropbox path -> content_hash of the last report uploaded there
+#   recipient_lists: Dropbox path -> {"content_hash", "recipients"} of the recipient list last downloaded
+import os
+import sys
+import json
+import gzip
+import posixpath
+import sqlite3
+import threading
+import toad_functions
+from datetime import date
+from datetime import timedelta
+from collections.abc import MutableMapping
+
+FILE_HISTORY = "files.json"
+SENSOR_HISTORY = "sensors.json"
+CURSORS = "cursor.json"
+SHARED_LINKS = "links.json"
+LOG_INDEX = "logs.json"
+UPLOAD_HASHES = "uploads.json"
+RECIPIENT_LISTS = "recipients.json"
+SQLITE_DATABASE = "state.sqlite"
+# the sharded backend's file history folder, its manifest and archived months
+FILE_HISTORY_SHARDS = "files"
+SHARD_MANIFEST = "manifest.json"
+ARCHIVE_FOLDER = "archive"
+
+def _readJson(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+# write to a temporary file then swap it in, so a crash never leaves half a file
+def _writeJson(path, value):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+def _writeGzipJson(path, value):
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+def _sensorHistoryFromIso(activations):
+    return {sys.intern(sensor_name): toad_functions.activationFromIso(activated_at) for (sensor_name, activated_at) in activations}
+
+def _sensorHistoryToIso(sensor_history):
+    return {sensor_name: toad_functions.activationToIso(timestamp) for (sensor_name, timestamp) in sensor_history.items()}
+
+# The original state format: whole JSON documents, read and rewritten every run
+class JsonStateStore():
+    def __init__(self, folder="."):
+        self.folder = folder
+        self.file_history = {}
+        self.sensor_history = {}
+        self.cursors = {}
+        self.shared_links = {}
+        self.log_index = {}
+        self.upload_hashes = {}
+        self.recipient_lists = {}
+        self.new_instance = False
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self):
+        self._loadFileHistory()
+        for (attribute, name) in [("sensor_history", SENSOR_HISTORY), ("cursors", CURSORS), ("shared_links", SHARED_LINKS),
+                ("log_index", LOG_INDEX), ("upload_hashes", UPLOAD_HASHES), ("recipient_lists", RECIPIENT_LISTS)]:
+            try:
+                setattr(self, attribute, _readJson(self._path(name)))
+            except (OSError, ValueError):
+                setattr(self, attribute, {})
+        self.sensor_history = _sensorHistoryFromIso(self.sensor_history.items())
+        return self
+
+    def _loadFileHistory(self):
+        try:
+            self.file_history = _readJson(self._path(FILE_HISTORY))
+        except (OSError, ValueError):
+            # we need to cater for empty file/sensor histories - indicative of a new
+            # monitor being set up for an established folder
+            self.file_history = {}
+            self.new_instance = True
+
+    def _commitFileHistory(self):
+        _writeJson(self._path(FILE_HISTORY), self.file_history)
+
+    def commit(self):
+        self._commitFileHistory()
+        _writeJson(self._path(SENSOR_HISTORY), _sensorHistoryToIso(self.sensor_history))
+        _writeJson(self._path(CURSORS), self.cursors)
+        _writeJson(self._path(SHARED_LINKS), self.shared_links)
+        _writeJson(self._path(LOG_INDEX), self.log_index)
+        _writeJson(self._path(UPLOAD_HASHES), self.upload_hashes)
+        _writeJson(self._path(RECIPIENT_LISTS), self.recipient_lists)
+        self.new_instance = False
+
+    def close(self):
+        pass
+
+# File history split into a partition per recording month (as parsed from
+# each filename), a JSON file each in `folder`. Only the months inside the hot
+# window (the last `hot_days` days, plus files without a date) are loaded.
+# Older months are archived as gzipped shards under archive/, which are only
+# opened for a file recorded in that month - a late upload of an old recording
+# is looked up (and recorded) in its archived month. The manifest lists the
+# archived months and the files in them still pending a notification, so
+# pending() never has to open an archive.
+class ShardedFileHistory(MutableMapping):
+    UNDATED = "undated"
+
+    def __init__(self, folder, hot_days=90):
+        self.folder = folder
+        self.hot_days = hot_days
+        # archived month -> its pending filenames
+        self.archived = {}
+        # month -> {filename: notified}, hot months and any archives opened this run
+        self.partitions = {}
+        self.dirty = set()
+
+    def _path(self, *names):
+        return os.path.join(self.folder, *names)
+
+    def exists(self):
+        return os.path.exists(self._path(SHARD_MANIFEST))
+
+    def load(self):
+        os.makedirs(self._path(ARCHIVE_FOLDER), exist_ok=True)
+        if self.exists():
+            self.archived = _readJson(self._path(SHARD_MANIFEST))["archived"]
+        for name in os.listdir(self.folder):
+            (month, extension) = os.path.splitext(name)
+            if extension != ".json" or name == SHARD_MANIFEST:
+                continue
+            if month in self.archived:
+                # archived by a commit that stopped before removing it
+                os.remove(self._path(name))
+            else:
+                self.partitions[month] = _readJson(self._path(name))
+        return self
+
+    def _month(self, filename):
+        return toad_functions.recordingMonth(filename) or self.UNDATED
+
+    def _partition(self, month):
+        partition = self.partitions.get(month)
+        if partition is None:
+            if month in self.archived:
+                with gzip.open(self._path(ARCHIVE_FOLDER, month + ".json.gz"), "rt") as f:
+                    partition = json.load(f)
+            else:
+                partition = {}
+            self.partitions[month] = partition
+        return partition
+
+    def __getitem__(self, filename):
+        month = self._month(filename)
+        if month not in self.partitions and month not in self.archived:
+            raise KeyError(filename)
+        return self._partition(month)[filename]
+
+    def __setitem__(self, filename, notified):
+        month = self._month(filename)
+        self._partition(month)[filename] = notified
+        self.dirty.add(month)
+
+    def __delitem__(self, filename):
+        month = self._month(filename)
+        if month not in self.partitions and month not in self.archived:
+            raise KeyError(filename)
+        del self._partition(month)[filename]
+        self.dirty.add(month)
+
+    def months(self):
+        return sorted(set(self.partitions) | set(self.archived))
+
+    # opens every archive, only for migrations and tests
+    def __iter__(self):
+        for month in self.months():
+            yield from list(self._partition(month))
+
+    def __len__(self):
+        return sum(len(self._partition(month)) for month in self.months())
+
+    def pending(self):
+        pending = [filename for (month, partition) in self.partitions.items()
+            for (filename, notified) in partition.items() if notified is False]
+        for (month, filenames) in self.archived.items():
+            if month not in self.partitions:
+                pending.extend(filenames)
+        return pending
+
+    # Write the months that changed. Months that have left the hot window are
+    # archived, and archives opened this run are let go of again.
+    def commit(self, today=None):
+        oldest_hot_month = ((today or date.today()) - timedelta(days=self.hot_days)).strftime("%Y-%m")
+        for (month, partition) in self.partitions.items():
+            archive = month < oldest_hot_month and month != self.UNDATED
+            if archive and (month in self.dirty or month not in self.archived):
+                _writeGzipJson(self._path(ARCHIVE_FOLDER, month + ".json.gz"), partition)
+                self.archived[month] = sorted(filename for (filename, notified) in partition.items() if notified is False)
+            elif not archive and month in self.dirty:
+                _writeJson(self._path(month + ".json"), partition)
+        _writeJson(self._path(SHARD_MANIFEST), {"archived": self.archived})
+
+        for month in list(self.partitions):
+            if month in self.archived:
+                del self.partitions[month]
+                if os.path.exists(self._path(month + ".json")):
+                    os.remove(self._path(month + ".json"))
+        self.dirty.clear()
+
+# JSON state with the file history sharded by month (see ShardedFileHistory),
+# so a run only reads the recent months and rewrites the ones it changed.
+# The first run imports an existing files.json.
+class ShardedStateStore(JsonStateStore):
+    def __init__(self, folder=".", hot_days=90):
+        super().__init__(folder)
+        self.hot_days = hot_days
+
+    def load(self):
+        super().load()
+        self._dropArchivedLinks()
+        return self
+
+    # Links are only kept for files in the hot window. A month's links go the
+    # run after it's archived, found from the manifest without opening it.
+    def _dropArchivedLinks(self):
+        archived = self.file_history.archived
+        for path in [path for path in self.shared_links if toad_functions.recordingMonth(posixpath.basename(path)) in archived]:
+            del self.shared_links[path]
+
+    def _loadFileHistory(self):
+        history = ShardedFileHistory(self._path(FILE_HISTORY_SHARDS), self.hot_days)
+        if not history.exists():
+            super()._loadFileHistory()
+            if not self.new_instance:
+                # the shards are only trusted once the manifest is committed
+                print(f"Migrating {len(self.file_history)} files from {FILE_HISTORY} to {FILE_HISTORY_SHARDS}/")
+            history.load().update(self.file_history)
+            self.file_history = history
+        else:
+            self.file_history = history.load()
+
+    def _commitFileHistory(self):
+        self.file_history.commit()
+
+def _toNotified(value):
+    return None if value is None else int(value)
+
+def _fromNotified(value):
+    return None if value is None else bool(value)
+
+# The rows a statement returned, fetched while the connection was held
+class _FetchedRows():
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.rowcount = cursor.rowcount
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+# A sqlite3 connection the async driver's executor threads can share. Each
+# statement runs under one lock and its rows are fetched before the lock is
+# released, so no two threads ever use the connection or a cursor at once.
+class SerialisedConnection():
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return _FetchedRows(self.connection.execute(sql, parameters))
+
+    def executemany(self, sql, parameters):
+        with self.lock:
+            return _FetchedRows(self.connection.executemany(sql, parameters))
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# A dict-like view of the files table. Writes go straight to the connection
+# and only become durable when the owning store commits.
+class SqliteFileHistory(MutableMapping):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getitem__(self, filename):
+        row = self.connection.execute("SELECT notified FROM files WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            raise KeyError(filename)
+        return _fromNotified(row[0])
+
+    def __setitem__(self, filename, notified):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (filename, notified) VALUES (?, ?)", (filename, _toNotified(notified)))
+
+    def __delitem__(self, filename):
+        cursor = self.connection.execute("DELETE FROM files WHERE filename = ?", (filename,))
+        if cursor.rowcount == 0:
+            raise KeyError(filename)
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute("SELECT filename FROM files"))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def update(self, other=(), **kwargs):
+        rows = dict(other, **kwargs).items()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files (filename, notified) VALUES (?, ?)",
+            ((filename, _toNotified(notified)) for (filename, notified) in rows))
+
+    # files waiting on a notification, answered from the index rather than a scan
+    def pending(self):
+        return [row[0] for row in self.connection.execute("SELECT filename FROM files WHERE notified = 0")]
+
+# A dict-like view of the shared_links table, written the same way as the files table
+class SqliteSharedLinks(MutableMapping):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getitem__(self, path_lower):
+        row = self.connection.execute("SELECT url FROM shared_links WHERE path_lower = ?", (path_lower,)).fetchone()
+        if row is None:
+            raise KeyError(path_lower)
+        return row[0]
+
+    def __setitem__(self, path_lower, url):
+        self.connection.execute("INSERT OR REPLACE INTO shared_links (path_lower, url) VALUES (?, ?)", (path_lower, url))
+
+    def __delitem__(self, path_lower):
+        cursor = self.connection.execute("DELETE FROM shared_links WHERE path_lower = ?", (path_lower,))
+        if cursor.rowcount == 0:
+            raise KeyError(path_lower)
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute("SELECT path_lower FROM shared_links"))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM shared_links").fetchone()[0]
+
+    def update(self, other=(), **kwargs):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO shared_links (path_lower, url) VALUES (?, ?)", dict(other, **kwargs).items())
+
+# State in a single SQLite database. Only new or changed files are written
+# each run and everything is committed in one transaction.
+class SqliteStateStore():
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY NOT NULL, notified INTEGER)",
+        "CREATE INDEX IF NOT EXISTS files_notified ON files (notified)",
+        "CREATE TABLE IF NOT EXISTS sensors (name TEXT PRIMARY KEY NOT NULL, last_activation TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS cursors (folder TEXT PRIMARY KEY NOT NULL, cursor TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS shared_links (path_lower TEXT PRIMARY KEY NOT NULL, url TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS log_index (folder TEXT NOT NULL, day TEXT NOT NULL, filename TEXT NOT NULL, status TEXT, PRIMARY KEY (folder, filename))",
+        "CREATE TABLE IF NOT EXISTS uploads (path TEXT PRIMARY KEY NOT NULL, content_hash TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS recipient_lists (path TEXT PRIMARY KEY NOT NULL, content_hash TEXT NOT NULL, recipients TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY NOT NULL, value TEXT)",
+    ]
+
+    def __init__(self, folder="."):
+        self.folder = folder
+        self.connection = None
+        self.file_history = None
+        self.sensor_history = {}
+        self.cursors = {}
+        self.shared_links = None
+        self.log_index = {}
+        self.upload_hashes = {}
+        self.recipient_lists = {}
+        self.new_instance = False
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self):
+        self.connection = SerialisedConnection(self._path(SQLITE_DATABASE))
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        self.file_history = SqliteFileHistory(self.connection)
+        self.shared_links = SqliteSharedLinks(self.connection)
+
+        # a database is only trusted once a run (or a migration) has committed to it
+        if not self._isInitialised():
+            self.new_instance = not self._migrateFromJson()
+
+        self.sensor_history = _sensorHistoryFromIso(self.connection.execute("SELECT name, last_activation FROM sensors"))
+        self.cursors = dict(self.connection.execute("SELECT folder, cursor FROM cursors"))
+        self.log_index = {}
+        for (folder, day, filename, status) in self.connection.execute("SELECT folder, day, filename, status FROM log_index"):
+            self.log_index.setdefault(folder, {}).setdefault(day, {})[filename] = status
+        self.upload_hashes = dict(self.connection.execute("SELECT path, content_hash FROM uploads"))
+        self.recipient_lists = {path: {"content_hash": content_hash, "recipients": json.loads(recipients)}
+            for (path, content_hash, recipients) in self.connection.execute("SELECT path, content_hash, recipients FROM recipient_lists")}
+        return self
+
+    # one-shot import of an existing JSON state, returns False if there was none
+    def _migrateFromJson(self):
+        json_store = JsonStateStore(self.folder).load()
+        if json_store.new_instance:
+            return False
+
+        print(f"Migrating {len(json_store.file_history)} files from {FILE_HISTORY} to {SQLITE_DATABASE}")
+        self.file_history.update(json_store.file_history)
+        self.shared_links.update(json_store.shared_links)
+        self._writeSmallTables(json_store.sensor_history, json_store.cursors, json_store.log_index,
+            json_store.upload_hashes, json_store.recipient_lists)
+        self.connection.commit()
+        return True
+
+    def _isInitialised(self):
+        return self.connection.execute("SELECT 1 FROM meta WHERE key = 'initialised'").fetchone() is not None
+
+    # tables small enough to keep in memory and rewrite whole, the log index is
+    # bounded by its retention window
+    def _writeSmallTables(self, sensor_history, cursors, log_index, upload_hashes, recipient_lists):
+        self.connection.execute("DELETE FROM sensors")
+        self.connection.executemany("INSERT INTO sensors (name, last_activation) VALUES (?, ?)",
+            _sensorHistoryToIso(sensor_history).items())
+        self.connection.execute("DELETE FROM cursors")
+        self.connection.executemany("INSERT INTO cursors (folder, cursor) VALUES (?, ?)", cursors.items())
+        self.connection.execute("DELETE FROM log_index")
+        self.connection.executemany("INSERT INTO log_index (folder, day, filename, status) VALUES (?, ?, ?, ?)",
+            ((folder, day, filename, status)
+                for (folder, log_days) in log_index.items()
+                for (day, logs) in log_days.items()
+                for (filename, status) in logs.items()))
+        self.connection.execute("DELETE FROM uploads")
+        self.connection.executemany("INSERT INTO uploads (path, content_hash) VALUES (?, ?)", upload_hashes.items())
+        self.connection.execute("DELETE FROM recipient_lists")
+        self.connection.executemany("INSERT INTO recipient_lists (path, content_hash, recipients) VALUES (?, ?, ?)",
+            ((path, cached["content_hash"], json.dumps(cached["recipients"])) for (path, cached) in recipient_lists.items()))
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('initialised', '1')")
+
+    def commit(self):
+        self._writeSmallTables(self.sensor_history, self.cursors, self.log_index, self.upload_hashes, self.recipient_lists)
+        self.connection.commit()
+        self.new_instance = False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+STATE_BACKENDS = {
+    "json": JsonStateStore,
+    "sqlite": SqliteStateStore,
+    "sharded": ShardedStateStore,
+}
+
+# `options` are passed on to the backend, e.g. hot_days for "sharded"
+def openStateStore(backend="json", folder=".", **options):
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Unknown state_backend '{backend}', expected one of {list(STATE_BACKENDS)}")
+    return STATE_BACKENDS[backend](folder, **options).load()
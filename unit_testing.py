@@ -1,6 +1,13 @@
 import unittest
 import json
+import os
+import tempfile
+import asyncio
 import datetime
+import time
+import signal
+import threading
+from unittest import mock
 from datetime import timedelta
 from datetime import timezone
 from toad_functions import (
@@ -12,11 +19,48 @@ from toad_functions import (
   formatNotifications,
   filterSensorDirs,
   filterGroupLogFiles,
+  updateLogIndex,
+  countLogs,
+  reportViewModel,
+  renderReport,
   closeToTimeOfDay,
+  scheduledTimeOfDay,
+  uploadFileToDropbox,
+  UPLOAD_CHUNK_SIZE,
   parse_whitelist_times,
-  time_ranges_contain_time_from_date
+  time_ranges_contain_time_from_date,
+  time_ranges_contain_seconds_of_day,
+  compile_whitelist,
+  getFileChangesFromDropbox,
+  streamFileChangesFromDropbox,
+  iterFilesFromDropbox,
+  mergeFileChanges,
+  getFilesFromDropbox,
+  resolveSharedLinks,
+  notificationPaths,
+  sendEmail,
+  SmtpTransport,
+  MaildirTransport,
+  SendGridTransport,
+  _parseFileInfoGeneric,
+  parseFileTimestamp,
+  Notification,
+  ListingTable,
+  LISTING_NEW,
+  LISTING_PENDING,
+  activationFromIso
 )
+from toad_state import openStateStore
+import toad_notification_system
+from toad_notification_system import loadInstances, runCycleAsync, runInstanceDaemon, runDaemon, Instance
+from benchmarks.fakes import FakeSmtpServer, FakeDropbox, FakeSendGrid
+import toad_metrics
+from toad_metrics import RunMetrics, InstrumentedDropbox, InstrumentedTransport
+from toad_http import ResilientDropbox, RetryPolicy, ApiBudget, ApiBudgetExhausted
+from benchmarks import end_to_end
+import toad_replay
 from dateutil import parser
+import dropbox
 import re
 
 class FileMetadataMock():
@@ -41,6 +85,38 @@ class FileMetadataMock():
       return [ FileMetadataMock(x) for x in filenames ]
 
 
+class ListFolderResultMock():
+    def __init__(self, entries, cursor, has_more=False):
+        self.entries = entries
+        self.cursor = cursor
+        self.has_more = has_more
+
+
+class ListFolderResetErrorMock():
+    def is_reset(self): return True
+
+
+class DropboxListingMock():
+    # pages keyed by the cursor that fetches them, or the folder path for an
+    # initial listing (None for any folder)
+    def __init__(self, pages, reset_cursors=()):
+        self.pages = pages
+        self.reset_cursors = reset_cursors
+        self.calls = []
+
+    def files_list_folder(self, path):
+        self.calls.append(("files_list_folder", path))
+        if path in self.pages:
+            return self.pages[path]
+        return self.pages[None]
+
+    def files_list_folder_continue(self, cursor):
+        self.calls.append(("files_list_folder_continue", cursor))
+        if cursor in self.reset_cursors:
+            raise dropbox.exceptions.ApiError("request-id", ListFolderResetErrorMock(), None, None)
+        return self.pages[cursor]
+
+
 class MyTest(unittest.TestCase):
     default_time_whitelist = parse_whitelist_times(None)
 
@@ -135,6 +211,109 @@ class MyTest(unittest.TestCase):
         self.assertEqual(expected_date, actual_date)
         self.assertEqual(expected_name, actual_name)
 
+    def test_parseFileInfo_fast_path_matches_generic(self):
+        with open("test/fixtures/log_listing.json") as f:
+            names = [entry["name"] for entry in json.load(f)["entries"]]
+        names += [
+          "toad-2018-02-18-100000+0930-sensor26.flac",
+          "toad-2018-02-18-100000+09-sensor26.flac",
+          "toad-2018-02-18-100000Z-sensor26.flac",
+          "toad-2018-02-18-100000-0930-sensor26.flac",
+          "2018-02-18-100000-sensor26.flac",
+          "toad.v2-2018-02-18-100000-sensor26.flac",
+          "toad-2018-02-18-100000-sensor26.tar.gz",
+        ]
+        fallback = timedelta(hours=9.5)
+
+        for name in names:
+            expected = _parseFileInfoGeneric(name, fallback)
+            actual = parseFileInfo(name, fallback)
+            self.assertEqual(expected, actual, name)
+            self.assertEqual(expected[0].utcoffset(), actual[0].utcoffset(), name)
+            self.assertEqual(parseFileTimestamp(name, fallback),
+                (int(expected[0].timestamp()), int(expected[0].utcoffset().total_seconds()), expected[1]), name)
+
+        # names already parsed are answered from the memo
+        hits = parseFileTimestamp.cache_info().hits
+        parseFileTimestamp(names[0], fallback)
+        self.assertEqual(parseFileTimestamp.cache_info().hits, hits + 1)
+
+        for name in ["sensor7", "toad-2018-13-18-100000-sensor26.flac"]:
+            with self.assertRaises(ValueError):
+                parseFileInfo(name, fallback)
+            with self.assertRaises(ValueError):
+                parseFileTimestamp(name, fallback)
+
+    def test_listing_table_only_holds_unprocessed_files(self):
+        files = FileMetadataMock.make_files([
+          "toad-2018-02-18-100000-sensor26.flac",
+          "toad-2018-02-18-110000Z-sensor26.flac",
+          "toad-2018-02-18-120000-sensor28.flac",
+          "toad-2018-02-18-130000-sensor26.flac",
+          "not-a-recording.txt",
+          "toad-2018-02-30-140000-sensor28.flac",
+          "2018-02-18-150000+0930-sensor29.flac",
+        ])
+        file_history = {"toad-2018-02-18-100000-sensor26.flac": True, "toad-2018-02-18-130000-sensor26.flac": False}
+
+        table = ListingTable.fromEntries(files, file_history, timedelta(hours=10))
+
+        self.assertEqual(table.names, [
+          "toad-2018-02-18-110000Z-sensor26.flac",
+          "toad-2018-02-18-120000-sensor28.flac",
+          "toad-2018-02-18-130000-sensor26.flac",
+          "2018-02-18-150000+0930-sensor29.flac"])
+        self.assertEqual(table.paths, ["/mock_path/" + name for name in table.names])
+        self.assertEqual(table.sensor_names, ["sensor26", "sensor28", "sensor29"])
+        self.assertEqual(list(table.sensor_ids), [0, 1, 0, 2])
+        self.assertEqual(list(table.notified), [LISTING_NEW, LISTING_NEW, LISTING_PENDING, LISTING_NEW])
+        self.assertEqual(list(table.utc_offsets), [0, 36000, 36000, 34200])
+        self.assertEqual(table.secondsOfDay(), [11 * 3600, 12 * 3600, 13 * 3600, 15 * 3600])
+        self.assertEqual(table.recordedAt(1), parser.isoparse("2018-02-18T12:00:00+10:00"))
+        self.assertEqual(len(ListingTable.fromEntries(files[:1], file_history, timedelta(hours=10))), 0)
+
+    def test_notifications_only_for_unprocessed_files(self):
+        files = FileMetadataMock.make_files([
+          "toad-2018-02-18-100000-sensor26.flac",
+          "toad-2018-02-18-110000Z-sensor26.flac",
+          "toad-2018-02-18-120000-sensor28.flac",
+          "toad-2018-02-18-130000-sensor26.flac",
+          "not-a-recording.txt",
+        ])
+        file_history = {"toad-2018-02-18-100000-sensor26.flac": True, "toad-2018-02-18-130000-sensor26.flac": False}
+        now = parser.isoparse("2018-02-19T00:00:00+10:00")
+
+        (notifications, sensors_status) = getNotificationsAndActivatingSensors(files, file_history, {},
+          3600, timedelta(hours=10), now, parse_whitelist_times([["11:30", "24:00"]]))
+
+        self.assertEqual([notification.name for notification in notifications], [
+          "toad-2018-02-18-110000Z-sensor26.flac",
+          "toad-2018-02-18-120000-sensor28.flac",
+          "toad-2018-02-18-130000-sensor26.flac"])
+        self.assertEqual([notification.utc_offset for notification in notifications], [0, 36000, 36000])
+        self.assertEqual([notification.suppress for notification in notifications], [True, False, False])
+        self.assertEqual(notifications[1].recordedAt(), parser.isoparse("2018-02-18T12:00:00+10:00"))
+        self.assertEqual(sensors_status, {"sensor26": SensorState.ACTIVATED, "sensor28": SensorState.ACTIVATED})
+
+    def test_notifications_only_keep_what_they_need(self):
+        files = FileMetadataMock.make_files(["toad-2018-08-12-191000-sensor36.flac", "toad-2018-08-12-120000Z-sensor36.flac"])
+        now = parser.isoparse("2018-08-12T19:30:00+10:00")
+        (notifications_to_send, sensors_status) = getNotificationsAndActivatingSensors(
+            files, {}, {}, 3600, timedelta(hours=10), now, parse_whitelist_times([["18:00", "24:00"]]))
+
+        self.assertEqual(notifications_to_send, [
+            Notification("toad-2018-08-12-191000-sensor36.flac", "/mock_path/toad-2018-08-12-191000-sensor36.flac",
+                int(parser.isoparse("2018-08-12T19:10:00+10:00").timestamp()), 36000, "sensor36", False),
+            Notification("toad-2018-08-12-120000Z-sensor36.flac", "/mock_path/toad-2018-08-12-120000Z-sensor36.flac",
+                int(parser.isoparse("2018-08-12T12:00:00Z").timestamp()), 0, "sensor36", True)])
+        self.assertEqual(notifications_to_send[0].recordedAt(), parser.isoparse("2018-08-12T19:10:00+10:00"))
+        # every notification from a sensor shares its name
+        self.assertIs(notifications_to_send[0].sensor_name, notifications_to_send[1].sensor_name)
+
+        sensor_history = {}
+        updateState(notifications_to_send, sensors_status, {}, sensor_history, now)
+        self.assertEqual(sensor_history, {"sensor36": now.timestamp()})
+
     def test_parseFileInfo_arg_validation(self):
         with self.assertRaises(TypeError):
             parseFileInfo("abc", None)
@@ -144,10 +323,29 @@ class MyTest(unittest.TestCase):
         test_result = getEmailsFromDropbox("<placeholder>", None, True, "test@example.com\ntest2@ex.com", ["<placeholder>"])
         self.assertEqual(test_result, expected_result)
 
+    def test_recipient_list_is_cached_until_it_changes(self):
+        dbx = FakeDropbox()
+        dbx.addFile("/mock_path/emails.txt", "a@example.com\n\nToad Team <B@example.com>\nnot an address\nA@Example.com\n".encode("utf-8"))
+        with tempfile.TemporaryDirectory() as folder:
+            state = openStateStore("sqlite", folder)
+            expected = ["a@example.com", "Toad Team <B@example.com>"]
+            self.assertEqual(getEmailsFromDropbox("/mock_path/emails.txt", dbx, recipient_cache=state.recipient_lists), expected)
+            state.commit()
+            state.close()
+
+            state = openStateStore("sqlite", folder)
+            self.assertEqual(getEmailsFromDropbox("/mock_path/emails.txt", dbx, recipient_cache=state.recipient_lists), expected)
+            self.assertEqual((dbx.calls["files_download"], dbx.calls["files_get_metadata"]), (1, 1))
+
+            dbx.addFile("/mock_path/emails.txt", b"c@example.com\n")
+            self.assertEqual(getEmailsFromDropbox("/mock_path/emails.txt", dbx, recipient_cache=state.recipient_lists), ["c@example.com"])
+            self.assertEqual(dbx.calls["files_download"], 2)
+            state.close()
+
     def test_scenario_1(self):
         files = self.scenario1_files
         file_history = json.loads(self.scenario1_file_history)
-        sensor_history = json.loads(self.scenario1_sensors)
+        sensor_history = self.load_sensor_history(self.scenario1_sensors)
         now =  parser.isoparse(self.scenario1_now)
         actual = getNotificationsAndActivatingSensors(files, file_history, sensor_history, 3600, timedelta(hours=0), now, self.default_time_whitelist)
         self.assert_notifications(actual, 1, 1, 1)
@@ -163,7 +361,7 @@ class MyTest(unittest.TestCase):
     def test_scenario_2(self):
         files = self.scenario2_files
         file_history = json.loads(self.scenario2_file_history)
-        sensor_history = json.loads(self.scenario2_sensors)
+        sensor_history = self.load_sensor_history(self.scenario2_sensors)
         now = parser.isoparse(self.scenario2_now)
         actual = getNotificationsAndActivatingSensors(files, file_history, sensor_history, 3600, timedelta(hours=0), now, self.default_time_whitelist)
         self.assert_notifications(actual, 1, 0, 1)
@@ -179,7 +377,7 @@ class MyTest(unittest.TestCase):
     def test_scenario_3(self):
         files = self.scenario3_files
         file_history = json.loads(self.scenario3_file_history)
-        sensor_history = json.loads(self.scenario3_sensors)
+        sensor_history = self.load_sensor_history(self.scenario3_sensors)
         now = parser.isoparse(self.scenario3_now)
         actual = getNotificationsAndActivatingSensors(files, file_history, sensor_history, 3600, timedelta(hours=0), now, self.default_time_whitelist)
         self.assert_notifications(actual, 1, 1, 2)
@@ -195,7 +393,7 @@ class MyTest(unittest.TestCase):
     def test_scenario_4(self):
         files = self.scenario4_files
         file_history = json.loads(self.scenario4_file_history)
-        sensor_history = json.loads(self.scenario4_sensors)
+        sensor_history = self.load_sensor_history(self.scenario4_sensors)
         now = parser.isoparse(self.scenario4_now)
         actual = getNotificationsAndActivatingSensors(files, file_history, sensor_history, 3600, timedelta(hours=0), now, self.default_time_whitelist)
         self.assert_notifications(actual, 2, 1, 2)
@@ -211,7 +409,7 @@ class MyTest(unittest.TestCase):
     def test_scenario_5(self):
         files = self.scenario5_files
         file_history = json.loads(self.scenario5_file_history)
-        sensor_history = json.loads(self.scenario5_sensors)
+        sensor_history = self.load_sensor_history(self.scenario5_sensors)
         now = parser.isoparse(self.scenario5_now)
         actual = getNotificationsAndActivatingSensors(files, file_history, sensor_history, 3600, timedelta(hours=0), now, self.default_time_whitelist)
         self.assert_notifications(actual, 2, 0, 2)
@@ -349,6 +547,68 @@ class MyTest(unittest.TestCase):
             self.assertEqual(len(list(filter(lambda entry: entry[2] == "up", log_entries))), up_count)
             self.assertEqual(len(list(filter(lambda entry: entry[2] == "down", log_entries))), down_count)
 
+    def test_incremental_log_index(self):
+        with open("test/fixtures/log_listing.json") as f:
+            log_listing = FileMetadataMock.make_files(json.load(f)["entries"])
+        folder = "/test/sensor7/logs"
+        pages = {
+            folder: ListFolderResultMock(log_listing, "c1"),
+            "c1": ListFolderResultMock(
+                FileMetadataMock.make_files(["log-2018-08-28-180000-down.txt"]) +
+                [dropbox.files.DeletedMetadata(name="log-2018-08-27-120530-up.txt")], "c2"),
+        }
+        tz = timezone(timedelta(hours=10))
+        report_date = datetime.datetime(2018, 8, 28, 12, 0, tzinfo=tz)
+        fallback_utc_offset = timedelta(hours=10)
+        retention = timedelta(days=3)
+
+        log_index = {"/test/gone/logs": {}}
+        cursors = {"/test/gone/logs": "old", "/mock_path": "root"}
+        dbx = DropboxListingMock(pages)
+        updateLogIndex(dbx, [folder], log_index, cursors, report_date, retention, fallback_utc_offset)
+        self.assertEqual(list(log_index), [folder])
+        self.assertEqual(cursors, {"/mock_path": "root", folder: "c1"})
+
+        # the same counts as grouping the full listing, for the retained days
+        expected = filterGroupLogFiles(log_listing, report_date, None, fallback_utc_offset)
+        counts = countLogs(log_index[folder])
+        self.assertEqual(list(counts), ["2018-08-25", "2018-08-26", "2018-08-27", "2018-08-28", "2018-08-29", "2018-08-30", "2018-08-31"])
+        for (day, day_counts) in counts.items():
+            self.assertEqual(sum(day_counts.values()), len(expected[day]))
+        self.assertEqual(counts["2018-08-28"], {"up": 1, "down": 1})
+
+        # then only the changes are listed
+        dbx = DropboxListingMock(pages)
+        updateLogIndex(dbx, [folder], log_index, cursors, report_date, retention, fallback_utc_offset)
+        self.assertEqual(dbx.calls, [("files_list_folder_continue", "c1")])
+        counts = countLogs(log_index[folder])
+        self.assertEqual(counts["2018-08-28"], {"up": 1, "down": 2})
+        self.assertEqual(sum(counts["2018-08-27"].values()), len(expected["2018-08-27"]) - 1)
+
+    def test_report_view_model(self):
+        full_report = {
+            "name": "Testing notifier",
+            "report_date": "2018-08-28T12:00:00+10:00",
+            "sensors": {
+                "sensor7": {"last_activation": None, "logs": {"2018-08-28": {"up": 1, "down": 1}, "2018-08-27": {"up": 6, "down": 1}}},
+            },
+        }
+        view_model = reportViewModel(full_report, datetime.date(2018, 8, 28), report_days=3)
+        self.assertEqual(view_model["dates"], ["2018-08-28", "2018-08-27", "2018-08-26"])
+        self.assertEqual(view_model["sensors"], [{
+            "name": "sensor7",
+            "last_activation": None,
+            "checks": [
+                {"verdict": "healthy", "up": 1, "down": 1},
+                {"verdict": "unbalanced", "up": 6, "down": 1},
+                {"verdict": "missing"}],
+        }])
+
+        page = renderReport(full_report, datetime.date(2018, 8, 28))
+        self.assertEqual(page.count("✅"), 1)
+        self.assertIn('title="6 up logs, 1 down logs"', page)
+        self.assertEqual(page.count("❌"), 3)
+
     def test_close_to_time_of_day(self):
       times = ["12:00", "15:00"]
 
@@ -371,6 +631,37 @@ class MyTest(unittest.TestCase):
         test_now = parser.parse(test_now_string)
         self.assertEqual(closeToTimeOfDay(test_now, times), expected)
 
+    def test_scheduled_time_of_day(self):
+      times = ["12:00", "15:00"]
+      self.assertEqual(scheduledTimeOfDay(parser.parse("2018-08-12T15:04:00+10:00"), times), parser.parse("2018-08-12T15:00:00+10:00"))
+      self.assertEqual(scheduledTimeOfDay(parser.parse("2018-08-12T11:56:30+10:00"), times), parser.parse("2018-08-12T12:00:00+10:00"))
+      self.assertIsNone(scheduledTimeOfDay(parser.parse("2018-08-12T14:00:00+10:00"), times))
+
+    def test_upload_skips_unchanged_content(self):
+        dbx = FakeDropbox()
+        upload_hashes = {}
+        self.assertTrue(uploadFileToDropbox(dbx, "report 1", "/status/report.json", upload_hashes))
+        self.assertEqual(dbx.calls, {"files_get_metadata": 1, "files_upload": 1})
+
+        # unchanged content costs nothing once we know what we uploaded
+        dbx.calls.clear()
+        self.assertFalse(uploadFileToDropbox(dbx, "report 1", "/status/report.json", upload_hashes))
+        self.assertEqual(dbx.calls, {})
+        self.assertTrue(uploadFileToDropbox(dbx, "report 2", "/status/report.json", upload_hashes))
+        self.assertEqual(dbx.calls, {"files_upload": 1})
+
+        # otherwise Dropbox's content_hash is checked
+        dbx.calls.clear()
+        self.assertFalse(uploadFileToDropbox(dbx, "report 2", "/status/report.json", {}))
+        self.assertEqual(dbx.calls, {"files_get_metadata": 1})
+
+        # large content goes through an upload session
+        dbx.calls.clear()
+        content = "x" * (2 * UPLOAD_CHUNK_SIZE + 10)
+        self.assertTrue(uploadFileToDropbox(dbx, content, "/status/big.json"))
+        self.assertEqual(dbx.calls, {"files_upload_session_start": 1, "files_upload_session_append_v2": 1, "files_upload_session_finish": 1})
+        self.assertEqual(dbx.contents["/status/big.json"], content.encode("utf-8"))
+
     def test_parse_whitelist_times(self):
         test_cases = [
             None,
@@ -418,10 +709,664 @@ class MyTest(unittest.TestCase):
             actual = time_ranges_contain_time_from_date(whitelist, date)
             self.assertEqual(expected, actual, f"failed for `{date}`")
 
+        dates = [parser.parse(date) for (date, _) in test_cases_dates[3:]]
+        seconds_of_day = [date.hour * 3600 + date.minute * 60 + date.second for date in dates]
+        self.assertEqual(time_ranges_contain_seconds_of_day(test_cases_whitelist[3], seconds_of_day),
+            [expected for (_, expected) in test_cases_dates[3:]])
+
+    def test_compiled_whitelist(self):
+        whitelist = compile_whitelist(
+            {"sat": [["00:00", "24:00"]], "sun": [["00:00", "24:00"]], "default": [["20:00", "24:00"], ["00:00", "05:30"]]},
+            {"sensor7": [["12:00", "13:00"]]})
+
+        # 2018-08-12 is a Sunday
+        test_cases = [
+            ("2018-08-12T14:55:01+10:00", "sensor36", True),
+            ("2018-08-13T14:55:01+10:00", "sensor36", False),
+            ("2018-08-13T20:00:00+10:00", "sensor36", True),
+            ("2018-08-14T05:30:00+10:00", "sensor36", False),
+            ("2018-08-14T05:29:59-09:30", "sensor36", True),
+            ("2018-08-12T14:55:01+10:00", "sensor7", False),
+            ("2018-08-13T12:59:59+10:00", "sensor7", True),
+        ]
+        sensor_names = ["sensor36", "sensor7"]
+        local_seconds = []
+        for (date, sensor_name, expected) in test_cases:
+            date = parser.isoparse(date)
+            local_seconds.append(int(date.timestamp() + date.utcoffset().total_seconds()))
+            self.assertEqual(whitelist.contains(local_seconds[-1], sensor_name), expected, f"failed for `{date}` on {sensor_name}")
+
+        sensor_ids = [sensor_names.index(sensor_name) for (_, sensor_name, _) in test_cases]
+        self.assertEqual(whitelist.containsAll(local_seconds, sensor_ids, sensor_names), [expected for (*_, expected) in test_cases])
+        # without sensor ids every time is checked against the default week
+        self.assertEqual(whitelist.containsAll(local_seconds[:5]), [expected for (*_, expected) in test_cases[:5]])
+
+        with self.assertRaises(ValueError):
+            compile_whitelist({"someday": [["00:00", "24:00"]]})
+
+    def test_file_changes_follow_cursor(self):
+        pages = {
+            None: ListFolderResultMock(FileMetadataMock.make_files(["a.flac"]), "c1", has_more=True),
+            "c1": ListFolderResultMock(FileMetadataMock.make_files(["b.flac"]), "c2"),
+            "c2": ListFolderResultMock(FileMetadataMock.make_files(["c.flac"]), "c3"),
+        }
+
+        dbx = DropboxListingMock(pages)
+        (entries, cursor, full_listing) = getFileChangesFromDropbox(dbx, "/mock_path")
+        self.assertEqual([e.name for e in entries], ["a.flac", "b.flac"])
+        self.assertEqual(cursor, "c2")
+        self.assertTrue(full_listing)
+
+        dbx = DropboxListingMock(pages)
+        (entries, cursor, full_listing) = getFileChangesFromDropbox(dbx, "/mock_path", "c2")
+        self.assertEqual([e.name for e in entries], ["c.flac"])
+        self.assertEqual(cursor, "c3")
+        self.assertFalse(full_listing)
+        self.assertEqual(dbx.calls, [("files_list_folder_continue", "c2")])
+
+    def test_file_changes_relist_on_reset_cursor(self):
+        pages = {None: ListFolderResultMock(FileMetadataMock.make_files(["a.flac"]), "c1")}
+        dbx = DropboxListingMock(pages, reset_cursors=["expired"])
+
+        (entries, cursor, full_listing) = getFileChangesFromDropbox(dbx, "/mock_path", "expired")
+        self.assertEqual([e.name for e in entries], ["a.flac"])
+        self.assertEqual(cursor, "c1")
+        self.assertTrue(full_listing)
+
+    def test_streamed_listing(self):
+        pages = {
+            None: ListFolderResultMock(FileMetadataMock.make_files(["toad-2018-08-12-191000-sensor36.flac"]), "c1", has_more=True),
+            "c1": ListFolderResultMock(FileMetadataMock.make_files(["toad-2018-08-12-191500-sensor36.flac"]), "c2", has_more=True),
+            "c2": ListFolderResultMock(FileMetadataMock.make_files(["toad-2018-08-12-192000-sensor36.flac"]), "c3"),
+        }
+
+        # pages are only fetched as they're needed
+        dbx = DropboxListingMock(pages)
+        entries = iter(iterFilesFromDropbox(dbx, "/mock_path", prefetch=False))
+        next(entries)
+        self.assertEqual(dbx.calls, [("files_list_folder", "/mock_path")])
+
+        # the notification search consumes the stream, after which its cursor is known
+        dbx = DropboxListingMock(pages)
+        (listing, full_listing) = streamFileChangesFromDropbox(dbx, "/mock_path")
+        self.assertTrue(full_listing)
+        self.assertIsNone(listing.cursor)
+        now = parser.isoparse("2018-08-12T19:30:00+10:00")
+        (notifications_to_send, sensors_status) = getNotificationsAndActivatingSensors(
+            listing, {}, {}, 3600, timedelta(hours=10), now, self.default_time_whitelist)
+        self.assertEqual(len(notifications_to_send), 3)
+        self.assertEqual(sensors_status, {"sensor36": SensorState.ACTIVATED})
+        self.assertEqual((listing.cursor, listing.count), ("c3", 3))
+
+    def test_concurrent_log_index_keeps_order_and_retries(self):
+        folders = [f"/mock_path/sensor{i}/logs" for i in range(10)]
+        names = [f"log-2018-08-28-{i:02}0000-up.txt" for i in range(10)]
+        pages = {folder: ListFolderResultMock(FileMetadataMock.make_files([name]), folder + "|c1")
+            for (folder, name) in zip(folders, names)}
+        dbx = DropboxListingMock(pages)
+        rate_limited = set()
+        list_folder = dbx.files_list_folder
+        def rateLimitOnce(path):
+            if path not in rate_limited:
+                rate_limited.add(path)
+                raise dropbox.exceptions.RateLimitError("request-id", backoff=0)
+            return list_folder(path)
+        dbx.files_list_folder = rateLimitOnce
+
+        (log_index, cursors) = ({}, {})
+        report_date = datetime.datetime(2018, 8, 28, 12, 0, tzinfo=timezone(timedelta(hours=10)))
+        updateLogIndex(dbx, folders, log_index, cursors, report_date, timedelta(days=3), timedelta(hours=10), max_workers=3)
+
+        self.assertEqual(list(log_index), folders)
+        self.assertEqual([log_index[folder] for folder in folders], [{"2018-08-28": {name: "up"}} for name in names])
+        self.assertEqual(cursors, {folder: folder + "|c1" for folder in folders})
+        self.assertEqual(rate_limited, set(folders))
+
+    def test_format_notifications_digest(self):
+        now = parser.isoparse("2018-08-12T19:10:00+10:00")
+        notifications_to_send = [Notification(name, "/mock_path/" + name, int(now.timestamp()), 36000, sensor_name, False)
+            for (name, sensor_name) in [
+            ("a.flac", "sensor1"),
+            ("b.flac", "sensor2"),
+            ("c.flac", "sensor1"),
+            ("d.flac", "sensor1"),
+            ("e.flac", "sensor3")]]
+        sensors_status = {"sensor2": SensorState.ACTIVATED, "sensor1": SensorState.ACTIVATED, "sensor3": SensorState.PAUSED}
+        href_function = lambda path: "fakeurl://" + path
+
+        self.assertEqual(notificationPaths(notifications_to_send, sensors_status, 2),
+            ["/mock_path/b.flac", "/mock_path/a.flac", "/mock_path/c.flac"])
+        self.assertEqual(formatNotifications(notifications_to_send, sensors_status, href_function, 2),
+            "<h1>Toad Update in Dropbox</h1>"
+            "<h2>Suspicious recordings from sensor2</h2><p><a href=\"fakeurl:///mock_path/b.flac\">b.flac</a></p>"
+            "<h2>Suspicious recordings from sensor1</h2><p><a href=\"fakeurl:///mock_path/a.flac\">a.flac</a></p>"
+            "<p><a href=\"fakeurl:///mock_path/c.flac\">c.flac</a></p><p>and 1 more recordings from sensor1</p>")
+        self.assertEqual(formatNotifications(notifications_to_send, sensors_status, href_function).count("<p>"), 4)
+
+    def test_resolve_shared_links_only_requests_new_paths(self):
+        class SharedLinkMock():
+            def __init__(self, url): self.url = url
+        class DropboxSharingMock():
+            def __init__(self): self.requested = []
+            def sharing_create_shared_link_with_settings(self, path):
+                self.requested.append(path)
+                return SharedLinkMock("fakeurl://" + path)
+
+        dbx = DropboxSharingMock()
+        link_cache = {"/mock_path/a.flac": "fakeurl://cached"}
+        paths = ["/mock_path/a.flac", "/mock_path/b.flac", "/mock_path/c.flac", "/mock_path/b.flac"]
+
+        resolveSharedLinks(dbx, paths, link_cache, max_workers=2)
+
+        self.assertCountEqual(dbx.requested, ["/mock_path/b.flac", "/mock_path/c.flac"])
+        self.assertEqual(link_cache, {
+            "/mock_path/a.flac": "fakeurl://cached",
+            "/mock_path/b.flac": "fakeurl:///mock_path/b.flac",
+            "/mock_path/c.flac": "fakeurl:///mock_path/c.flac"})
+
+        resolveSharedLinks(dbx, paths, link_cache)
+        self.assertEqual(len(dbx.requested), 2)
+
+    def test_send_email_batches_recipients(self):
+        class ResponseMock():
+            def __init__(self, status_code): self.status_code = status_code
+        class SendGridMock():
+            def __init__(self):
+                self.requests = []
+                self.client = self
+                self.mail = self
+                self.send = self
+            def post(self, request_body):
+                self.requests.append(request_body)
+                # fail the second batch
+                return ResponseMock(500 if len(self.requests) == 2 else 202)
+
+        sg = SendGridMock()
+        recipients = [f"test{i}@example.com" for i in range(2500)]
+
+        outcomes = sendEmail("<p>body</p>", "test", recipients + recipients[:10], "bot@example.com", sg)
+
+        self.assertEqual([len(request["personalizations"]) for request in sg.requests], [1000, 1000, 500])
+        self.assertEqual(sg.requests[0]["personalizations"][0]["to"], [{"email": "test0@example.com"}])
+        self.assertEqual(list(outcomes.keys()), recipients)
+        self.assertEqual([recipient for (recipient, sent) in outcomes.items() if not sent], recipients[1000:2000])
+
+    def test_smtp_transport_reuses_connection(self):
+        recipients = ["test1@example.com", "test2@example.com", "test3@example.com"]
+        with FakeSmtpServer() as server:
+            transport = SmtpTransport("127.0.0.1", server.port)
+            outcomes = sendEmail("<p>body</p>", "test", recipients, "bot@example.com", transport)
+            outcomes.update(sendEmail("<p>body</p>", "test", recipients, "bot@example.com", transport))
+            transport.close()
+
+        self.assertEqual(outcomes, {recipient: True for recipient in recipients})
+        self.assertEqual(server.messages, 6)
+        self.assertEqual(server.connections, 1)
+
+    def test_maildir_transport(self):
+        import mailbox
+        with tempfile.TemporaryDirectory() as folder:
+            transport = MaildirTransport(folder)
+            outcomes = sendEmail("<p>body</p>", "test", ["test1@example.com", "test2@example.com"], "bot@example.com", transport)
+
+            self.assertEqual(outcomes, {"test1@example.com": True, "test2@example.com": True})
+            messages = list(mailbox.Maildir(folder))
+            self.assertCountEqual([message["To"] for message in messages], ["test1@example.com", "test2@example.com"])
+            self.assertIn("<p>body</p>", messages[0].get_payload(decode=True).decode("utf-8"))
+            self.assertEqual(len({message["Message-ID"] for message in messages}), 2)
+            self.assertTrue(all(message["Date"] for message in messages))
+            # SMTP line endings, never a bare LF
+            raw = transport.maildir.get_bytes(transport.maildir.keys()[0])
+            self.assertEqual(raw.count(b"\n"), raw.count(b"\r\n"))
+
+    def test_merge_file_changes(self):
+        f1 = "toad-2018-08-12-190631-sensor36.flac"
+        f2 = "toad-2018-08-12-194235-sensor36.flac"
+        f3 = "toad-2018-08-12-200236-sensor36.flac"
+        f4 = "toad-2018-08-14-074924-sensor36.flac"
+        file_history = {f1: True, f2: False, f3: False}
+        changes = FileMetadataMock.make_files([f4]) + [dropbox.files.DeletedMetadata(name=f3)]
+
+        actual = mergeFileChanges(changes, file_history, "/Mock_Path")
+
+        # pending f2 is not in the delta but must still be processed, deleted f3 is forgotten
+        self.assertEqual(sorted(e.name for e in actual), [f2, f4])
+        self.assertEqual([e.path_lower for e in actual if e.name == f2], ["/mock_path/" + f2])
+        self.assertEqual(file_history, {f1: True, f2: False})
+
+    def test_status_report_only_keeps_hashes_of_its_own_uploads(self):
+        now = parser.isoparse("2021-01-01T00:00:00+10:00")
+        dbx = FakeDropbox()
+        end_to_end.syntheticArchive(dbx, now, files=20, sensors=2, days=1, recipients=2)
+        system_configuration = {"name": "Testing notifier", "root_folder": end_to_end.ROOT_FOLDER,
+            "log_folder": end_to_end.LOG_FOLDER, "save_status_reports_folder": None,
+            "filename_send_to": end_to_end.EMAIL_LIST, "send_from": "bot@example.com", "pause_duration": 3600,
+            "fallback_utc_offset": 36000, "whitelist_times_of_day": None, "update_status_report_at": ["00:00"]}
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                transport = MaildirTransport(os.path.join(folder, "outbox"))
+                state = openStateStore("json", folder)
+                for day in range(3):
+                    self.assertTrue(toad_notification_system.runCycle(system_configuration, dbx, transport, state, now + timedelta(days=day)))
+                upload_hashes = openStateStore("json", folder).upload_hashes
+            finally:
+                os.chdir(working_directory)
+
+        self.assertIn(end_to_end.LOG_FOLDER + "/sensors_status_2021-01-01.html", dbx.contents)
+        self.assertEqual(sorted(upload_hashes), [end_to_end.LOG_FOLDER + "/sensors_status.json",
+            end_to_end.LOG_FOLDER + "/sensors_status_2021-01-03.html"])
+
+    def test_sqlite_state_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            state = openStateStore("sqlite", folder)
+            self.assertTrue(state.new_instance)
+            state.file_history.update({"a.flac": True, "b.flac": False, "c.flac": None})
+            state.sensor_history["sensor36"] = activationFromIso("2018-08-12T19:10:00+10:00")
+            state.cursors["/mock_path"] = "c1"
+            state.shared_links["/mock_path/a.flac"] = "fakeurl://a"
+            state.commit()
+            state.close()
+
+            state = openStateStore("sqlite", folder)
+            self.assertFalse(state.new_instance)
+            self.assertEqual(dict(state.file_history), {"a.flac": True, "b.flac": False, "c.flac": None})
+            self.assertEqual(state.file_history.pending(), ["b.flac"])
+            self.assertEqual(state.sensor_history, {"sensor36": activationFromIso("2018-08-12T19:10:00+10:00")})
+            self.assertEqual(state.cursors, {"/mock_path": "c1"})
+            self.assertEqual(dict(state.shared_links), {"/mock_path/a.flac": "fakeurl://a"})
+
+            # uncommitted changes are discarded
+            state.file_history["b.flac"] = True
+            state.file_history["d.flac"] = False
+            state.close()
+            state = openStateStore("sqlite", folder)
+            self.assertEqual(state.file_history["b.flac"], False)
+            self.assertNotIn("d.flac", state.file_history)
+            state.close()
+
+    def test_sqlite_state_migrates_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            state = openStateStore("json", folder)
+            self.assertTrue(state.new_instance)
+            state.file_history.update({"a.flac": True, "b.flac": False})
+            state.sensor_history["sensor36"] = activationFromIso("2018-08-12T19:10:00+10:00")
+            state.commit()
+            with open(os.path.join(folder, "sensors.json")) as f:
+                self.assertEqual(json.load(f), {"sensor36": "2018-08-12T09:10:00+00:00"})
+
+            state = openStateStore("sqlite", folder)
+            self.assertFalse(state.new_instance)
+            self.assertEqual(dict(state.file_history), {"a.flac": True, "b.flac": False})
+            self.assertEqual(state.sensor_history, {"sensor36": activationFromIso("2018-08-12T19:10:00+10:00")})
+
+            changes = [dropbox.files.DeletedMetadata(name="b.flac")]
+            self.assertEqual(mergeFileChanges(changes, state.file_history, "/mock_path"), [])
+            self.assertEqual(dict(state.file_history), {"a.flac": True})
+            state.close()
+
+    def test_sharded_state_archives_old_months(self):
+        today = datetime.date.today()
+        old_day = today - timedelta(days=400)
+        (recent_month, old_month) = (today.strftime("%Y-%m"), old_day.strftime("%Y-%m"))
+        recent = f"toad-{today:%Y-%m-%d}-120000-sensor1.flac"
+        old = f"toad-{old_day:%Y-%m-%d}-120000-sensor1.flac"
+        late = f"toad-{old_day:%Y-%m-%d}-130000-sensor2.flac"
+        with tempfile.TemporaryDirectory() as folder:
+            state = openStateStore("json", folder)
+            state.file_history.update({recent: True, old: False, "notes.txt": None})
+            state.commit()
+
+            state = openStateStore("sharded", folder, hot_days=90)
+            self.assertFalse(state.new_instance)
+            self.assertEqual(dict(state.file_history), {recent: True, old: False, "notes.txt": None})
+            state.shared_links.update({"/audio/" + recent.lower(): "fakeurl://recent", "/audio/" + old.lower(): "fakeurl://old"})
+            state.commit()
+
+            # the old month is archived, and only opened to look up a file from it
+            state = openStateStore("sharded", folder, hot_days=90)
+            self.assertEqual(sorted(state.file_history.partitions), [recent_month, "undated"])
+            self.assertEqual(state.file_history.pending(), [old])
+            # an archived month's links are dropped with it
+            self.assertEqual(state.shared_links, {"/audio/" + recent.lower(): "fakeurl://recent"})
+            self.assertNotIn(late, state.file_history)
+            self.assertIn(old_month, state.file_history.partitions)
+            state.file_history[late] = True
+            state.shared_links["/audio/" + late.lower()] = "fakeurl://late"
+            state.commit()
+            self.assertEqual(sorted(state.file_history.partitions), [recent_month, "undated"])
+
+            state = openStateStore("sharded", folder, hot_days=90)
+            self.assertEqual(state.file_history[late], True)
+            self.assertEqual(state.file_history.pending(), [old])
+            self.assertEqual(state.shared_links, {"/audio/" + recent.lower(): "fakeurl://recent"})
+            self.assertTrue(os.path.exists(os.path.join(folder, "files", "archive", old_month + ".json.gz")))
+            self.assertFalse(os.path.exists(os.path.join(folder, "files", old_month + ".json")))
+
+    def test_load_instances_gives_each_config_its_own_state(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for (name, configuration) in [("b.json", {"name": "b"}), ("a.json", {"name": "a", "state_folder": "/srv/a"})]:
+                with open(os.path.join(folder, name), "w") as f:
+                    json.dump(configuration, f)
+            with open(os.path.join(folder, "notes.txt"), "w") as f:
+                f.write("not a config")
+
+            instances = loadInstances([folder])
+            self.assertEqual([instance.name for instance in instances], ["a", "b"])
+            self.assertEqual([instance.state_folder for instance in instances], ["/srv/a", os.path.join("state", "b")])
+
+            (instance,) = loadInstances([os.path.join(folder, "b.json")])
+            self.assertEqual(instance.state_folder, ".")
+
+    def test_end_to_end_benchmark(self):
+        results = end_to_end.main(files=500, sensors=5, days=3, recipients=10, new_files=10)
+        # the backfill is a new instance, so nothing in the archive is notified
+        self.assertNotIn("send", results["runs"]["backfill"]["stages"])
+        incremental = results["runs"]["incremental"]
+        self.assertIn("send", incremental["stages"])
+        # the audio folder and each sensor's logs carry on from their cursors
+        self.assertEqual(incremental["api_calls"]["files_list_folder_continue"], 1 + 5)
+        self.assertGreater(results["emails"]["personalizations"], 0)
+
+    def test_async_cycle(self):
+        now = parser.isoparse("2021-01-01T00:00:00+10:00")
+        system_configuration = {"name": "Testing notifier", "root_folder": end_to_end.ROOT_FOLDER,
+            "log_folder": end_to_end.LOG_FOLDER, "save_status_reports_folder": None,
+            "filename_send_to": end_to_end.EMAIL_LIST, "send_from": "bot@example.com", "pause_duration": 3600,
+            "fallback_utc_offset": 36000, "whitelist_times_of_day": None, "update_status_report_at": ["00:00"]}
+        working_directory = os.getcwd()
+        for backend in ["json", "sqlite", "sharded"]:
+            with self.subTest(backend=backend), tempfile.TemporaryDirectory() as folder:
+                dbx = FakeDropbox(page_size=20)
+                end_to_end.syntheticArchive(dbx, now, files=50, sensors=3, days=2, recipients=2)
+                os.chdir(folder)
+                loop = asyncio.new_event_loop()
+                # the cycle runs the store's calls on the loop's executor threads
+                state = openStateStore(backend, folder)
+                try:
+                    transport = MaildirTransport(os.path.join(folder, "outbox"))
+                    # a new instance only makes the report
+                    self.assertTrue(loop.run_until_complete(runCycleAsync(system_configuration, dbx, transport, state, now)))
+                    dbx.addFile(end_to_end.ROOT_FOLDER + "/toad-2021-01-01-015000+1000-sensor0.flac")
+                    self.assertFalse(loop.run_until_complete(
+                        runCycleAsync(system_configuration, dbx, transport, state, now + timedelta(hours=2))))
+                    outbox = os.listdir(os.path.join(folder, "outbox", "new"))
+
+                    self.assertEqual(len(outbox), 2)
+                    self.assertIn(end_to_end.LOG_FOLDER + "/sensors_status.json", dbx.contents)
+                    self.assertEqual(state.cursors[end_to_end.ROOT_FOLDER], "/instance/audio|51")
+                    self.assertEqual(state.file_history["toad-2021-01-01-015000+1000-sensor0.flac"], True)
+                finally:
+                    state.close()
+                    loop.close()
+                    os.chdir(working_directory)
+
+    def test_replay_timeline(self):
+        timeline = "\n".join([
+            "toad-2021-01-01-000100+1000-sensor0.flac\t2021-01-01T00:02:00+10:00",
+            "toad-2021-01-01-001100+1000-sensor0.flac\t2021-01-01T00:12:00+10:00",
+            # arrives when it was recorded
+            "toad-2021-01-01-002100+1000-sensor1.flac",
+            # outside the whitelist
+            "toad-2020-12-31-120000+1000-sensor2.flac\t2021-01-01T00:42:00+10:00",
+            "toad-2021-01-01-010700+1000-sensor0.flac",
+            "notes.txt",
+        ])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "timeline.txt")
+            with open(path, "w") as f:
+                f.write(timeline)
+            arrivals = toad_replay.loadTimeline(path, timedelta(hours=10))
+            # a recorded timeline starts at its first arrival unless --start is given
+            from_first_arrival = toad_replay.main(["--timeline", path, "--days", "1"])
+            from_start = toad_replay.main(["--timeline", path, "--days", "1", "--start", "2021-01-01T00:00:00+10:00"])
+        self.assertEqual(len(arrivals), 5)
+        self.assertEqual(from_first_arrival["runs"], from_start["runs"])
+        self.assertLess(from_first_arrival["mean_seconds_to_email"], from_start["mean_seconds_to_email"])
+
+        start = parser.isoparse("2021-01-01T00:00:00+10:00")
+        whitelist = compile_whitelist([["18:00", "24:00"], ["00:00", "06:00"]])
+        (runs, results, delays) = toad_replay.replay(arrivals, start, start + timedelta(minutes=90),
+            timedelta(minutes=5), 3600, whitelist, timedelta(hours=10))
+
+        self.assertEqual(runs, 19)
+        self.assertEqual([(result.run_at - start).total_seconds() // 60 for result in results], [5, 15, 20, 25, 45, 70])
+        self.assertEqual([result.emailed for result in results],
+            [{"sensor0": 1}, {}, {}, {"sensor1": 1}, {}, {"sensor0": 1}])
+        # sensor0's second file waits while it's paused, then goes out unlisted when sensor1 triggers an email
+        self.assertEqual([result.pending for result in results], [0, 1, 1, 0, 0, 0])
+        self.assertEqual([result.silenced for result in results], [0, 0, 0, 1, 0, 0])
+        self.assertEqual([result.suppressed for result in results], [0, 0, 0, 0, 1, 0])
+
+        summary = toad_replay.summarise(runs, results, delays)
+        self.assertEqual(summary["emails"], 3)
+        self.assertEqual(summary["files_emailed_by_sensor"], {"sensor0": 2, "sensor1": 1})
+        self.assertEqual(summary["max_seconds_to_email"], 240)
+
+    def test_daemon_cycles_and_reports_once(self):
+        now = datetime.datetime.now(timezone.utc)
+        dbx = FakeDropbox()
+        end_to_end.syntheticArchive(dbx, now, files=20, sensors=2, days=1, recipients=2)
+        # the first cycle fails part way through its listing
+        list_folder = dbx.files_list_folder
+        failed = []
+        def failOnce(path):
+            if not failed:
+                failed.append(path)
+                raise RuntimeError("listing failed")
+            return list_folder(path)
+        dbx.files_list_folder = failOnce
+
+        with tempfile.TemporaryDirectory() as folder:
+            instance = self.daemon_instance(folder, dbx, now)
+            stop = threading.Event()
+            wake = threading.Event()
+            with mock.patch.object(toad_notification_system, "openState", wraps=toad_notification_system.openState) as openState:
+                daemon = threading.Thread(target=runInstanceDaemon, args=(instance, 0.01, False, 0, stop, wake))
+                daemon.start()
+                try:
+                    self.wait_for(lambda: len(self.cycle_metrics(folder)) >= 5)
+                finally:
+                    stop.set()
+                    wake.set()
+                    daemon.join(5)
+            self.assertFalse(daemon.is_alive())
+
+            cycles = self.cycle_metrics(folder)
+            self.assertEqual([cycle["failed"] for cycle in cycles[:3]], [True, False, False])
+            self.assertFalse(any(cycle["failed"] for cycle in cycles[1:]))
+            # the failed cycle's state is thrown away and opened again
+            self.assertEqual(openState.call_count, 2)
+            # the report is made by the first cycle that succeeds, and not again for the same time
+            self.assertEqual([("report_list" in cycle["stages"]) for cycle in cycles[:2]], [False, True])
+            self.assertEqual(sum("report_list" in cycle["stages"] for cycle in cycles), 1)
+
+    def test_longpoll_wakes_the_daemon(self):
+        now = datetime.datetime.now(timezone.utc)
+        dbx = FakeDropbox()
+        end_to_end.syntheticArchive(dbx, now, files=5, sensors=1, days=1, recipients=1)
+        with tempfile.TemporaryDirectory() as folder:
+            instance = self.daemon_instance(folder, dbx, now)
+            outbox = os.path.join(folder, "outbox", "new")
+            stop = threading.Event()
+            wake = threading.Event()
+            # cycles only come early, when the watcher sees a change
+            daemon = threading.Thread(target=runInstanceDaemon, args=(instance, 60, True, 0, stop, wake))
+            daemon.start()
+            watchers = lambda: [thread for thread in threading.enumerate() if thread.name == "longpoll Testing notifier"]
+            try:
+                self.wait_for(lambda: len(watchers()) == 1)
+                # the first cycle squashes the archive's notifications, as a new instance
+                self.wait_for(lambda: dbx.calls["files_list_folder_longpoll"] == 1)
+                self.assertEqual(len(self.cycle_metrics(folder)), 1)
+                dbx.addFile(end_to_end.ROOT_FOLDER + "/" + end_to_end._recordingName(now, 0))
+                self.wait_for(lambda: os.path.isdir(outbox) and len(os.listdir(outbox)) == 1)
+                self.assertEqual(len(self.cycle_metrics(folder)), 2)
+            finally:
+                stop.set()
+                wake.set()
+                daemon.join(5)
+                # the longpoll in progress returns with the next change
+                dbx.addFile(end_to_end.ROOT_FOLDER + "/" + end_to_end._recordingName(now + timedelta(seconds=1), 0))
+                for watcher in watchers():
+                    watcher.join(5)
+            self.assertFalse(daemon.is_alive())
+            self.assertEqual(watchers(), [])
+            self.assertEqual(len(os.listdir(outbox)), 1)
+
+    def test_daemon_stops_on_signal(self):
+        now = datetime.datetime.now(timezone.utc)
+        dbx = FakeDropbox()
+        end_to_end.syntheticArchive(dbx, now, files=5, sensors=1, days=1, recipients=1)
+        previous_handlers = {signal_number: signal.getsignal(signal_number) for signal_number in (signal.SIGTERM, signal.SIGINT)}
+        stopped = threading.Event()
+        def terminate():
+            # until the daemon has its handlers in place and stops
+            while not stopped.wait(0.1):
+                if signal.getsignal(signal.SIGTERM) not in (previous_handlers[signal.SIGTERM], signal.SIG_DFL):
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+        with tempfile.TemporaryDirectory() as folder:
+            instance = self.daemon_instance(folder, dbx, now)
+            killer = threading.Thread(target=terminate)
+            killer.start()
+            try:
+                runDaemon([instance], 0.01, min_gap=0)
+            finally:
+                stopped.set()
+                killer.join()
+                for (signal_number, handler) in previous_handlers.items():
+                    signal.signal(signal_number, handler)
+            self.assertGreaterEqual(len(self.cycle_metrics(folder)), 1)
+
+    def test_run_metrics(self):
+        metrics = RunMetrics("Testing notifier", parser.isoparse("2021-01-01T00:00:00+10:00"))
+        fake_dropbox = FakeDropbox(page_size=2)
+        for name in ["a.flac", "b.flac", "c.flac"]:
+            fake_dropbox.addFile("/mock_path/" + name)
+        dbx = InstrumentedDropbox(fake_dropbox, metrics)
+
+        with metrics.stage("list"):
+            self.assertEqual(len(getFilesFromDropbox(dbx, "/mock_path")), 3)
+        with self.assertRaises(dropbox.exceptions.ApiError):
+            dbx.sharing_create_shared_link_with_settings("/mock_path/a.flac")
+            dbx.sharing_create_shared_link_with_settings("/mock_path/a.flac")
+        with tempfile.TemporaryDirectory() as folder:
+            transport = InstrumentedTransport(MaildirTransport(folder), metrics)
+            transport.send("bot@example.com", "subject", "<p>hi</p>", ["a@example.com", "b@example.com"])
+        metrics.finish()
+
+        result = metrics.toDict()
+        self.assertEqual(list(result["stages"]), ["list"])
+        self.assertEqual(result["items"], {"emails_sent": 2, "emails_failed": 0})
+        calls = {(call["api"], call["call"]): call["count"] for call in result["api_calls"]}
+        self.assertEqual(calls, {
+            ("dropbox", "files_list_folder"): 1,
+            ("dropbox", "files_list_folder_continue"): 1,
+            ("dropbox", "sharing_create_shared_link_with_settings"): 2,
+            ("email", "MaildirTransport"): 1})
+        self.assertEqual(result["api_errors"], [
+            {"api": "dropbox", "call": "sharing_create_shared_link_with_settings", "error": "api", "count": 1}])
+
+        textfile = metrics.toPrometheus()
+        self.assertIn('toad_api_calls{instance="Testing notifier",api="dropbox",call="files_list_folder"} 1\n', textfile)
+        self.assertIn('toad_run_items{instance="Testing notifier",item="emails_sent"} 2\n', textfile)
+
+    def test_connect_leaves_retries_to_toad_http(self):
+        with tempfile.TemporaryDirectory() as folder:
+            system_configuration = {"dropbox_api_key": "key", "email_transport": {"type": "maildir", "folder": folder}}
+            with mock.patch.object(dropbox, "Dropbox") as Dropbox, mock.patch.object(toad_metrics, "countingSession"):
+                toad_notification_system.connect(system_configuration)
+        # with the SDK retrying a rate limit itself, and forever, ours would never run
+        (_args, options) = Dropbox.call_args
+        self.assertEqual((options["max_retries_on_error"], options["max_retries_on_rate_limit"]), (0, 0))
+
+    def test_resilient_dropbox_retries_and_budget(self):
+        metrics = RunMetrics("Testing notifier", parser.isoparse("2021-01-01T00:00:00+10:00"))
+        fake_dropbox = FakeDropbox(page_size=2)
+        for name in ["a.flac", "b.flac", "c.flac"]:
+            fake_dropbox.addFile("/mock_path/" + name)
+        failures = [dropbox.exceptions.InternalServerError("request-id", 500, None),
+            dropbox.exceptions.RateLimitError("request-id", backoff=0)]
+        list_folder = fake_dropbox.files_list_folder
+        def failTwice(path):
+            if failures:
+                raise failures.pop(0)
+            return list_folder(path)
+        fake_dropbox.files_list_folder = failTwice
+        dbx = ResilientDropbox(InstrumentedDropbox(fake_dropbox, metrics), RetryPolicy(retries=2, base_delay=0), ApiBudget(4), metrics)
+
+        self.assertEqual(len(getFilesFromDropbox(dbx, "/mock_path")), 3)
+        # 3 attempts to list, 1 to continue and the budget is spent
+        with self.assertRaises(ApiBudgetExhausted):
+            dbx.files_get_metadata("/mock_path/a.flac")
+        # an error that isn't transient is raised straight away
+        dbx = ResilientDropbox(fake_dropbox, RetryPolicy(retries=2, base_delay=0), ApiBudget(), metrics)
+        with self.assertRaises(dropbox.exceptions.ApiError):
+            dbx.files_get_metadata("/mock_path/missing.flac")
+
+        self.assertEqual(metrics.items, {"api_retries": 2, "api_throttled": 1, "api_budget_exhausted": 1})
+        self.assertEqual(metrics.api_calls[("dropbox", "files_list_folder")], 3)
+
+    def test_sendgrid_retries_throttled_requests(self):
+        class TooManyRequests(Exception):
+            status_code = 429
+            headers = {"Retry-After": "0"}
+        sendgrid_client = FakeSendGrid()
+        post = sendgrid_client.post
+        throttled = []
+        def throttleOnce(request_body):
+            if not throttled:
+                throttled.append(request_body)
+                raise TooManyRequests()
+            return post(request_body)
+        sendgrid_client.client.mail.send.post = throttleOnce
+        metrics = RunMetrics("Testing notifier", parser.isoparse("2021-01-01T00:00:00+10:00"))
+        transport = InstrumentedTransport(SendGridTransport(sendgrid_client, RetryPolicy(retries=1, base_delay=0)), metrics)
+
+        outcomes = transport.send("bot@example.com", "subject", "<p>hi</p>", ["a@example.com", "b@example.com"])
+
+        self.assertEqual(outcomes, {"a@example.com": True, "b@example.com": True})
+        self.assertEqual(sendgrid_client.requests, 1)
+        self.assertEqual(metrics.items, {"email_retries": 1, "email_throttled": 1, "emails_sent": 2, "emails_failed": 0})
+
     #
     # Helper methods
     #
 
+    # An instance against `dbx` (filled by end_to_end.syntheticArchive) with
+    # its state, email and metrics in `folder`, due a status report at `now`
+    def daemon_instance(self, folder, dbx, now):
+        system_configuration = {"name": "Testing notifier", "root_folder": end_to_end.ROOT_FOLDER,
+            "log_folder": end_to_end.LOG_FOLDER, "save_status_reports_folder": None,
+            "filename_send_to": end_to_end.EMAIL_LIST, "send_from": "bot@example.com", "pause_duration": 3600,
+            "fallback_utc_offset": 36000, "whitelist_times_of_day": None, "api_retries": 0,
+            "update_status_report_at": [now.strftime("%H:%M")],
+            "metrics": {"json_lines": os.path.join(folder, "metrics.jsonl")}}
+        instance = Instance(os.path.join(folder, "config.json"), system_configuration, os.path.join(folder, "state"))
+        instance.dbx = dbx
+        instance.email_transport = MaildirTransport(os.path.join(folder, "outbox"))
+        return instance
+
+    # the metrics of every cycle the instance from daemon_instance has run
+    def cycle_metrics(self, folder):
+        try:
+            with open(os.path.join(folder, "metrics.jsonl")) as f:
+                return [json.loads(line) for line in f]
+        except OSError:
+            return []
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    # sensor_history as a state store loads it from sensors.json
+    def load_sensor_history(self, document):
+        return {sensor_name: activationFromIso(activated_at) for (sensor_name, activated_at) in json.loads(document).items()}
+
     def assert_notifications(self, actual, sensor_count, sensor_active, notification_count):
         (notifications_to_send, sensors_status) = actual
         self.assertEqual(len(sensors_status), sensor_count)
@@ -431,7 +1376,7 @@ class MyTest(unittest.TestCase):
     def step_runner(self, steps):
       db_files = []
       file_history = {}
-      sensor_history = {"sensor36": "2018-08-12T18:00:00+10:00"}
+      sensor_history = {"sensor36": activationFromIso("2018-08-12T18:00:00+10:00")}
       times_whitelist =  [
           (timedelta(hours=18), timedelta(days=1)), 
           (timedelta(days=0), timedelta(hours=10))
@@ -451,16 +1396,18 @@ class MyTest(unittest.TestCase):
         (file_history, sensor_history, send_notifications) = updateState(*actual, file_history, sensor_history, now)
                 
         self.assertEqual(file_history, expected_history)
-        self.assertEqual(sensor_history, {"sensor36": sensor_last_update})
+        self.assertEqual(sensor_history, {"sensor36": activationFromIso(sensor_last_update)})
         self.assertEqual(send_notifications, step["send_notifications"])
 
-        body = formatNotifications(*actual, lambda path: "fakeurl://" + path)
+        linked_paths = []
+        body = formatNotifications(*actual, lambda path: linked_paths.append(path) or "fakeurl://" + path)
+        self.assertEqual(linked_paths, notificationPaths(*actual))
 
         self.assertEqual(len(re.findall("sensor36</h2>", body)), 1 if send_notifications else 0)
         if send_notifications:
             notifications_to_send = actual[0]
-            for (entry, *_) in notifications_to_send:
-                self.assertRegex(body, "fakeurl:///mock_path/" + entry.name)
+            for notification in notifications_to_send:
+                self.assertRegex(body, "fakeurl:///mock_path/" + notification.name)
 
 
 if __name__ == '__main__':